@@ -0,0 +1,122 @@
+import time
+
+import numpy as np
+
+from datadriven_modeling import Hankel_matrix, Simulate_dynamics
+
+
+def Hankel_matrix_loop(z: np.array, i: int, N: int, t: int) -> np.array:
+    '''
+    the element-by-element Hankel_matrix it replaced, verbatim, kept only to benchmark against
+    (it ignores i and always starts at z(0), so it is only compared with i = 0)
+    '''
+    if i + t + N - 2 >= z.shape[1]:
+        raise Exception(f"source array ({z.shape[1]} elements) can't build Hankel matrix {t}x{N}!")
+
+    sigma = z.shape[0]
+
+    Hz = np.zeros((t*sigma, N))
+
+    for tt in range(t):
+        for nn in range(N):
+            for s in range(sigma):
+                Hz[tt*sigma+s, nn] = z[s, nn + tt]
+
+    return Hz
+
+
+def best_time(function, repeat: int = 3) -> float:
+    best = np.inf
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def benchmark_hankel(sizes=((1, 1, 1000), (2, 1, 10000), (2, 4, 10000), (3, 10, 40000))):
+    '''
+    sizes is a list of (sigma, t, N), sigma being the number of logged signals
+
+    return:
+    list of (sigma, t, N, loop [s], strided copy [s], strided view [s])
+    '''
+    rng = np.random.default_rng(0)
+    results = []
+
+    for sigma, t, N in sizes:
+        z = rng.standard_normal((sigma, N + t))
+
+        if not np.array_equal(Hankel_matrix_loop(z, 0, N, t), Hankel_matrix(z, 0, N, t)):
+            raise Exception(f"strided Hankel matrix differs from the loop one for sigma={sigma}, t={t}, N={N}")
+
+        results.append((sigma, t, N,
+                        best_time(lambda: Hankel_matrix_loop(z, 0, N, t), repeat=1),
+                        best_time(lambda: Hankel_matrix(z, 0, N, t)),
+                        best_time(lambda: Hankel_matrix(z, 0, N, t, zero_copy=True))))
+
+    return results
+
+
+def Simulate_dynamics_loop(A: np.array, B: np.array, U: np.array, x0: np.array) -> np.array:
+    '''
+    reference step-by-step simulation (the former Model_01/Model_02 loop), for a single model
+    '''
+    X = np.zeros((A.shape[0], U.shape[1]))
+    X[:, 0] = x0
+    x = x0.reshape((-1, 1))
+
+    for i in range(U.shape[1] - 1):
+        u = np.array([[U[0, i]]])
+        x = A @ x + B @ u
+        X[:, i + 1] = x[:, 0]
+
+    return X
+
+
+def benchmark_simulation(sizes=((1, 4000), (100, 4000), (1000, 1000))):
+    '''
+    sizes is a list of (sequences, T): number of input sequences simulated at once and their length
+
+    return:
+    list of (sequences, T, loop [s], scan [s])
+    '''
+    rng = np.random.default_rng(0)
+    A = np.array([[1, 0.05],
+                  [0, 0.99]])
+    B = np.array([[0],
+                  [10 / 3]])
+    x0 = np.zeros(2)
+    results = []
+
+    for sequences, T in sizes:
+        U = rng.standard_normal((sequences, 1, T))
+
+        if not np.allclose(Simulate_dynamics_loop(A, B, U[0], x0), Simulate_dynamics(A, B, U[0], x0)):
+            raise Exception(f"scan simulation differs from the loop one for T={T}")
+
+        results.append((sequences, T,
+                        best_time(lambda: [Simulate_dynamics_loop(A, B, U[s], x0) for s in range(sequences)],
+                                  repeat=1),
+                        best_time(lambda: Simulate_dynamics(A, B, U, x0))))
+
+    return results
+
+
+def main():
+    print(f"{'sigma':>6}{'t':>6}{'N':>8}{'loop [ms]':>14}{'copy [ms]':>14}{'view [ms]':>14}")
+
+    for sigma, t, N, loop, copy, view in benchmark_hankel():
+        print(f"{sigma:>6}{t:>6}{N:>8}{loop*1e3:>14.3f}{copy*1e3:>14.3f}{view*1e3:>14.3f}")
+
+    print()
+    print(f"{'sequences':>10}{'T':>8}{'loop [ms]':>14}{'scan [ms]':>14}")
+
+    for sequences, T, loop, scan in benchmark_simulation():
+        print(f"{sequences:>10}{T:>8}{loop*1e3:>14.3f}{scan*1e3:>14.3f}")
+
+
+if __name__ == '__main__':
+    main()
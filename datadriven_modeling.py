@@ -1,16 +1,22 @@
+import argparse
+import functools
+import hashlib
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
 import numpy as np
-import matplotlib.pyplot as plt
-import control
-import zmq
 
 
-def Hankel_matrix(z: np.array, i: int, N: int, t: int) -> np.array:
+def Hankel_matrix(z: np.array, i: int, N: int, t: int, zero_copy: bool = False) -> np.array:
     '''
     arguments:
     z is a row array (len > 1) where each element is a column array of the same length
     i is a natural number
     N (number of columns) is a natural number >= 1
     t (number of rows) is a natural number >= 1
+    zero_copy selects a read-only strided view instead of a new matrix
 
     precondition:
     i+t+N-2 must be less than len(z)
@@ -24,23 +30,61 @@ def Hankel_matrix(z: np.array, i: int, N: int, t: int) -> np.array:
                     .....
     [z(i+t-1)  z(i+t)    z(i+t+1)  ...   z(i+t+N-2)]]
     ```
+
+    with zero_copy the matrix shares memory with z whenever z is stored sample-major
+    (column-major, or a single signal); otherwise only the t+N-1 used samples are
+    copied once and the view is built on top of them.
     '''
     if i + t + N - 2 >= z.shape[1]:
         raise Exception(f"source array ({z.shape[1]} elements) can't build Hankel matrix {t}x{N}!")
 
+    Hz = _Hankel_view(z, i, N, t)
+
+    if zero_copy:
+        return Hz
+
+    return np.array(Hz, dtype=np.float64)
+
+
+def _Hankel_view(z: np.array, i: int, N: int, t: int) -> np.array:
     sigma = z.shape[0]
+    z = z[:, i:i + t + N - 1]
 
-    Hz = np.zeros((t*sigma, N))
+    # rows tt*sigma+s walk the signals and then the samples, which is a single stride
+    # only when consecutive samples are sigma elements apart
+    if z.dtype != np.float64 or (sigma > 1 and z.strides[1] != sigma * z.strides[0]):
+        z = np.asfortranarray(z, dtype=np.float64)
 
-    for tt in range(t):
-        for nn in range(N):
-            for s in range(sigma):
-                Hz[tt*sigma+s, nn] = z[s, nn + tt]
+    step = z.strides[1]
 
-    return Hz
+    return np.lib.stride_tricks.as_strided(z, shape=(t * sigma, N), strides=(step // sigma, step),
+                                           writeable=False)
 
 
-def Make_data_driven_dynamics(x_0: np.array, x_1: np.array, u_0: np.array) -> np.array:
+def Make_data_driven_dynamics(x_0: np.array, x_1: np.array, u_0: np.array, t: int = 1, rank: int = None,
+                              rcond: float = 1e-15) -> np.array:
+    '''
+    arguments:
+    x_0, x_1 and u_0 are row arrays of states, next states and inputs (x_1 is x_0 shifted by one sample)
+    t (model depth) is a natural number >= 1
+    rank optionally caps the number of singular values kept by the least-squares solver
+    rcond drops singular values below rcond * largest singular value, like np.linalg.pinv
+
+    return:
+    (B, A) of the model
+    ```
+    x(k+t) = A_0 x(k) + ... + A_{t-1} x(k+t-1) + B_0 u(k) + ... + B_{t-1} u(k+t-1)
+    ```
+    realized in block observer form, with n states and m inputs:
+    ```
+    A = [[A_{t-1}  I  0  ...  0]       B = [[B_{t-1}]
+         [A_{t-2}  0  I  ...  0]            [B_{t-2}]
+                  .....                       .....
+         [A_0      0  0  ...  0]]           [B_0    ]]
+    ```
+    so A is (n*t)x(n*t), B is (n*t)x(m) and the first n states are x itself (C = [I 0 ... 0]).
+    For t = 1 this is the one-step model x(k+1) = A x(k) + B u(k).
+    '''
     i = 0
     #Nt = lambda z: (z.shape[1] - (z.shape[0] - 1), z.shape[0])
     #Nx0, tx0 = Nt(x_0)
@@ -51,41 +95,238 @@ def Make_data_driven_dynamics(x_0: np.array, x_1: np.array, u_0: np.array) -> np
     Nx1 = x_1.shape[1]
     Nu0 = u_0.shape[1]
 
-    tx0 = tx1 = tu0 = 1
+    num_cols = np.min((Nx0, Nx1, Nu0)) - t + 1
 
-    num_cols = np.min((Nx0, Nx1, Nu0))
+    X_0 = Hankel_matrix(x_0, i, num_cols, t, zero_copy=True) # sinal, i, N, t
+    X_1 = Hankel_matrix(x_1, i + t - 1, num_cols, 1, zero_copy=True)
+    U_0 = Hankel_matrix(u_0, i, num_cols, t, zero_copy=True)
 
-    X_0 = Hankel_matrix(x_0, i, num_cols, tx0) # sinal, i, N, t
-    X_1 = Hankel_matrix(x_1, i, num_cols, tx1)
-    U_0 = Hankel_matrix(u_0, i, num_cols, tu0)
+    dynamics = Solve_least_squares(X_1, (U_0, X_0), rank=rank, rcond=rcond)
 
-    Inverse = np.block([[U_0], [X_0]])
-    Inverse = np.linalg.pinv(Inverse)
+    return _Observer_form(dynamics, x_0.shape[0], u_0.shape[0], t)
 
-    dynamics = X_1 @ Inverse
 
-    m = u_0.shape[0]
+def _Observer_form(dynamics: np.array, n: int, m: int, t: int) -> np.array:
+    # dynamics = [B_0 ... B_{t-1} A_0 ... A_{t-1}], see Make_data_driven_dynamics
+    A = np.zeros((n*t, n*t))
+    B = np.zeros((n*t, m))
+    A[:n*(t - 1), n:] = np.eye(n*(t - 1))
 
-    A = dynamics[:, m:]
-    B = dynamics[:, :m]
+    for tt in range(t):
+        row = (t - 1 - tt)*n
+        A[row:row + n, :n] = dynamics[:, m*t + tt*n:m*t + (tt + 1)*n]
+        B[row:row + n, :] = dynamics[:, tt*m:(tt + 1)*m]
 
     return B, A
 
 
+def Solve_least_squares(target: np.array, regressors, rank: int = None, rcond: float = 1e-15,
+                        chunk: int = 4096) -> np.array:
+    '''
+    arguments:
+    target is a (n)x(N) matrix
+    regressors is a sequence of matrices with N columns, stacked vertically into a (k)x(N) matrix Phi
+    rank optionally caps the number of singular values kept
+    rcond drops singular values below rcond * largest singular value
+    chunk is the number of columns factorized at a time
+
+    return:
+    the (n)x(k) matrix Theta minimizing ||Theta Phi - target||, i.e. target @ pinv(Phi)
+
+    [Phi; target]^T is reduced column chunk by column chunk to its triangular QR factor
+    [[R11 R12], [0 R22]], so only (k+n)x(k+n) numbers are kept whatever N is, and Theta^T
+    is the truncated-SVD solution of the small system R11 Theta^T = R12.
+    '''
+    N = target.shape[1]
+    k = sum(regressor.shape[0] for regressor in regressors)
+
+    R = np.zeros((0, k + target.shape[0]))
+
+    for start in range(0, N, chunk):
+        columns = slice(start, start + chunk)
+        block = np.vstack([regressor[:, columns] for regressor in regressors] + [target[:, columns]]).T
+        R = np.linalg.qr(np.vstack((R, block)), mode='r')
+
+    U, S, Vt = np.linalg.svd(R[:, :k], full_matrices=False)
+
+    keep = S > rcond * S[0] if S.size and S[0] > 0 else np.zeros(S.shape, dtype=bool)
+    if rank is not None:
+        keep[rank:] = False
+
+    theta_t = Vt[keep].T @ ((U[:, keep].T @ R[:, k:]) / S[keep, None])
+
+    return theta_t.T
+
+
+class RecursiveDynamics:
+    '''
+    recursive least-squares version of Make_data_driven_dynamics, fed one sample at a time
+
+    arguments:
+    n is the number of states, m the number of inputs
+    t (model depth) is a natural number >= 1
+    forgetting (0 < forgetting <= 1) discounts old samples by forgetting^age
+    delta (> 0) starts the solver from P = I/delta and a zero model instead (None for the exact start)
+
+    The regressor [u(k) ... u(k+t-1) x(k) ... x(k+t-1)] has k = (m+n)*t entries. Until the
+    samples make the information matrix invertible they are accumulated in it (its rank is
+    checked every k samples), then the solver starts from the exact batch solution, so with
+    forgetting = 1 the model after a window of samples is the one Make_data_driven_dynamics
+    finds on that window. Every sample costs O(k^2). With delta the samples go to the solver
+    from the first one, at the price of a bias of delta on the information matrix, which
+    fades with forgetting < 1.
+    '''
+    def __init__(self, n: int, m: int, t: int = 1, forgetting: float = 1.0, delta: float = None):
+        self.n = n
+        self.m = m
+        self.t = t
+        self.forgetting = forgetting
+
+        k = (m + n) * t
+
+        self.__theta = np.zeros((n, k))
+        self.__P = None if delta is None else np.eye(k) / delta
+        self.__information = np.zeros((k, k))
+        self.__cross = np.zeros((n, k))
+        self.__states = np.zeros((n, t))
+        self.__inputs = np.zeros((m, t))
+        self.__phi = np.zeros(k)
+        self.__history = 0
+
+        self.samples = 0
+
+    def update(self, x: np.array, u: np.array):
+        '''
+        x is the state measured at this sample and u the input applied at it
+        (a MyLog row gives both)
+        '''
+        x = np.ravel(x)
+        u = np.ravel(u)
+
+        if self.__history == self.t:
+            self.__phi[:self.m * self.t] = self.__inputs.ravel(order='F')
+            self.__phi[self.m * self.t:] = self.__states.ravel(order='F')
+            self.__update(self.__phi, x)
+
+        # shift the histories left, the newest sample goes last
+        self.__states[:, :-1] = self.__states[:, 1:]
+        self.__inputs[:, :-1] = self.__inputs[:, 1:]
+        self.__states[:, -1] = x
+        self.__inputs[:, -1] = u
+        self.__history = min(self.__history + 1, self.t)
+
+    def update_window(self, X: np.array, U: np.array):
+        '''
+        X and U are row arrays of states and inputs, fed sample by sample
+        '''
+        for k in range(X.shape[1]):
+            self.update(X[:, k], U[:, k])
+
+    def __update(self, phi: np.array, y: np.array):
+        self.samples += 1
+
+        if self.__P is None:
+            self.__information *= self.forgetting
+            self.__information += np.outer(phi, phi)
+            self.__cross *= self.forgetting
+            self.__cross += np.outer(y, phi)
+
+            if self.samples % phi.size == 0 and np.linalg.matrix_rank(self.__information) == phi.size:
+                self.__P = np.linalg.inv(self.__information)
+                self.__theta = self.__cross @ self.__P
+            return
+
+        Pphi = self.__P @ phi
+        gain = Pphi / (self.forgetting + phi @ Pphi)
+
+        self.__theta += np.outer(y - self.__theta @ phi, gain)
+        self.__P -= np.outer(gain, Pphi)
+        self.__P /= self.forgetting
+        # keep P symmetric against round-off
+        self.__P += self.__P.T
+        self.__P *= 0.5
+
+    def is_ready(self) -> bool:
+        return self.__P is not None and self.samples >= self.__phi.size
+
+    def dynamics(self) -> np.array:
+        '''
+        return:
+        (B, A) in the block observer form of Make_data_driven_dynamics
+        (the minimum-norm batch solution while the exact start waits for enough samples)
+        '''
+        theta = self.__theta if self.__P is not None else self.__cross @ np.linalg.pinv(self.__information)
+
+        return _Observer_form(theta, self.n, self.m, self.t)
+
+
+def Simulate_dynamics(A: np.array, B: np.array, U: np.array, x0: np.array = None) -> np.array:
+    '''
+    arguments:
+    A is a (n)x(n) matrix and B a (n)x(m) matrix, or stacks (...)x(n)x(n) and (...)x(n)x(m) of models
+    U is a (m)x(T) row array of inputs, or a stack (...)x(m)x(T) of input sequences
+    x0 is the initial state, (n) or (n)x(1) or a stack of them (zeros if None)
+
+    return:
+    (...)x(n)x(T) row array of states with x(k+1) = A x(k) + B u(k), x(0) = x0 (u(T-1) is unused,
+    like the last sample of a log); the leading dimensions broadcast between models, inputs and x0
+
+    The recursion is evaluated as a prefix scan, x(k) = sum_j A^(k-j) z(j) with z(0) = x0 and
+    z(j) = B u(j-1), doubling the reach of each term every round: log2(T) batched products over
+    preallocated buffers instead of T Python steps. When the next power of an unstable A would
+    overflow (where 0 * inf turns even the states it never reaches into NaN), the doubling stops
+    and the sums over the last window length are carried forward one window at a time.
+    '''
+    A = np.asarray(A, dtype=np.float64)
+    B = np.asarray(B, dtype=np.float64)
+    U = np.asarray(U, dtype=np.float64)
+    n = A.shape[-1]
+    T = U.shape[-1]
+
+    if x0 is None:
+        x0 = np.zeros(n)
+    x0 = np.asarray(x0, dtype=np.float64)
+    if x0.ndim >= 2 and x0.shape[-2:] == (n, 1):
+        x0 = x0[..., 0]
+
+    batch = np.broadcast_shapes(A.shape[:-2], B.shape[:-2], U.shape[:-2], x0.shape[:-1])
+
+    # time-major buffers so that every round is a single (...)x(T)x(n) @ (...)x(n)x(n) product
+    scan = np.empty((*batch, T, n))
+    scan[..., 0, :] = x0
+    np.matmul(np.swapaxes(U[..., :T - 1], -1, -2), np.swapaxes(B, -1, -2), out=scan[..., 1:, :])
+
+    power = np.broadcast_to(np.swapaxes(A, -1, -2), (*batch, n, n)).copy()
+    product = np.empty_like(scan)
+
+    shift = 1
+    while shift < T:
+        with np.errstate(all="ignore"):
+            squared = power @ power
+        if not np.isfinite(squared).all():
+            break
+        np.matmul(scan[..., :T - shift, :], power, out=product[..., :T - shift, :])
+        scan[..., shift:, :] += product[..., :T - shift, :]
+        power = squared
+        shift *= 2
+
+    # scan holds the sums over windows of `shift` samples, x(k) = A^shift x(k-shift) + window(k)
+    for start in range(shift, T, shift):
+        stop = min(start + shift, T)
+        np.matmul(scan[..., start - shift:stop - shift, :], power, out=product[..., :stop - start, :])
+        scan[..., start:stop, :] += product[..., :stop - start, :]
+
+    return np.swapaxes(scan, -1, -2)
+
+
 def Model_01(x0: np.array, N: int) -> np.array:
     A = np.array([[0.2]])
     B = np.array([[0.5]])
 
-    X = np.zeros((N, 1))
     U = np.zeros((N, 1))
-    X[0, 0] = x0[0, 0]
-    x = x0
+    U[:N - 1, 0] = np.sin(2 * np.arange(N - 1))
 
-    for i in range(N - 1):
-        u = np.array([[np.sin(2 * i)]])
-        x = A @ x + B @ u
-        X[i + 1, 0] = x[0, 0]
-        U[i, 0] = u[0, 0]
+    X = Simulate_dynamics(A, B, U.T, x0).T
 
     return X, U
 
@@ -96,33 +337,199 @@ def Model_02(x0: np.array, N: int) -> np.array:
     B = np.array([[0],
                   [10 / 3]])
 
-    X = np.zeros((N, 2))
     U = np.zeros((N, 1))
-    X[0, :] = x0[:, 0]
-    x = x0
+    U[:N - 1, 0] = np.sin(2 * np.arange(N - 1))
 
-    for i in range(N - 1):
-        u = np.array([[np.sin(2 * i)]])
-        x = A @ x + B @ u
-        X[i + 1, :] = x[:, 0]
-        U[i, 0] = u[0, 0]
+    X = Simulate_dynamics(A, B, U.T, x0).T
 
     return X, U
 
 
+# dtypes of the DataPoint tuple written by MyLog in main.cpp
+LOG_DTYPES = {
+    "time_us": np.uint64,
+    "pulse_qc": np.int32,
+    "setpoint_current_mA": np.float64,
+    "actual_current_mA": np.int16,
+    "epos_velocity_unfiltered_rpm": np.int32,
+    "calculated_velocity_rad/s": np.float32,
+    "tracked_reference": np.float32,
+    "event_max_error": np.float32,
+    "event_error": np.float32,
+}
+
+# PackedDataPoint of main.cpp: the DataPoint tuple without padding, little-endian
+PACKED_DATAPOINT_DTYPE = np.dtype([(column, np.dtype(dtype).newbyteorder("<")) for column, dtype in LOG_DTYPES.items()])
+
+
+def Read_experiment_log(experiment_log: str, columns=None, cache: bool = True) -> tuple:
+    '''
+    arguments:
+    experiment_log is the path of a MyLog::saveToFile log (with or without its [Configuration] section)
+    columns is the list of table columns to load (all of them if None)
+    cache keeps every loaded column in a <experiment_log>.columns directory of .npy files
+    (binary logs are memory-mapped directly, see Read_binary_log)
+
+    return:
+    (configuration, table)
+    configuration maps the [Configuration] keys to strings, floats or matrices (A, B, K)
+    table maps each requested column to a 1-D array typed like the DataPoint tuple
+
+    Only the requested columns are converted. Cached columns are memory-mapped read-only,
+    so they cost nothing until used; the cache is ignored once the log is newer than it, and
+    skipped when it cannot be written (read-only or full file system).
+    '''
+    configuration, header, table_start, binary = _Read_log_header(experiment_log)
+
+    if columns is None:
+        columns = header
+
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise Exception(f"columns {missing} not in {experiment_log} (available: {header})")
+
+    if binary is not None:
+        _, records = Read_binary_log(experiment_log)
+        return configuration, {column: records[column] for column in columns}
+
+    cache_dir = experiment_log + ".columns"
+    cache_path = lambda column: os.path.join(cache_dir, re.sub(r"[^\w.-]", "_", column) + ".npy")
+    cache_valid = cache and os.path.isdir(cache_dir) and \
+        os.path.getmtime(cache_dir) >= os.path.getmtime(experiment_log)
+
+    table = {}
+    if cache_valid:
+        for column in columns:
+            if os.path.exists(cache_path(column)):
+                table[column] = np.load(cache_path(column), mmap_mode="r")
+
+    to_parse = [column for column in columns if column not in table]
+    if not to_parse:
+        return configuration, {column: table[column] for column in columns}
+
+    dtype = np.dtype([(column, LOG_DTYPES.get(column, np.float64)) for column in to_parse])
+    with open(experiment_log) as log:
+        log.seek(table_start)
+        parsed = np.loadtxt(log, delimiter=",", dtype=dtype, usecols=[header.index(column) for column in to_parse],
+                            ndmin=1)
+
+    if cache:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            if not cache_valid:
+                for stale in os.listdir(cache_dir):
+                    os.remove(os.path.join(cache_dir, stale))
+        except OSError:
+            cache = False
+
+    for column in to_parse:
+        table[column] = np.ascontiguousarray(parsed[column])
+        if cache:
+            try:
+                np.save(cache_path(column), table[column])
+            except OSError:
+                cache = False
+                _Remove_partial(cache_path(column))
+
+    return configuration, {column: table[column] for column in columns}
+
+
+def _Remove_partial(path: str):
+    # a cache file cut short by a failed write would be loaded next time
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def Read_binary_log(experiment_log: str) -> tuple:
+    '''
+    arguments:
+    experiment_log is the path of a log written by MyLog::saveToFile in binary mode (LOG_FORMAT=binary)
+
+    return:
+    (configuration, records)
+    configuration as in Read_experiment_log
+    records is a read-only np.memmap structured array with one packed record per DataPoint,
+    so records[start:stop]["pulse_qc"] only touches the pages of that window
+    '''
+    configuration, header, offset, binary = _Read_log_header(experiment_log)
+
+    if binary is None:
+        raise Exception(f"{experiment_log} is not a binary log!")
+
+    dtype = np.dtype([tuple(column.rsplit(":", 1)) for column in binary["columns"].split(",")])
+
+    if dtype.itemsize != binary["record_size"]:
+        raise Exception(f"records of {experiment_log} have {int(binary['record_size'])} bytes, "
+                        f"its columns describe {dtype.itemsize}!")
+
+    records = np.memmap(experiment_log, dtype=dtype, mode="r", offset=offset, shape=(int(binary["records"]),))
+
+    return configuration, records
+
+
+def _Read_log_header(experiment_log: str) -> tuple:
+    # returns the [Configuration] entries, the column names, the offset of the first table row
+    # or record and, for binary logs, the [Binary] entries (None for text logs)
+    sections = {}
+    section = None
+
+    with open(experiment_log, "rb") as log:
+        line = log.readline().decode()
+
+        while line.strip().startswith("["):
+            section = line.strip()
+            if section in ("[Table]", "[Data]"):
+                break
+
+            sections[section] = {}
+            for line in iter(lambda: log.readline().decode(), ""):
+                if line.strip().startswith("["):
+                    break
+                if "=" in line:
+                    key, value = (item.strip() for item in line.split("=", 1))
+                    sections[section][key] = _Parse_configuration_value(value)
+
+        configuration = sections.get("[Configuration]", {})
+
+        if section == "[Data]":
+            binary = sections["[Binary]"]
+            header = [column.rsplit(":", 1)[0] for column in binary["columns"].split(",")]
+            return configuration, header, log.tell(), binary
+
+        if section == "[Table]":
+            line = log.readline().decode()
+
+        header = [column.strip() for column in line.split(",")]
+
+        return configuration, header, log.tell(), None
+
+
+def _Parse_configuration_value(value: str):
+    if value.startswith("["):
+        rows = re.findall(r"\[([^\[\]]*)\]", value)
+        return np.array([[float(item) for item in row.split(",")] for row in rows])
+
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
 def manopla_model(experiment_log) -> np.array:
-    import pandas as pd
-    df = pd.read_csv(experiment_log)
-    # df.rename(str.strip, axis = 'columns')
-    n_points, n_columns = df.shape
+    _, table = Read_experiment_log(experiment_log, ["time_us", "pulse_qc", "setpoint_current_mA",
+                                                    "actual_current_mA", "epos_velocity_unfiltered_rpm",
+                                                    "calculated_velocity_rad/s"])
+    n_points = table["time_us"].shape[0]
 
 
-    time = np.asarray(df["time_us"]).reshape((1, n_points))
-    pulse = np.asarray(df["pulse_qc"]).reshape((1, n_points))
-    setpoint_current = np.asarray(df["setpoint_current_mA"]).reshape((1, n_points))
-    actual_current = np.asarray(df["actual_current_mA"]).reshape((1, n_points))
-    epos_velocity = np.asarray(df["epos_velocity_unfiltered_rpm"]).reshape((1, n_points))
-    calculated_velocity = np.asarray(df["calculated_velocity_rad/s"]).reshape((1, n_points))
+    time = np.asarray(table["time_us"]).reshape((1, n_points))
+    pulse = np.asarray(table["pulse_qc"]).reshape((1, n_points))
+    setpoint_current = np.asarray(table["setpoint_current_mA"]).reshape((1, n_points))
+    actual_current = np.asarray(table["actual_current_mA"]).reshape((1, n_points))
+    epos_velocity = np.asarray(table["epos_velocity_unfiltered_rpm"]).reshape((1, n_points))
+    calculated_velocity = np.asarray(table["calculated_velocity_rad/s"]).reshape((1, n_points))
 
     outputs = np.concatenate((pulse, calculated_velocity), axis=0)
     output_names = ["pulse [qc]", "calculated velocity [rpm]"]
@@ -133,126 +540,228 @@ def manopla_model(experiment_log) -> np.array:
     return time, outputs, inputs, output_names, input_names
 
 
-def main():
+def Sweep_identification(X: np.array, U: np.array, configurations, validation=None, max_workers: int = None) -> list:
+    '''
+    arguments:
+    X and U are row arrays of states and inputs (as returned by manopla_model)
+    configurations is a list of (start, length, t): identification window and model depth
+    validation is the (start, length) window every model is scored on (the whole log if None)
+    max_workers is the size of the process pool (os.cpu_count() if None)
 
-    time, X, U, output_names, input_names = manopla_model(
-        '/home/grilo/Git/manopla-system-identification-test/cmake-build-debug-arm-docker/KEEPIT-log_2023_09_06-13_17_50-openloop.log')
+    return:
+    list of (error, start, length, t, B, A), best fit first
+    error is the NRMSE of the free-run simulation over the validation window, averaged over
+    the states (inf when the window is not within the log, the identification fails or the
+    simulation diverges)
 
-    x0 = np.array([[0]])
-    start_idx=0
-    N = start_idx+190
-    start_idx = 20
-    N=start_idx+1000
+    X and U are copied once into shared memory, so the workers read the log from there
+    instead of receiving a pickled copy with every configuration.
+    '''
+    if validation is None:
+        validation = (0, X.shape[1])
+    _Check_window(*validation, X.shape[1])
 
-    plt.figure()
-    plt.plot(time[0], X[0], time[0], X[1], time[0], U[0])
-    plt.legend([*output_names, *input_names])
-    #plt.show(block=False)
+    data = np.concatenate((X, U), axis=0).astype(np.float64)
+    memory = shared_memory.SharedMemory(create=True, size=data.nbytes)
 
-    x_0 = X[:, start_idx  :N - 1]
-    x_1 = X[:, start_idx+1:N]
-    u_0 = U[:, start_idx  :N - 1]
+    try:
+        np.ndarray(data.shape, dtype=data.dtype, buffer=memory.buf)[:] = data
+        del data
 
-    B, A = Make_data_driven_dynamics(x_0, x_1, u_0)
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_Sweep_worker_init,
+                                 initargs=(memory.name, X.shape[0], U.shape[0], X.shape[1])) as pool:
+            results = list(pool.map(_Sweep_worker, [(*configuration, *validation)
+                                                    for configuration in configurations]))
+    finally:
+        memory.close()
+        memory.unlink()
 
-    print('A Good: ', A)
-    print('B Good: ', B)
+    return sorted(results, key=lambda result: result[0])
 
-    C = np.eye(2)
-    D = np.array([[0],[0]])
 
-    time_dd,output_dd=control.step_response(control.ss(A, B, C, D, 0.01))
+_sweep_log = None
 
-    x=output_dd[0,0,:]
-    xdot=output_dd[1,0,:]
 
-    plt.figure()
-    plt.plot(time_dd,x, time_dd,xdot)
-    plt.title('datadriven step response')
-    #plt.show(block=False)
+def _Sweep_worker_init(name: str, n: int, m: int, length: int):
+    global _sweep_log
 
-    time_dd = np.arange(0, 40, .01)
-    input_dd = 400*np.sin(time_dd*2*np.pi-np.pi-np.pi/4)
+    memory = shared_memory.SharedMemory(name=name)
+    data = np.ndarray((n + m, length), dtype=np.float64, buffer=memory.buf)
+    _sweep_log = (memory, data[:n], data[n:])
 
-    #time_dd,output_dd=control.forced_response(control.ss(A,B,C,D,0.01), time_dd, X0=[0,0], U=input_dd)
-    time_dd,output_dd_0=control.forced_response(control.ss(A,B,C,D,0.01), time_dd, X0=[0,0], U=U[0][0:len(time_dd)])
 
-    x=output_dd_0[0,:]
-    xdot=output_dd_0[1,:]
+def _Sweep_worker(task: tuple) -> tuple:
+    from datadriven_validation import Normalized_rms_error
 
-    plt.figure()
-    plt.plot(time_dd,x, time_dd,xdot, 'b')
-    plt.plot(time_dd,input_dd, 'r')
-    plt.plot((time[0][0:len(time_dd)]-time[0][0])/1e6, X[0][0:len(time_dd)], '--')
-    plt.legend(['dd pos output', 'dd vel output', 'dd cur input', 'exp pos output'])
-    plt.title('datadriven sin response')
-    #plt.show(block=False)
+    start, length, t, validation_start, validation_length = task
+    _, X, U = _sweep_log
+    n = X.shape[0]
+    stop = start + length
 
-    #mag, phase, omega = control.bode_plot(control.ss(A,B,C,D,0.01))
+    try:
+        _Check_window(start, length, X.shape[1])
+        B, A = Make_data_driven_dynamics(X[:, start:stop - 1], X[:, start + 1:stop], U[:, start:stop - 1], t=t)
+    except Exception:
+        return np.inf, start, length, t, None, None
 
-    #-------------------------------------------------------------------------------------------------------------------
+    X_val = X[:, validation_start:validation_start + validation_length]
+    U_val = U[:, validation_start:validation_start + validation_length]
 
-    x0 = np.array([[0]])
-    N = 190
-    # N=4000
+    x0 = np.zeros(A.shape[0])
+    x0[:n] = X_val[:, 0]
 
-    plt.figure()
-    plt.plot(time[0], X[0], time[0], X[1], time[0], U[0])
-    plt.legend([*output_names, *input_names])
-    #plt.show(block=False)
+    with np.errstate(all="ignore"):
+        simulated = Simulate_dynamics(A, B, U_val, x0)[:n]
+
+        error = np.mean(Normalized_rms_error(simulated, X_val))
+
+    return (error if np.isfinite(error) else np.inf), start, length, t, B, A
 
-    x_0 = X[:, 0:N - 1]
-    x_1 = X[:, 1:N]
-    u_0 = U[:, 0:N - 1]
 
-    B, A = Make_data_driven_dynamics(x_0, x_1, u_0)
+def _Check_window(start: int, length: int, samples: int):
+    # slicing would silently cut a window that runs past the log short
+    if start < 0 or length < 1 or start + length > samples:
+        raise Exception(f"window of {length} samples from {start} is not within the log ({samples} samples)!")
 
-    print('A Good: ', A)
-    print('B Good: ', B)
 
-    C = np.eye(2)
-    D = np.array([[0], [0]])
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "datadriven_modeling")
 
-    time_dd, output_dd = control.step_response(control.ss(A, B, C, D, 0.01))
 
-    x = output_dd[0, 0, :]
-    xdot = output_dd[1, 0, :]
+def Identify_experiment(experiment_log: str, start: int, length: int, t: int = 1,
+                        cache_dir: str = DEFAULT_CACHE_DIR) -> tuple:
+    '''
+    arguments:
+    experiment_log is the path of a MyLog log (text or binary)
+    start and length select the identification window (length samples from start, within
+    the log)
+    t is the model depth, as in Make_data_driven_dynamics
+    cache_dir keeps the identified models (None disables the cache)
+
+    return:
+    (B, A) identified on the window
+
+    Models are memoized on disk by (SHA-256 of the log, start, length, t), so a report over
+    logs that were already identified only reads the hash and a small .npz.
+    '''
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, f"{_Log_digest(experiment_log)}_{start}_{length}_{t}.npz")
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as model:
+                return model["B"], model["A"]
+
+    _, X, U, _, _ = manopla_model(experiment_log)
+    _Check_window(start, length, X.shape[1])
+    stop = start + length
+
+    B, A = Make_data_driven_dynamics(X[:, start:stop - 1], X[:, start + 1:stop], U[:, start:stop - 1], t=t)
+
+    if cache_dir is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(cache_path, B=B, A=A)
+        except OSError:
+            _Remove_partial(cache_path)
+
+    return B, A
+
+
+def _Log_digest(experiment_log: str) -> str:
+    stat = os.stat(experiment_log)
+    return _File_digest(os.path.abspath(experiment_log), stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=None)
+def _File_digest(path: str, size: int, mtime_ns: int) -> str:
+    # size and mtime only key the in-process memo, the digest is of the content
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def _Plot_identification(time: np.array, X: np.array, U: np.array, output_names, input_names, models):
+    import matplotlib.pyplot as plt
 
     plt.figure()
-    plt.plot(time_dd, x, time_dd, xdot)
-    plt.title('datadriven step response')
-    #plt.show(block=False)
+    plt.plot(time[0], X[0], time[0], X[1], time[0], U[0])
+    plt.legend([*output_names, *input_names])
 
     time_dd = np.arange(0, 40, .01)
-    input_dd = 400 * np.sin(time_dd * 2 * np.pi - np.pi - np.pi / 4)
+    input_dd = 400*np.sin(time_dd*2*np.pi-np.pi-np.pi/4)
+    responses = []
 
-    # time_dd,output_dd=control.forced_response(control.ss(A,B,C,D,0.01), time_dd, X0=[0,0], U=input_dd)
-    time_dd, output_dd_1 = control.forced_response(control.ss(A, B, C, D, 0.01), time_dd, X0=[0, 0],
-                                                   U=U[0][0:len(time_dd)])
+    for name, B, A in models:
+        n = X.shape[0]
 
-    x = output_dd_1[0, :]
-    xdot = output_dd_1[1, :]
+        output_dd = Simulate_dynamics(A, B, np.ones((1, 400)))
+        plt.figure()
+        plt.plot(time_dd[:400], output_dd[0], time_dd[:400], output_dd[1])
+        plt.title(f'datadriven step response ({name})')
 
-    plt.figure()
-    plt.plot(time_dd, x, time_dd, xdot, 'b')
-    plt.plot(time_dd, input_dd, 'r')
-    plt.plot((time[0][0:len(time_dd)] - time[0][0]) / 1e6, X[0][0:len(time_dd)], '--')
-    plt.legend(['dd pos output', 'dd vel output', 'dd cur input', 'exp pos output'])
-    plt.title('datadriven sin response')
-    #plt.show(block=False)
+        output_dd = Simulate_dynamics(A, B, U[:, 0:len(time_dd)])[:n]
+        responses.append(output_dd)
 
-    # mag, phase, omega = control.bode_plot(control.ss(A,B,C,D,0.01))
+        plt.figure()
+        plt.plot(time_dd[:output_dd.shape[1]], output_dd[0], time_dd[:output_dd.shape[1]], output_dd[1], 'b')
+        plt.plot(time_dd, input_dd, 'r')
+        plt.plot((time[0][0:len(time_dd)]-time[0][0])/1e6, X[0][0:len(time_dd)], '--')
+        plt.legend(['dd pos output', 'dd vel output', 'dd cur input', 'exp pos output'])
+        plt.title(f'datadriven sin response ({name})')
 
     plt.figure()
-    plt.plot(time_dd[0:len(time_dd)],output_dd_0[0,:len(time_dd)],'*')
-    plt.plot(time_dd[0:len(time_dd)],output_dd_1[0,:len(time_dd)],'*')
+    for output_dd in responses:
+        plt.plot(time_dd[:output_dd.shape[1]], output_dd[0], '*')
     plt.plot((time[0][0:len(time_dd)] - time[0][0]) / 1e6, X[0][0:len(time_dd)], '*')
-    plt.legend(['output N=4000', 'output N=190'])
-    plt.show()
+    plt.legend([f'output {name}' for name, _, _ in models] + ['exp pos output'])
 
-    #error_0 = np.trapz(np.square(output_dd_0[0,:len(time_dd)] - X[0][0:len(time_dd)]),
+    plt.show()
 
 
+def main(argv=None):
+    from datadriven_validation import Validate_dynamics
+
+    parser = argparse.ArgumentParser(description="data driven identification of MyLog experiments")
+    parser.add_argument("experiment_log", help="log written by MyLog::saveToFile (text or binary)")
+    parser.add_argument("--window", nargs=2, type=int, action="append", metavar=("START", "LENGTH"),
+                        help="identification window, may be repeated (default: 20 1000 and 0 190)")
+    parser.add_argument("--order", nargs="+", type=int, default=[1], metavar="T",
+                        help="model depths to identify on every window (default: 1)")
+    parser.add_argument("--validation", nargs=2, type=int, metavar=("START", "LENGTH"),
+                        help="window the models are scored on (default: 0 4000, the first 40 s, "
+                             "or the whole log if shorter)")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="where identified models are memoized")
+    parser.add_argument("--no-cache", action="store_true", help="always identify from scratch")
+    parser.add_argument("--plot", action="store_true", help="plot responses (imports matplotlib)")
+    args = parser.parse_args(argv)
+
+    windows = args.window or [(20, 1000), (0, 190)]
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    time, X, U, output_names, input_names = manopla_model(args.experiment_log)
+
+    validation_start, validation_length = args.validation or (0, min(4000, X.shape[1]))
+    _Check_window(validation_start, validation_length, X.shape[1])
+    X_val = X[:, validation_start:validation_start + validation_length]
+    U_val = U[:, validation_start:validation_start + validation_length]
+
+    models = []
+    for start, length in windows:
+        for t in args.order:
+            B, A = Identify_experiment(args.experiment_log, start, length, t, cache_dir)
+            metrics = Validate_dynamics(A, B, X_val, U_val)
+
+            print(f'window {start}+{length}, t={t}')
+            print('A Good: ', A)
+            print('B Good: ', B)
+            print(f'NRMSE {metrics["nrmse"]}, VAF {metrics["vaf"]} %, ISE {metrics["ise"]}')
+
+            models.append((f'{start}+{length} t={t}', B, A))
+
+    if args.plot:
+        _Plot_identification(time, X, U, output_names, input_names, models)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,208 @@
+import argparse
+import threading
+import time
+
+import numpy as np
+import zmq
+
+from datadriven_modeling import PACKED_DATAPOINT_DTYPE, RecursiveDynamics, Read_experiment_log, Simulate_dynamics
+from datadriven_validation import Normalized_rms_error
+
+# same states and input as manopla_model
+OUTPUT_COLUMNS = ["pulse_qc", "calculated_velocity_rad/s"]
+INPUT_COLUMNS = ["setpoint_current_mA"]
+
+
+class StreamingIdentifier:
+    '''
+    identifies (A, B) from DataPoint records published over ZeroMQ
+
+    arguments:
+    endpoint is the PUB socket carrying the telemetry; each message holds one or more
+    PackedDataPoint records (PACKED_DATAPOINT_DTYPE)
+    publish_endpoint is where the models are republished (not published if None)
+    t and forgetting configure the RecursiveDynamics fed with every sample
+    window is the number of recent samples kept in the ring buffer
+    publish_every is the number of samples between two published models
+    context is the zmq.Context to use (inproc:// endpoints need the publisher's one)
+    on_model is called with every new model
+
+    Every published model is a JSON message
+    {"samples": ..., "time_us": ..., "A": [[...]], "B": [[...]], "nrmse": [...]}
+    where nrmse is the free-run fit over the ring buffer.
+    '''
+    def __init__(self, endpoint: str, publish_endpoint: str = None, t: int = 1, forgetting: float = 0.999,
+                 window: int = 1000, publish_every: int = 100, context: zmq.Context = None, on_model=None):
+        self.__context = context or zmq.Context.instance()
+
+        self.__subscriber = self.__context.socket(zmq.SUB)
+        self.__subscriber.setsockopt(zmq.SUBSCRIBE, b"")
+        self.__subscriber.connect(endpoint)
+
+        self.__publisher = None
+        if publish_endpoint is not None:
+            self.__publisher = self.__context.socket(zmq.PUB)
+            self.__publisher.bind(publish_endpoint)
+
+        self.identifier = RecursiveDynamics(len(OUTPUT_COLUMNS), len(INPUT_COLUMNS), t, forgetting)
+        self.publish_every = publish_every
+
+        self.__buffer = np.zeros(window, dtype=PACKED_DATAPOINT_DTYPE)
+        self.__head = 0
+        self.__received = 0
+
+        self.on_model = on_model
+        self.model = None
+
+    def recent(self) -> np.array:
+        '''
+        return:
+        the samples of the ring buffer, oldest first
+        '''
+        if self.__received < self.__buffer.shape[0]:
+            return self.__buffer[:self.__received]
+
+        return np.roll(self.__buffer, -self.__head)
+
+    def feed(self, records: np.array):
+        '''
+        records is an array of PACKED_DATAPOINT_DTYPE samples, in order
+        '''
+        X = np.stack([records[column].astype(np.float64) for column in OUTPUT_COLUMNS])
+        U = np.stack([records[column].astype(np.float64) for column in INPUT_COLUMNS])
+
+        for k in range(records.shape[0]):
+            self.identifier.update(X[:, k], U[:, k])
+
+            self.__buffer[self.__head] = records[k]
+            self.__head = (self.__head + 1) % self.__buffer.shape[0]
+            self.__received += 1
+
+            if self.__received % self.publish_every == 0 and self.identifier.is_ready():
+                self.__publish(records[k]["time_us"])
+
+    def __publish(self, time_us: int):
+        B, A = self.identifier.dynamics()
+
+        recent = self.recent()
+        X = np.stack([recent[column].astype(np.float64) for column in OUTPUT_COLUMNS])
+        U = np.stack([recent[column].astype(np.float64) for column in INPUT_COLUMNS])
+
+        x0 = np.zeros(A.shape[0])
+        x0[:X.shape[0]] = X[:, 0]
+
+        with np.errstate(all="ignore"):
+            nrmse = Normalized_rms_error(Simulate_dynamics(A, B, U, x0)[:X.shape[0]], X)
+
+        model = {
+            "samples": self.__received,
+            "time_us": int(time_us),
+            "A": A.tolist(),
+            "B": B.tolist(),
+            "nrmse": [float(error) if np.isfinite(error) else None for error in nrmse],
+        }
+        self.model = model
+
+        if self.on_model is not None:
+            self.on_model(model)
+
+        if self.__publisher is not None:
+            self.__publisher.send_json(model)
+
+    def run(self, stop: threading.Event = None, max_samples: int = None, timeout_ms: int = 100):
+        '''
+        receives records until stop is set or max_samples samples were fed
+        '''
+        poller = zmq.Poller()
+        poller.register(self.__subscriber, zmq.POLLIN)
+
+        while not (stop is not None and stop.is_set()) and \
+                not (max_samples is not None and self.__received >= max_samples):
+            if not poller.poll(timeout_ms):
+                continue
+
+            self.feed(np.frombuffer(self.__subscriber.recv(), dtype=PACKED_DATAPOINT_DTYPE))
+
+    def close(self):
+        self.__subscriber.close()
+        if self.__publisher is not None:
+            self.__publisher.close()
+
+
+def Replay_experiment_log(experiment_log: str, endpoint: str, speedup: float = 10.0, batch: int = 1,
+                          context: zmq.Context = None, warmup: float = 0.2, stop: threading.Event = None):
+    '''
+    arguments:
+    experiment_log is the path of a MyLog log (text or binary)
+    endpoint is where the records are published (bound here)
+    speedup divides the recorded time_us intervals (None sends as fast as possible)
+    batch is the number of records per message
+    context is the zmq.Context to use (share it with the subscriber for inproc:// endpoints)
+    warmup is waited after binding so that subscribers can connect first
+    stop interrupts the replay when set
+
+    publishes the log as PackedDataPoint records, paced by its own time_us column
+    '''
+    _, table = Read_experiment_log(experiment_log, [column for column in PACKED_DATAPOINT_DTYPE.names
+                                                    if column in ("time_us", *OUTPUT_COLUMNS, *INPUT_COLUMNS)])
+    records = np.zeros(table["time_us"].shape[0], dtype=PACKED_DATAPOINT_DTYPE)
+    for column, values in table.items():
+        records[column] = values
+
+    publisher = (context or zmq.Context.instance()).socket(zmq.PUB)
+    publisher.bind(endpoint)
+
+    try:
+        time.sleep(warmup)
+        start = time.perf_counter()
+        first_us = int(records["time_us"][0]) if records.shape[0] else 0
+
+        for k in range(0, records.shape[0], batch):
+            if stop is not None and stop.is_set():
+                break
+
+            if speedup is not None:
+                delay = (int(records["time_us"][k]) - first_us) / 1e6 / speedup - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            publisher.send(records[k:k + batch].tobytes())
+    finally:
+        publisher.close(linger=1000)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="identify (A, B) from a live DataPoint telemetry feed")
+    parser.add_argument("endpoint", help="ZeroMQ PUB endpoint of the telemetry, e.g. tcp://192.168.7.2:5555")
+    parser.add_argument("--publish", default=None, help="endpoint where models are republished")
+    parser.add_argument("--order", type=int, default=1, metavar="T", help="model depth (default: 1)")
+    parser.add_argument("--forgetting", type=float, default=0.999, help="forgetting factor (default: 0.999)")
+    parser.add_argument("--window", type=int, default=1000, help="samples kept to score models (default: 1000)")
+    parser.add_argument("--publish-every", type=int, default=100, help="samples between models (default: 100)")
+    parser.add_argument("--replay", default=None, metavar="LOG",
+                        help="replay a recorded log on the endpoint instead of listening to a controller")
+    parser.add_argument("--speedup", type=float, default=10.0, help="replay speed factor (default: 10)")
+    args = parser.parse_args(argv)
+
+    stop = threading.Event()
+    identifier = StreamingIdentifier(args.endpoint, args.publish, args.order, args.forgetting, args.window,
+                                     args.publish_every, on_model=print)
+
+    if args.replay is not None:
+        def replay():
+            Replay_experiment_log(args.replay, args.endpoint, args.speedup)
+            time.sleep(0.5)
+            stop.set()
+
+        threading.Thread(target=replay, daemon=True).start()
+
+    try:
+        identifier.run(stop=stop)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        identifier.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import numpy as np
+
+from datadriven_modeling import Simulate_dynamics
+
+
+def Normalized_rms_error(simulated: np.array, measured: np.array) -> np.array:
+    '''
+    arguments:
+    simulated and measured are (...)x(n)x(T) row arrays of outputs (the leading dimensions broadcast)
+
+    return:
+    (...)x(n) array of ||measured - simulated|| / ||measured - mean(measured)|| over time
+    (0 is a perfect fit, 1 is as good as the mean of the measurement)
+    '''
+    residual = np.sqrt(np.sum(np.square(measured - simulated), axis=-1))
+    spread = np.sqrt(np.sum(np.square(measured - np.mean(measured, axis=-1, keepdims=True)), axis=-1))
+
+    return residual / spread
+
+
+def Variance_accounted_for(simulated: np.array, measured: np.array) -> np.array:
+    '''
+    arguments:
+    simulated and measured are (...)x(n)x(T) row arrays of outputs
+
+    return:
+    (...)x(n) array of 100 * (1 - var(measured - simulated) / var(measured)), in percent
+    '''
+    return 100 * (1 - np.var(measured - simulated, axis=-1) / np.var(measured, axis=-1))
+
+
+def Integrated_squared_error(simulated: np.array, measured: np.array, dt: float = 0.01) -> np.array:
+    '''
+    arguments:
+    simulated and measured are (...)x(n)x(T) row arrays of outputs
+    dt is the sampling period
+
+    return:
+    (...)x(n) array of the trapezoidal integral of (measured - simulated)^2 over time
+    '''
+    squared = np.square(measured - simulated)
+
+    return dt * (np.sum(squared, axis=-1) - (squared[..., 0] + squared[..., -1]) / 2)
+
+
+def Prediction_error(A: np.array, B: np.array, X: np.array, U: np.array, k: int = 1) -> np.array:
+    '''
+    arguments:
+    A and B are a model or stacks (...)x(n)x(n) and (...)x(n)x(m) of models
+    X and U are (n)x(T) and (m)x(T) row arrays of measured states and inputs
+    k is the prediction horizon, a natural number >= 1
+
+    return:
+    (...)x(n) array of the RMS error of predicting x(j+k) from the measured x(j) and u(j) ... u(j+k-1),
+    over every j of the log at once
+    '''
+    T = X.shape[-1]
+
+    predicted = X[..., :T - k]
+
+    for i in range(k):
+        predicted = A @ predicted + B @ U[..., i:T - k + i]
+
+    return np.sqrt(np.mean(np.square(X[..., k:] - predicted), axis=-1))
+
+
+def Validate_dynamics(A: np.array, B: np.array, X: np.array, U: np.array, x0: np.array = None, k: int = 1,
+                      dt: float = 0.01) -> dict:
+    '''
+    arguments:
+    A and B are a model or stacks (...)x(n*t)x(n*t) and (...)x(n*t)x(m) of models
+    (the first n states are compared with X, as in Make_data_driven_dynamics)
+    X and U are (n)x(T) and (m)x(T) row arrays of measured states and inputs
+    x0 is the initial state of the free-run simulation (X[:, 0] padded with zeros if None)
+    k is the prediction horizon of the k-step-ahead error (only for one-step models, t = 1)
+    dt is the sampling period
+
+    return:
+    dict of (...)x(n) arrays: "nrmse", "vaf" and "ise" of the free-run simulation and, when the
+    model state is X itself, "prediction" (the k-step-ahead RMS error)
+    '''
+    n = X.shape[0]
+
+    if x0 is None:
+        x0 = np.zeros(A.shape[-1])
+        x0[:n] = X[:, 0]
+
+    with np.errstate(all="ignore"):
+        simulated = Simulate_dynamics(A, B, U, x0)[..., :n, :]
+
+        metrics = {
+            "nrmse": Normalized_rms_error(simulated, X),
+            "vaf": Variance_accounted_for(simulated, X),
+            "ise": Integrated_squared_error(simulated, X, dt),
+        }
+
+        if A.shape[-1] == n:
+            metrics["prediction"] = Prediction_error(A, B, X, U, k)
+
+    return metrics
@@ -170,6 +170,28 @@ using DataPoint = std::tuple<uint64_t /*time_us*/,
                              float /*event_max_error*/,
                              float /*event_error*/>;
 
+/*
+ * DataPoint as written by MyLog in binary mode: the tuple fields in order, without padding.
+ * The "columns" entry of the [Binary] section describes it as numpy dtype strings.
+*/
+#pragma pack(push, 1)
+struct PackedDataPoint {
+    uint64_t time_us;
+    int32_t pulse_qc;
+    double setpoint_current_mA;
+    int16_t actual_current_mA;
+    int32_t epos_velocity_unfiltered_rpm;
+    float calculated_velocity_rad_s;
+    float tracked_reference;
+    float event_max_error;
+    float event_error;
+};
+#pragma pack(pop)
+
+static_assert(sizeof(PackedDataPoint) == 42, "PackedDataPoint must not be padded");
+
+const std::vector<std::string> PackedDataPointTypes{"u8", "i4", "f8", "i2", "i4", "f4", "f4", "f4", "f4"};
+
 class MyLog {
     std::vector<DataPoint> log;
     std::vector<std::string> logHeader;
@@ -190,7 +212,8 @@ public:
                     double a,
                     double b,
                     double sigma,
-                    float refresh_rate){
+                    float refresh_rate,
+                    bool binary = false){
 
         using std::setw;
         using std::setfill;
@@ -206,7 +229,7 @@ public:
            << "-" << setfill('0') << setw(2) << localtime->tm_sec
            << "_" << fileName;
 
-        std::ofstream file{ssFileName.str()};
+        std::ofstream file{ssFileName.str(), binary ? std::ios::out | std::ios::binary : std::ios::out};
 
         file.precision(10);
 
@@ -223,8 +246,14 @@ public:
                 << "event_sigma = " << std::scientific << sigma << "\n"
 
                 << "refresh_rate = " << std::scientific << refresh_rate << "\n"
-                << "\n"
-                << "[Table]\n";
+                << "\n";
+
+        if (binary) {
+            saveRecords(file);
+            return;
+        }
+
+        file << "[Table]\n";
 
         std::for_each(logHeader.cbegin(), logHeader.cend()-1, [&](const auto &item) {
             file << item << ',';
@@ -246,6 +275,43 @@ public:
                  << setw(20) << std::get<8>(dp) << '\n';
         }
     }
+
+private:
+    /*
+     * [Binary] section followed by the PackedDataPoint records, in host byte order:
+     *   record_size = 42
+     *   records = <number of records>
+     *   columns = time_us:<u8,pulse_qc:<i4,...
+     *   [Data]
+     *   <records>
+    */
+    void saveRecords(std::ofstream& file) const {
+        const uint16_t probe{1};
+        const char byteOrder = *reinterpret_cast<const char*>(&probe) == 1 ? '<' : '>';
+
+        file << "[Binary]\n"
+             << "record_size = " << sizeof(PackedDataPoint) << "\n"
+             << "records = " << log.size() << "\n"
+             << "columns = ";
+
+        for (std::size_t i = 0; i < logHeader.size(); ++i) {
+            file << (i ? "," : "") << logHeader[i] << ':' << byteOrder << PackedDataPointTypes[i];
+        }
+
+        file << "\n[Data]\n";
+
+        std::vector<PackedDataPoint> records;
+        records.reserve(log.size());
+
+        for(const auto& dp : log) {
+            records.push_back(PackedDataPoint{std::get<0>(dp), std::get<1>(dp), std::get<2>(dp),
+                                              std::get<3>(dp), std::get<4>(dp), std::get<5>(dp),
+                                              std::get<6>(dp), std::get<7>(dp), std::get<8>(dp)});
+        }
+
+        file.write(reinterpret_cast<const char*>(records.data()),
+                   static_cast<std::streamsize>(records.size() * sizeof(PackedDataPoint)));
+    }
 };
 
 int main(int argc, char* argv[]) {
@@ -300,6 +366,9 @@ int main(int argc, char* argv[]) {
                      "         EVNET_A_B_SIGMA=10 0.2 0.01\n"
                      "      (menor update_rate)\n"
                      "         EVNET_A_B_SIGMA=16 0.001 0.01\n"
+                     "    LOG_FORMAT: text (default) or binary\n"
+                     "      binary writes the DataPoints as packed records after the [Configuration] header\n"
+                     "      (read them with datadriven_modeling.Read_binary_log)\n"
                      "\n";
 
     if (argc >= 3) {
@@ -854,7 +923,10 @@ int main(int argc, char* argv[]) {
            << "b" << std::scientific << event_b << "_"
            << "s" << std::scientific << event_sigma;
     }*/
-    ss << synccallback << "_" << controllerArgParameter << ".csv";
+    const char* env_log_format = std::getenv("LOG_FORMAT");
+    bool binaryLog = env_log_format != nullptr && std::string{env_log_format} == "binary";
+
+    ss << synccallback << "_" << controllerArgParameter << (binaryLog ? ".bin" : ".csv");
 
     manopla.start_loop();
 
@@ -866,7 +938,7 @@ int main(int argc, char* argv[]) {
     }
     std::cout << "\n\n" << "REFRESH RATE: " << refresh_rate << " (" << refresh_count << " / " << time_count << ")\n\n";
 
-    log.saveToFile(ss.str(), synccallback, referenceType, sys_matrix_A, sys_matrix_B, sys_dlqr_K, event_a, event_b, event_sigma, refresh_rate);
+    log.saveToFile(ss.str(), synccallback, referenceType, sys_matrix_A, sys_matrix_B, sys_dlqr_K, event_a, event_b, event_sigma, refresh_rate, binaryLog);
 
     return 0;
 }
@@ -10,8 +10,10 @@
 #include <unistd.h>
 #include "../include/control_msg.h"
 #include "../include/label_message.h"
+#include "../include/datapoint_batch.h"
 #include <thread>
 #include <mutex>
+#include <set>
 
 // Define the server IP and port
 // 192.168.2.33 
@@ -51,6 +53,14 @@ class Client {
         void sendingMsg(const uint8_t* buffer, 
                         const std::string& type_message, 
                         const int content_size);
+
+    // telemetry - one DataPointBatch message with every record
+        void sendingDataPoints(const PackedDataPoint* records, size_t count);
+
+    // topics - a pattern ending with '*' matches every topic starting with the prefix
+        void subscribe(const std::string& pattern);
+        void unsubscribe(const std::string& pattern = "");  // empty: every subscription
+        void publish(const std::string& topic = "");  // empty: back to the peer
         
     // header functions
         std::array<uint8_t, HEADER_SIZE> packHeader(const int msg_size, const std::string& type_message) const;
@@ -67,6 +77,11 @@ class Client {
 
         char* get_client_peer(){return (char*)_client.client_peer.c_str();}
 
+        std::set<std::string> get_subscriptions(){
+            std::lock_guard<std::mutex> lock(_mutex);
+            return _client.subscriptions;
+        }
+
         void checkOperation(int result, std::string errorMsg);
 
         void handleControlMsg(const std::array<uint8_t, CONTROL_MSG_BUFFER>& control_msg);
@@ -88,6 +103,8 @@ class Client {
         struct client_pattern{
             std::string client_id;
             std::string client_peer;
+            std::string topic;  // published topic, set by publish()
+            std::set<std::string> subscriptions;  // patterns confirmed by the server
             bool is_alive = false;
 
         };
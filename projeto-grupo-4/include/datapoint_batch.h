@@ -0,0 +1,45 @@
+#ifndef DATAPOINT_BATCH_H
+#define DATAPOINT_BATCH_H
+
+#include <cstdint>
+#include <cstring>
+#include <vector>
+
+// Size of one record in bytes
+#define DATAPOINT_SIZE 42
+
+// DataPoint tuple of the manipulator controller (PackedDataPoint in main.cpp).
+// A DataPointBatch message is a sequence of these records, without padding and
+// little-endian (the byte order of the BeagleBone and of x86)
+#pragma pack(push, 1)
+struct PackedDataPoint {
+    uint64_t time_us;
+    int32_t pulse_qc;
+    double setpoint_current_mA;
+    int16_t actual_current_mA;
+    int32_t epos_velocity_unfiltered_rpm;
+    float calculated_velocity_rad_s;
+    float tracked_reference;
+    float event_max_error;
+    float event_error;
+};
+#pragma pack(pop)
+
+static_assert(sizeof(PackedDataPoint) == DATAPOINT_SIZE, "PackedDataPoint must not be padded");
+
+class DataPointBatch {
+    public:
+        static std::vector<uint8_t> pack_msg(const PackedDataPoint* records, size_t count) {
+            std::vector<uint8_t> buffer(count * DATAPOINT_SIZE);
+            std::memcpy(buffer.data(), records, buffer.size());
+            return buffer;
+        }
+
+        static std::vector<PackedDataPoint> unpack_msg(const uint8_t* data, size_t size) {
+            std::vector<PackedDataPoint> records(size / DATAPOINT_SIZE);
+            std::memcpy(records.data(), data, records.size() * DATAPOINT_SIZE);
+            return records;
+        }
+};
+
+#endif // DATAPOINT_BATCH_H
@@ -0,0 +1,826 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+from framing import FrameReader
+from simple_msg import CONTROL_MSG, LABEL_STRING, ControlMsg, LabelString
+from transport import TCP, TRANSPORTS, address, connect, create_socket
+
+HEADER = 24
+HEADER_FORMAT = "!I20s"
+FORMAT = "utf-8"
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def pack_frame(msg, type_message):
+    header = struct.pack(HEADER_FORMAT, len(msg), type_message.encode(FORMAT))
+    return header + b" " * (HEADER - len(header)) + msg
+
+
+def recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Server closed the connection")
+        data += chunk
+    return data
+
+
+def recv_frame(sock):
+    length_message, type_message = struct.unpack(HEADER_FORMAT, recv_exact(sock, HEADER))
+    return type_message.decode(FORMAT).rstrip("\x00"), recv_exact(sock, length_message)
+
+
+def wait_control(sock, command):
+    # Skips frames until the control message `command` arrives, returns its first argument
+    while True:
+        type_message, body = recv_frame(sock)
+        if type_message == "ControlMsg":
+            received, arg1, _ = ControlMsg().unpack_msg(body)
+            if received == command:
+                return arg1
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def start_server(port, mode, msg_per_second=100, transport=TCP, **options):
+    arguments = "".join(f", {name}={value!r}" for name, value in options.items())
+    code = (
+        "import time\n"
+        "from simple_server import Server\n"
+        f"Server(port={port}, mode={mode!r}, msg_per_second={msg_per_second}, transport={transport!r}"
+        f"{arguments})\n"
+        "time.sleep(1e9)\n"
+    )
+    server = subprocess.Popen([sys.executable, "-c", code], cwd=SCRIPTS_DIR)
+
+    # Wait until the server accepts connections
+    for _ in range(100):
+        try:
+            probe = create_socket(transport)
+            probe.settimeout(0.1)
+            probe.connect(address(transport, "127.0.0.1", port))
+            probe.close()
+            time.sleep(0.2)  # Let the server drop the probe connection first
+            return server
+        except OSError:
+            probe.close()
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError(f"Server did not start on port {port}")
+
+
+def cpu_seconds(pid):
+    # utime + stime of a process, from /proc (Linux)
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def memory_kb(pid):
+    # Resident set size and its peak of a process [kB], from /proc (Linux)
+    sizes = {}
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "VmHWM"):
+                sizes[name] = int(value.split()[0])
+    return sizes.get("VmRSS"), sizes.get("VmHWM")
+
+
+class Drain:
+    # Reads and discards everything sent to idle connections, so the server never blocks on them
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.alive = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def add(self, sock):
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ)
+
+    def loop(self):
+        while self.alive:
+            if not self.selector.get_map():
+                time.sleep(0.01)
+                continue
+            for key, _ in self.selector.select(timeout=0.1):
+                try:
+                    if not key.fileobj.recv(65536):
+                        self.selector.unregister(key.fileobj)
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    self.selector.unregister(key.fileobj)
+
+    def close(self):
+        self.alive = False
+        self.thread.join()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+
+
+class Receivers:
+    # Reads every receiver connection and records when each of them got message number k
+    def __init__(self, sockets):
+        self.selector = selectors.DefaultSelector()
+        self.received = {}  # k -> receive times [ns]
+        self.condition = threading.Condition()
+        self.alive = True
+
+        for sock in sockets:
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, FrameReader())
+
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        while self.alive:
+            for key, _ in self.selector.select(timeout=0.1):
+                try:
+                    if not key.data.recv_from(key.fileobj):
+                        self.selector.unregister(key.fileobj)
+                        continue
+                except BlockingIOError:
+                    continue
+                now = time.perf_counter_ns()
+
+                for type_message, _, body in key.data.frames():
+                    if type_message != "LabelString":
+                        continue
+                    k = int(LabelString().unpack_msg(body)[1])
+                    with self.condition:
+                        self.received.setdefault(k, []).append(now)
+                        self.condition.notify_all()
+
+    def wait(self, k, count, timeout):
+        # True when `count` receivers got message k within the timeout
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.received.get(k, ())) >= count, timeout)
+
+    def close(self):
+        self.alive = False
+        self.thread.join()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+
+
+class LoadRecorder:
+    # Reads every client connection and records the end-to-end latency of each LabelString,
+    # whose string carries the perf_counter_ns it was sent at
+    def __init__(self, sockets):
+        self.selector = selectors.DefaultSelector()
+        self.latencies = []  # [ns]
+        self.bytes = 0
+        self.last = None  # perf_counter_ns of the last delivery
+        self.alive = True
+
+        # The sockets stay blocking for the senders: they are only read when ready
+        for sock in sockets:
+            self.selector.register(sock, selectors.EVENT_READ, FrameReader())
+
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        while self.alive:
+            for key, _ in self.selector.select(timeout=0.1):
+                try:
+                    if not key.data.recv_from(key.fileobj):
+                        self.selector.unregister(key.fileobj)
+                        continue
+                except OSError:
+                    self.selector.unregister(key.fileobj)
+                    continue
+                now = time.perf_counter_ns()
+
+                for type_message, frame, body in key.data.frames():
+                    if type_message != "LabelString":
+                        continue
+                    self.latencies.append(now - int(LABEL_STRING.unpack(body)[1]))
+                    self.bytes += len(frame)
+                    self.last = now
+
+    def drain(self, quiet=0.5, timeout=5.0):
+        # Waits until nothing was delivered for `quiet` seconds
+        deadline = time.perf_counter() + timeout
+        count = -1
+        while count != len(self.latencies) and time.perf_counter() < deadline:
+            count = len(self.latencies)
+            time.sleep(quiet)
+
+    def close(self):
+        self.alive = False
+        self.thread.join()
+
+
+def load_sender(sock, label, rate, batch, stop, sent):
+    # Sends `batch` LabelString frames at a time, `rate` frames/s (0 is as fast as the socket
+    # takes them), until stop is set. sent[label] is the number of frames sent
+    interval = batch / rate if rate else 0
+    next_send = time.perf_counter()
+    count = 0
+
+    while not stop.is_set():
+        if interval:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_send += interval
+
+        frame = LABEL_STRING.frame(label, str(time.perf_counter_ns()))
+        try:
+            sock.sendall(frame * batch)
+        except OSError:
+            break
+        count += batch
+
+    sent[label] = count
+
+
+def load_worker(port, names, peers, rate, batch, ready, stop, results):
+    # One process of the load generator: connects its clients under the given names (and
+    # peers), sends until stop is set, then puts what it sent and received in `results`
+    sockets = []
+    for name, peer in zip(names, peers):
+        sock = socket.create_connection(("127.0.0.1", port))
+        wait_control(sock, "/change_id")
+        sock.sendall(CONTROL_MSG.frame("/change_id", name))
+        if wait_control(sock, "/change_id") != name:
+            raise RuntimeError(f"Client id {name} already in use")
+        if peer is not None:
+            sock.sendall(CONTROL_MSG.frame("/change_peer", peer))
+        sockets.append(sock)
+
+    recorder = LoadRecorder(sockets)
+    sent = {}
+    senders = [
+        threading.Thread(target=load_sender, args=(sock, name, rate, batch, stop, sent), daemon=True)
+        for sock, name in zip(sockets, names)
+    ]
+
+    ready.wait()
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+
+    recorder.drain()
+    recorder.close()
+    results.put({
+        "sent": sum(sent.values()),
+        "latencies": recorder.latencies,
+        "bytes": recorder.bytes,
+        "last": recorder.last,
+    })
+
+    for sock in sockets:
+        sock.close()
+
+
+def benchmark_load(mode, clients, port, routing="broadcast", seconds=5.0, rate=100, batch=1, workers=None,
+                   **options):
+    '''
+    Drives the server with `clients` synthetic clients that all send LabelString messages for
+    `seconds` (`rate` messages/s each, 0 as fast as possible) and receive the others'. With
+    routing "broadcast" every message goes to the other clients, with "peer" each client
+    sends to the next one. The clients are spread over `workers` processes (one per CPU by
+    default), so the load generator is not limited to one core.
+
+    Reports the sent and delivered messages/s, the delivered bytes/s, the end-to-end latency
+    percentiles, and the server CPU use and memory.
+    '''
+    if routing == "peer" and clients < 2:
+        raise ValueError("Peer routing needs at least 2 clients")
+
+    workers = max(1, min(clients, workers or os.cpu_count() or 1))
+    names = [f"load_{k}" for k in range(clients)]
+    peers = [names[(k + 1) % clients] if routing == "peer" else None for k in range(clients)]
+
+    server = start_server(port, mode, **options)
+    ready = multiprocessing.Barrier(workers + 1)
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=load_worker,
+            args=(port, names[k::workers], peers[k::workers], rate, batch, ready, stop, results),
+            daemon=True,
+        )
+        for k in range(workers)
+    ]
+
+    try:
+        for process in processes:
+            process.start()
+        ready.wait(timeout=60)  # Every client connected, the senders start
+        cpu_start, start = cpu_seconds(server.pid), time.perf_counter_ns()
+        time.sleep(seconds)
+        stop.set()
+
+        received = [results.get(timeout=60) for _ in processes]
+        end = max([result["last"] for result in received if result["last"]], default=time.perf_counter_ns())
+        elapsed = (end - start) / 1e9
+        server_cpu = (cpu_seconds(server.pid) - cpu_start) / elapsed
+        rss_kb, peak_rss_kb = memory_kb(server.pid)
+
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.kill()
+        server.kill()
+        server.wait()
+
+    latencies = [latency / 1e6 for result in received for latency in result["latencies"]] or [float("nan")]
+    delivered = sum(len(result["latencies"]) for result in received)
+    sent = sum(result["sent"] for result in received)
+    expected = sent * (clients - 1 if routing == "broadcast" else 1)
+
+    return {
+        "mode": mode,
+        "routing": routing,
+        "clients": clients,
+        "workers": workers,
+        "rate": rate,
+        "sent": sent,
+        "delivered": delivered,
+        "lost": expected - delivered,
+        "sent_per_s": sent / seconds,
+        "delivered_per_s": delivered / elapsed,
+        "bytes_per_s": sum(result["bytes"] for result in received) / elapsed,
+        "p50_ms": percentile(latencies, 0.5),
+        "p99_ms": percentile(latencies, 0.99),
+        "p999_ms": percentile(latencies, 0.999),
+        "server_cpu": server_cpu,
+        "rss_kb": rss_kb,
+        "peak_rss_kb": peak_rss_kb,
+    }
+
+
+def benchmark_fanout(mode, clients, port, messages=200, slow=0, drop_policy="drop-oldest"):
+    '''
+    Broadcasts `messages` messages, one at a time, from one client to `clients` receivers
+    (plus `slow` receivers that never read) and reports the latency of every delivery and of
+    the whole fan-out (until the last receiver got the message).
+    '''
+    server = start_server(port, mode, drop_policy=drop_policy)
+    stalled = []
+
+    try:
+        receivers = []
+        for _ in range(clients):
+            receiver = socket.create_connection(("127.0.0.1", port))
+            wait_control(receiver, "/change_id")
+            receivers.append(receiver)
+
+        # Slow consumers: a small receive buffer that is never read
+        for _ in range(slow):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            sock.connect(("127.0.0.1", port))
+            stalled.append(sock)
+
+        sender = socket.create_connection(("127.0.0.1", port))
+        wait_control(sender, "/change_id")
+        sender.setblocking(False)  # Nothing is read from it, and it must not fill up
+        time.sleep(0.5)
+
+        collector = Receivers(receivers)
+        deliveries, fanouts, lost = [], [], 0
+        payload = "x" * 40
+
+        for k in range(messages):
+            sent = time.perf_counter_ns()
+            sender.setblocking(True)
+            sender.sendall(pack_frame(LabelString(payload[:8], str(k)).pack_msg(), "LabelString"))
+            sender.setblocking(False)
+
+            if not collector.wait(k, clients, timeout=5):
+                lost += 1
+                continue
+
+            with collector.condition:
+                times = collector.received.pop(k)
+            deliveries.extend((received - sent) / 1e6 for received in times)
+            fanouts.append((max(times) - sent) / 1e6)
+
+        collector.close()
+        sender.close()
+    finally:
+        for sock in stalled:
+            sock.close()
+        server.kill()
+        server.wait()
+
+    return {
+        "mode": mode,
+        "clients": clients,
+        "slow": slow,
+        "lost": lost,
+        "delivery_p50_ms": percentile(deliveries, 0.5),
+        "delivery_p99_ms": percentile(deliveries, 0.99),
+        "fanout_p50_ms": percentile(fanouts, 0.5),
+        "fanout_p99_ms": percentile(fanouts, 0.99),
+    }
+
+
+def benchmark_connections(mode, connections, port, seconds=2.0, idle_seconds=2.0):
+    '''
+    Opens `connections` clients (two of them measured, the rest idle) and reports the server
+    CPU use while idle, and the CPU use and latency while the measured clients exchange peer
+    messages one at a time for `seconds`.
+    '''
+    server = start_server(port, mode)
+    drain = Drain()
+
+    try:
+        for _ in range(connections - 2):
+            drain.add(socket.create_connection(("127.0.0.1", port)))
+
+        receiver = socket.create_connection(("127.0.0.1", port))
+        receiver_id = wait_control(receiver, "/change_id")
+        sender = socket.create_connection(("127.0.0.1", port))
+        wait_control(sender, "/change_id")
+
+        sender.sendall(pack_frame(ControlMsg("/change_peer", receiver_id).pack_msg(), "ControlMsg"))
+        time.sleep(1)
+
+        cpu_start = cpu_seconds(server.pid)
+        time.sleep(idle_seconds)
+        idle_cpu = (cpu_seconds(server.pid) - cpu_start) / idle_seconds
+
+        latencies = []
+        cpu_start, wall_start = cpu_seconds(server.pid), time.perf_counter()
+        while time.perf_counter() - wall_start < seconds:
+            sent = time.perf_counter_ns()
+            sender.sendall(pack_frame(LabelString("bench", str(sent)).pack_msg(), "LabelString"))
+
+            while True:
+                type_message, body = recv_frame(receiver)
+                if type_message == "LabelString" and LabelString().unpack_msg(body)[1] == str(sent):
+                    break
+            latencies.append((time.perf_counter_ns() - sent) / 1e6)
+        busy_cpu = (cpu_seconds(server.pid) - cpu_start) / (time.perf_counter() - wall_start)
+
+        sender.close()
+        receiver.close()
+    finally:
+        drain.close()
+        server.kill()
+        server.wait()
+
+    return {
+        "mode": mode,
+        "connections": connections,
+        "idle_cpu": idle_cpu,
+        "busy_cpu": busy_cpu,
+        "messages": len(latencies),
+        "p50_ms": percentile(latencies, 0.5),
+        "p99_ms": percentile(latencies, 0.99),
+    }
+
+
+def benchmark_transports(transport, mode, port, seconds=2.0, messages=200000, size=100):
+    '''
+    Peer messages between two clients over one transport: the latency of one message at a
+    time for `seconds`, then the throughput of `messages` messages of `size` bytes sent back
+    to back, with the CPU time the server and the two clients spend per message.
+    '''
+    server = start_server(port, mode, transport=transport)
+
+    try:
+        receiver = connect(transport, "127.0.0.1", port)
+        receiver_id = wait_control(receiver, "/change_id")
+        sender = connect(transport, "127.0.0.1", port)
+        wait_control(sender, "/change_id")
+
+        sender.sendall(CONTROL_MSG.frame("/change_peer", receiver_id))
+        for _ in range(2):
+            wait_control(receiver, "/new_peer")  # Sent twice for the sender's connection
+        time.sleep(0.5)
+
+        latencies = []
+        wall_start = time.perf_counter()
+        while time.perf_counter() - wall_start < seconds:
+            sent = time.perf_counter_ns()
+            sender.sendall(LABEL_STRING.frame("bench", str(sent)))
+
+            while True:
+                type_message, body = recv_frame(receiver)
+                if type_message == "LabelString" and LABEL_STRING.unpack(body)[1] == str(sent):
+                    break
+            latencies.append((time.perf_counter_ns() - sent) / 1e6)
+
+        # Throughput: bursts of 64 frames of a type the server forwards unread
+        burst = (struct.pack(HEADER_FORMAT, size, b"Bench") + b"x" * size) * 64
+        bursts = max(1, messages // 64)
+        total = bursts * len(burst)
+
+        def send():
+            for _ in range(bursts):
+                sender.sendall(burst)
+
+        cpu_start, clients_start = cpu_seconds(server.pid), time.process_time()
+        wall_start = time.perf_counter()
+        thread = threading.Thread(target=send)
+        thread.start()
+
+        buffer = bytearray(65536)
+        received = 0
+        while received < total:
+            count = receiver.recv_into(buffer)
+            if not count:
+                raise ConnectionError("Server closed the connection")
+            received += count
+
+        thread.join()
+        elapsed = time.perf_counter() - wall_start
+        server_cpu = cpu_seconds(server.pid) - cpu_start
+        clients_cpu = time.process_time() - clients_start
+
+        sender.close()
+        receiver.close()
+    finally:
+        server.kill()
+        server.wait()
+
+    return {
+        "transport": transport,
+        "mode": mode,
+        "p50_ms": percentile(latencies, 0.5),
+        "p99_ms": percentile(latencies, 0.99),
+        "messages_per_s": bursts * 64 / elapsed,
+        "bytes_per_s": total / elapsed,
+        "server_us_per_message": server_cpu / (bursts * 64) * 1e6,
+        "clients_us_per_message": clients_cpu / (bursts * 64) * 1e6,
+    }
+
+
+class LegacyLabelString:
+    # LabelString as it was before the codec registry, kept to compare against
+    def __init__(self, label='', string_msg=''):
+        self.__label = label
+        self.__string = string_msg
+        self.__pattern = f'20s80s'
+
+    def pack_msg(self):
+        self.__label = self.__label.encode('utf-8')
+        self.__label = self.__label.ljust(20, b"\x00")
+
+        self.__string = self.__string.encode('utf-8')
+        self.__string = self.__string.ljust(80, b"\x00")
+
+        return struct.pack(self.__pattern, self.__label, self.__string)
+
+    def unpack_msg(self, data):
+        self.__label, self.__string = struct.unpack(self.__pattern, data)
+        self.__label = self.__label.decode('utf-8').strip('\x00')
+        self.__string = self.__string.decode('utf-8').strip('\x00')
+
+        return self.__label, self.__string
+
+
+class LegacyControlMsg:
+    # ControlMsg as it was before the codec registry, kept to compare against
+    def __init__(self, command='', arg1 ='', arg2=''):
+        self.__command = command
+        self.__arg1 = arg1
+        self.__arg2 = arg2
+        self.__pattern = '20s20s20s'
+
+    def setup_msg(self):
+        self.__command = self.__command.encode('utf-8')
+        self.__command = self.__command.ljust(20, b"\x00")
+
+        self.__arg1 = self.__arg1.encode('utf-8')
+        self.__arg1 = self.__arg1.ljust(20, b"\x00")
+
+        self.__arg2 = self.__arg2.encode('utf-8')
+        self.__arg2 = self.__arg2.ljust(20, b"\x00")
+
+    def pack_msg(self):
+        self.setup_msg()
+        return struct.pack(self.__pattern,
+                           self.__command,
+                           self.__arg1,
+                           self.__arg2)
+
+    def unpack_msg(self, data):
+        self.__command, self.__arg1, self.__arg2 = struct.unpack(self.__pattern, data)
+        self.__command = self.__command.decode('utf-8').strip('\x00')
+        self.__arg1 = self.__arg1.decode('utf-8').strip('\x00')
+        self.__arg2 = self.__arg2.decode('utf-8').strip('\x00')
+
+        return self.__command, self.__arg1, self.__arg2
+
+
+def benchmark_codecs(number=100000):
+    '''
+    Messages per second packed and unpacked by the codecs of simple_msg and by the message
+    classes they replaced, for every operation of the send and receive paths. Bodies are
+    unpacked from memoryviews, as they come out of a FrameReader.
+    '''
+    control = ("/change_id", "client_1")
+    label = ("client_1", "x" * 40)
+    buffer = bytearray(HEADER + LABEL_STRING.size)
+
+    control_body = memoryview(CONTROL_MSG.pack(*control))
+    label_body = memoryview(LABEL_STRING.pack(*label))
+
+    cases = [
+        ("ControlMsg", "pack",
+         lambda: LegacyControlMsg(*control).pack_msg(),
+         lambda: CONTROL_MSG.pack(*control)),
+        ("ControlMsg", "frame",
+         lambda: pack_frame(LegacyControlMsg(*control).pack_msg(), "ControlMsg"),
+         lambda: CONTROL_MSG.frame(*control)),
+        ("ControlMsg", "frame_into",
+         lambda: buffer.__setitem__(slice(0, HEADER + CONTROL_MSG.size),
+                                    pack_frame(LegacyControlMsg(*control).pack_msg(), "ControlMsg")),
+         lambda: CONTROL_MSG.frame_into(buffer, 0, *control)),
+        ("ControlMsg", "unpack",
+         lambda: LegacyControlMsg().unpack_msg(control_body),
+         lambda: CONTROL_MSG.unpack(control_body)),
+        ("LabelString", "pack",
+         lambda: LegacyLabelString(*label).pack_msg(),
+         lambda: LABEL_STRING.pack(*label)),
+        ("LabelString", "frame",
+         lambda: pack_frame(LegacyLabelString(*label).pack_msg(), "LabelString"),
+         lambda: LABEL_STRING.frame(*label)),
+        ("LabelString", "frame_into",
+         lambda: buffer.__setitem__(slice(0, HEADER + LABEL_STRING.size),
+                                    pack_frame(LegacyLabelString(*label).pack_msg(), "LabelString")),
+         lambda: LABEL_STRING.frame_into(buffer, 0, *label)),
+        ("LabelString", "unpack",
+         lambda: LegacyLabelString().unpack_msg(label_body),
+         lambda: LABEL_STRING.unpack(label_body)),
+    ]
+
+    results = []
+    for message, operation, before, after in cases:
+        if operation != "frame_into":
+            assert before() == after(), f"{message} {operation} differs from the class"
+        results.append({
+            "message": message,
+            "operation": operation,
+            "before_per_s": number / min(timeit.repeat(before, number=number, repeat=3)),
+            "after_per_s": number / min(timeit.repeat(after, number=number, repeat=3)),
+        })
+    return results
+
+
+def version():
+    # Commit of the tree being measured, so results can be compared across versions
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=SCRIPTS_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_json(path, args, results):
+    report = {
+        "benchmark": args.benchmark,
+        "version": version(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "arguments": {name: value for name, value in vars(args).items() if name not in ("benchmark", "json")},
+        "results": results,
+    }
+    with open(path, "w") as output:
+        json.dump(report, output, indent=2)
+
+
+def main():
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument("--json", metavar="PATH", help="also write the results to a JSON file")
+
+    common = argparse.ArgumentParser(add_help=False, parents=[output])
+    common.add_argument("--port", type=int, default=5060)
+    common.add_argument("--modes", nargs="+", default=["threads", "selector"])
+
+    parser = argparse.ArgumentParser(description="Benchmarks of the TCP message server")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    connections = benchmarks.add_parser("connections", parents=[common],
+                                        help="CPU and peer latency vs open connections")
+    connections.add_argument("--connections", nargs="+", type=int, default=[10, 100, 1000])
+    connections.add_argument("--seconds", type=float, default=2.0)
+
+    fanout = benchmarks.add_parser("fanout", parents=[common], help="broadcast latency vs number of receivers")
+    fanout.add_argument("--clients", nargs="+", type=int, default=[10, 100, 500])
+    fanout.add_argument("--messages", type=int, default=200)
+    fanout.add_argument("--slow", type=int, default=0, help="receivers that never read")
+    fanout.add_argument("--drop-policy", default="drop-oldest",
+                        choices=["drop-oldest", "drop-newest", "disconnect"])
+
+    load = benchmarks.add_parser("load", parents=[common], help="throughput and latency of N clients")
+    load.add_argument("--clients", nargs="+", type=int, default=[2, 10, 20])
+    load.add_argument("--routing", nargs="+", default=["broadcast", "peer"], choices=["broadcast", "peer"])
+    load.add_argument("--seconds", type=float, default=5.0)
+    load.add_argument("--rate", type=float, default=100, help="messages/s per client (0: as fast as possible)")
+    load.add_argument("--batch", type=int, default=1, help="messages per write of a client")
+    load.add_argument("--workers", type=int, default=None, help="load generator processes (default: one per CPU)")
+    load.add_argument("--queue-size", type=int, default=None, help="frames queued per client by the server")
+
+    transports = benchmarks.add_parser("transports", parents=[common],
+                                       help="latency and CPU cost of the TCP, Unix socket and shared-memory transports")
+    transports.add_argument("--transports", nargs="+", default=list(TRANSPORTS), choices=TRANSPORTS)
+    transports.add_argument("--seconds", type=float, default=2.0, help="duration of the latency measure")
+    transports.add_argument("--messages", type=int, default=200000, help="messages of the throughput measure")
+    transports.add_argument("--size", type=int, default=100, help="bytes per message of the throughput measure")
+
+    codecs = benchmarks.add_parser("codecs", parents=[output], help="pack/unpack throughput of the message codecs")
+    codecs.add_argument("--number", type=int, default=100000, help="calls per measure")
+
+    args = parser.parse_args()
+    port = getattr(args, "port", None)
+    results = []
+
+    if args.benchmark == "codecs":
+        print(f"{'message':>12}{'operation':>12}{'before [k/s]':>14}{'after [k/s]':>13}{'speedup':>9}")
+        for result in benchmark_codecs(args.number):
+            results.append(result)
+            print(f"{result['message']:>12}{result['operation']:>12}{result['before_per_s'] / 1e3:>14.0f}"
+                  f"{result['after_per_s'] / 1e3:>13.0f}{result['after_per_s'] / result['before_per_s']:>9.2f}")
+
+    elif args.benchmark == "load":
+        options = {} if args.queue_size is None else {"queue_size": args.queue_size}
+        print(f"{'mode':>10}{'routing':>11}{'clients':>9}{'sent/s':>10}{'recv/s':>10}{'MB/s':>8}{'lost':>8}"
+              f"{'p50':>8}{'p99':>8}{'p999 [ms]':>11}{'CPU':>7}{'RSS [MB]':>10}")
+        for mode in args.modes:
+            for routing in args.routing:
+                for clients in args.clients:
+                    result = benchmark_load(mode, clients, port, routing, args.seconds, args.rate, args.batch,
+                                            args.workers, **options)
+                    results.append(result)
+                    port += 1
+                    print(f"{result['mode']:>10}{result['routing']:>11}{result['clients']:>9}"
+                          f"{result['sent_per_s']:>10.0f}{result['delivered_per_s']:>10.0f}"
+                          f"{result['bytes_per_s'] / 1e6:>8.1f}{result['lost']:>8}"
+                          f"{result['p50_ms']:>8.2f}{result['p99_ms']:>8.2f}{result['p999_ms']:>11.2f}"
+                          f"{result['server_cpu']:>7.0%}{result['peak_rss_kb'] / 1e3:>10.1f}")
+
+    elif args.benchmark == "transports":
+        print(f"{'transport':>10}{'mode':>10}{'p50':>8}{'p99 [ms]':>10}{'msg/s':>10}{'MB/s':>8}"
+              f"{'server':>8}{'clients [us/msg]':>18}")
+        for transport in args.transports:
+            for mode in args.modes:
+                result = benchmark_transports(transport, mode, port, args.seconds, args.messages, args.size)
+                results.append(result)
+                port += 1
+                print(f"{result['transport']:>10}{result['mode']:>10}{result['p50_ms']:>8.3f}{result['p99_ms']:>10.3f}"
+                      f"{result['messages_per_s']:>10.0f}{result['bytes_per_s'] / 1e6:>8.1f}"
+                      f"{result['server_us_per_message']:>8.2f}{result['clients_us_per_message']:>18.2f}")
+
+    elif args.benchmark == "fanout":
+        print(f"{'mode':>10}{'clients':>9}{'slow':>6}{'lost':>6}"
+              f"{'delivery p50':>14}{'p99 [ms]':>10}{'fan-out p50':>13}{'p99 [ms]':>10}")
+        for mode in args.modes:
+            for clients in args.clients:
+                result = benchmark_fanout(mode, clients, port, args.messages, args.slow, args.drop_policy)
+                results.append(result)
+                port += 1
+                print(f"{result['mode']:>10}{result['clients']:>9}{result['slow']:>6}{result['lost']:>6}"
+                      f"{result['delivery_p50_ms']:>14.3f}{result['delivery_p99_ms']:>10.3f}"
+                      f"{result['fanout_p50_ms']:>13.3f}{result['fanout_p99_ms']:>10.3f}")
+
+    else:
+        print(f"{'mode':>10}{'clients':>9}{'idle CPU':>10}{'busy CPU':>10}{'p50 [ms]':>10}{'p99 [ms]':>10}")
+        for mode in args.modes:
+            for connections in args.connections:
+                result = benchmark_connections(mode, connections, port, args.seconds)
+                results.append(result)
+                port += 1
+                print(f"{result['mode']:>10}{result['connections']:>9}{result['idle_cpu']:>10.1%}"
+                      f"{result['busy_cpu']:>10.1%}{result['p50_ms']:>10.3f}{result['p99_ms']:>10.3f}")
+
+    if args.json:
+        write_json(args.json, args, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import threading
+
+from message_queue import BLOCK
+
+# Policies of a client out of send credits, besides BLOCK (wait for the next grant)
+FAIL_FAST = "fail-fast"  # Refuse the message
+COALESCE = "coalesce"  # Keep the latest message of each lane for the next grant
+
+FLOW_POLICIES = (BLOCK, FAIL_FAST, COALESCE)
+
+
+class SendCredits:
+    """
+    Send credits of a client under flow control: one per data message, granted by the
+    server (/credit) as the recipients of the messages keep up.
+
+    A message is only handed to `send` (the send queue) with a credit. Without one the
+    policy applies: BLOCK waits for a grant, FAIL_FAST refuses the message and COALESCE
+    keeps the latest message of each lane until the next grant (telemetry where only the
+    last value matters). `send` is called under the lock, so the messages a grant
+    releases keep their order with the ones sent meanwhile.
+    """
+
+    def __init__(self, send, policy=BLOCK):
+        if policy not in FLOW_POLICIES:
+            raise ValueError(f"Unknown flow control policy: {policy}")
+
+        self.policy = policy
+        self.available = 0
+        self.refused = 0  # Messages refused (FAIL_FAST), or given up on by BLOCK's timeout
+        self.coalesced = 0  # Messages replaced by a newer one while waiting (COALESCE)
+
+        self.__send = send
+        self.__waiting = {}  # lane -> message kept by COALESCE, oldest lane first
+        self.__condition = threading.Condition()
+        self.__closed = False
+
+    def send(self, item, lane, timeout=None):
+        # Returns False when the message is refused, True when it is sent or kept for the
+        # next grant
+        with self.__condition:
+            if self.__closed:
+                return False
+
+            if not self.available:
+                if self.policy == COALESCE:
+                    if lane in self.__waiting:
+                        self.coalesced += 1
+                    self.__waiting[lane] = item
+                    return True
+
+                if self.policy == FAIL_FAST or not self.__condition.wait_for(
+                    lambda: self.available or self.__closed, timeout
+                ) or self.__closed:
+                    self.refused += 1
+                    return False
+
+            return self.__take(item, lane)
+
+    def grant(self, count):
+        # The messages kept by COALESCE go first
+        with self.__condition:
+            self.available += count
+            while self.available and self.__waiting:
+                lane = next(iter(self.__waiting))
+                self.__take(self.__waiting.pop(lane), lane)
+            self.__condition.notify_all()
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__waiting.clear()
+            self.__condition.notify_all()
+
+    def __take(self, item, lane):
+        # A message the send queue drops gives its credit back: the server never sees it
+        self.available -= 1
+        if self.__send(item, lane):
+            return True
+        self.available += 1
+        return False
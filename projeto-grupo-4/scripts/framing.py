@@ -0,0 +1,213 @@
+import os
+import socket
+import struct
+
+HEADER = 24
+HEADER_FORMAT = "!I20s"
+FORMAT = "utf-8"
+
+BUFFER_SIZE = 65536
+MAX_FRAME = 1 << 24  # Largest frame body accepted (the length field of a header is untrusted)
+
+# Most buffers a single sendmsg accepts
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+_LENGTH = struct.Struct("!I")  # Length field at the start of a header
+
+class FrameTooLarge(ValueError):
+    """A header declared a body larger than the reader accepts: the stream cannot be trusted."""
+
+
+# Decoded type names, so repeated frames of the same type do not decode their name again
+_TYPE_NAMES = {}
+
+
+def type_name(raw_type):
+    # The Python side pads the type with "\x00", the C++ client with spaces
+    name = _TYPE_NAMES.get(raw_type)
+    if name is None:
+        name = _TYPE_NAMES[raw_type] = raw_type.rstrip(b"\x00 ").decode(FORMAT)
+    return name
+
+
+class FrameReader:
+    """
+    Receive side of the framing: `recv_into` a preallocated buffer, then cut every
+    complete frame out of it.
+
+    A single read may hold several frames (or part of one); frames() yields the complete
+    ones as memoryview slices of the buffer. The slices are only valid until the next
+    recv_from(), so anything kept longer must be copied by the caller. A relay that only
+    reads some types gets the other frames as runs (of one type each), to pass each run
+    on with one write.
+
+    A header declaring a body over max_frame raises FrameTooLarge before any buffer is
+    grown for it; the connection should be dropped, its next frame cannot be found.
+    """
+
+    def __init__(self, size=BUFFER_SIZE, max_frame=MAX_FRAME):
+        self.__buffer = bytearray(size)
+        self.__view = memoryview(self.__buffer)
+        self.__start = 0  # First byte not consumed by frames()
+        self.__end = 0  # End of the received bytes
+        self.__needed = HEADER  # Bytes the frame at __start needs to be complete
+        self.__max_frame = max_frame
+        self.count = 0  # Complete frames cut so far
+        self.invalid = 0  # Frames dropped for a type name that is not text
+
+    def recv_from(self, sock):
+        # One recv_into call; returns the number of bytes received (0 when the peer closed)
+        self.__make_room()
+        received = sock.recv_into(self.__view[self.__end :])
+        self.__end += received
+        return received
+
+    def frames(self, parsed=None):
+        # Yields (type_message, frame, body) for every complete frame received so far,
+        # frame being the whole frame (header and body). With `parsed` (type names), frames
+        # of another type that follow each other are yielded together, unparsed, as
+        # (type_message, frames, None)
+        view = self.__view
+        run_start = None  # First byte of the pending run of unparsed frames
+        run_type = None
+
+        while self.__end - self.__start >= HEADER:
+            length_message, raw_type = struct.unpack_from(HEADER_FORMAT, view, self.__start)
+            if length_message > self.__max_frame:
+                if run_start is not None:
+                    yield run_type, view[run_start : self.__start], None
+                raise FrameTooLarge(
+                    f"Frame of {length_message} bytes, at most {self.__max_frame} accepted"
+                )
+            frame_end = self.__start + HEADER + length_message
+
+            if frame_end > self.__end:
+                self.__needed = HEADER + length_message
+                break
+
+            try:
+                type_message = type_name(raw_type)
+            except UnicodeDecodeError:
+                # Dropped, past it first so the next call does not stop on it again
+                invalid_start, self.__start = self.__start, frame_end
+                self.invalid += 1
+                if run_start is not None:
+                    yield run_type, view[run_start : invalid_start], None
+                    run_start = None
+                continue
+
+            self.count += 1
+
+            if run_start is not None and type_message != run_type:
+                yield run_type, view[run_start : self.__start], None
+                run_start = None
+
+            if parsed is not None and type_message not in parsed:
+                if run_start is None:
+                    run_start, run_type = self.__start, type_message
+                self.__start = frame_end
+                continue
+
+            frame = view[self.__start : frame_end]
+            body = view[self.__start + HEADER : frame_end]
+            self.__start = frame_end
+
+            yield type_message, frame, body
+        else:
+            self.__needed = HEADER
+
+        if run_start is not None:
+            yield run_type, view[run_start : self.__start], None
+
+    def __make_room(self):
+        pending = self.__end - self.__start
+
+        if pending == 0:
+            self.__start = self.__end = 0
+            return
+
+        needed = max(self.__needed, pending + 1)
+
+        if needed > len(self.__buffer):
+            # A frame larger than the buffer: move to a bigger one (the old one stays alive
+            # for as long as the caller holds slices of it)
+            buffer = bytearray(max(needed, 2 * len(self.__buffer)))
+            buffer[:pending] = self.__view[self.__start : self.__end]
+            self.__buffer = buffer
+            self.__view = memoryview(buffer)
+            self.__start, self.__end = 0, pending
+
+        elif len(self.__buffer) - self.__start < needed or self.__end == len(self.__buffer):
+            # Move the partial frame to the front (memoryview assignment is a memmove)
+            self.__view[:pending] = self.__view[self.__start : self.__end]
+            self.__start, self.__end = 0, pending
+
+
+def split_frames(data):
+    # The frames of a run (whole frames back to back), as views of data
+    view = memoryview(data)
+    frames = []
+    start = 0
+    while start < len(view):
+        (length_message,) = _LENGTH.unpack_from(view, start)
+        end = start + HEADER + length_message
+        frames.append(view[start:end])
+        start = end
+    return frames
+
+
+def configure_socket(sock, nodelay=True, send_buffer=None, recv_buffer=None):
+    # TCP_NODELAY (TCP sockets only) and the kernel buffer sizes (None keeps the system
+    # default)
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+
+    if send_buffer is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+    if recv_buffer is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer)
+
+
+def send_available(sock, buffers):
+    """
+    One sendmsg scatter call with the first IOV_MAX buffers. On a non-blocking socket it
+    writes what fits in the socket buffer. Returns the number of bytes written and the
+    buffers (or the rest of one) left unsent.
+    """
+    try:
+        sent = written = sock.sendmsg(buffers[:IOV_MAX])
+    except BlockingIOError:
+        return 0, buffers
+
+    # Skip the buffers written entirely, then cut the partially written one
+    first = 0
+    while first < len(buffers) and sent >= len(buffers[first]):
+        sent -= len(buffers[first])
+        first += 1
+
+    if sent:
+        return written, [memoryview(buffers[first])[sent:]] + buffers[first + 1 :]
+    return written, buffers[first:]
+
+
+def send_buffers(sock, buffers):
+    """
+    Send side of the framing: writes every buffer (headers and bodies of one or more
+    frames) with a single sendmsg scatter call, and only calls it again for what a full
+    socket buffer left unsent. Blocks until everything is written, like sendall, and
+    returns the number of bytes written.
+    """
+    if not hasattr(sock, "sendmsg"):
+        data = b"".join(buffers)
+        sock.sendall(data)  # No scatter/gather I/O on this platform
+        return len(data)
+
+    total = 0
+    buffers = [buffer for buffer in buffers if len(buffer)]
+    while buffers:
+        sent, buffers = send_available(sock, buffers)
+        total += sent
+    return total
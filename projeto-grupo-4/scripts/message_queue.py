@@ -0,0 +1,234 @@
+import collections
+import threading
+
+# Drop policies, applied when a message arrives at a full queue
+DROP_OLDEST = "drop-oldest"  # Discard the oldest queued message to make room
+DROP_NEWEST = "drop-newest"  # Discard the message being queued
+BLOCK = "block"  # Wait for room (put() gives up and drops after its timeout)
+
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+# Lanes of a queue
+CONTROL = "control"  # Served before every other lane, never full
+BARRIER = "barrier"  # In order with every lane (after the messages queued before it), never full
+DATA = "data"  # Messages put without a lane, or in a lane the queue does not have
+
+
+class MessageQueue:
+    """
+    Bounded FIFO shared by producer and consumer threads.
+
+    Consumers sleep on a condition variable and wake up as soon as a message is queued,
+    instead of polling the queue length. `dropped` counts every message lost to the
+    drop policy.
+
+    Messages are put in lanes. The CONTROL lane is always taken first and is not bounded
+    (control messages are few, and must not wait behind data nor be dropped). The data
+    lanes (DATA, plus one per entry of `weights`, lane -> weight) each hold up to maxlen
+    messages and are served in weighted round robin: `weight` messages of a lane, then the
+    next lane's, so a high-volume lane does not starve the others. FIFO order holds within
+    a lane.
+
+    A BARRIER message (a command that changes where the next messages go) keeps its place
+    among all of them: it is taken once every message queued before it in any lane has
+    been, and before any message queued after it.
+    """
+
+    def __init__(self, maxlen=10, policy=DROP_OLDEST, weights=None):
+        if policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {policy}")
+
+        self.maxlen = maxlen
+        self.policy = policy
+        self.dropped = 0
+
+        self.__control = collections.deque()
+        self.__lanes = {DATA: collections.deque()}
+        self.__weights = [1]
+        for lane, weight in (weights or {}).items():
+            if weight < 1:
+                raise ValueError(f"Weight of lane {lane} must be at least 1")
+            if lane == DATA:
+                self.__weights[0] = weight
+            elif lane != CONTROL:
+                self.__lanes[lane] = collections.deque()
+                self.__weights.append(weight)
+        self.__order = list(self.__lanes.values())  # Round robin order, matches __weights
+        self.__turn = 0  # Data lane the round robin resumes from
+
+        # Pending barriers, oldest first: [message, messages of each data lane (in __order)
+        # still to be taken before it]
+        self.__barriers = collections.deque()
+
+        self.__count = 0
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.__woken = False  # wake() called since the last wait()
+
+    def __len__(self):
+        return self.__count
+
+    def put(self, item, timeout=None, lane=DATA):
+        # Returns False when the item (or, with DROP_OLDEST, nothing) was dropped
+        return self.put_many((item,), timeout, lane) == 1
+
+    def put_many(self, items, timeout=None, lane=DATA):
+        # Puts the items one after the other, the drop policy applying to each, under one
+        # lock acquisition. Returns how many of them were queued (dropped ones excluded).
+        # With BLOCK, the timeout applies to each item
+        with self.__condition:
+            if self.__closed:
+                return 0
+
+            queued = 0
+            if lane == BARRIER:
+                for item in items:
+                    self.__barriers.append([item, [len(lane_items) for lane_items in self.__order]])
+                self.__count += len(items)
+                self.__condition.notify_all()
+                return len(items)
+
+            if lane == CONTROL:
+                queue = self.__control
+            else:
+                queue = self.__lane(lane)
+
+            for item in items:
+                if lane != CONTROL and len(queue) >= self.maxlen:
+                    if self.policy == DROP_NEWEST:
+                        self.dropped += 1
+                        continue
+
+                    if self.policy == DROP_OLDEST:
+                        queue.popleft()
+                        self.__count -= 1
+                        self.dropped += 1
+                        if self.__barriers:
+                            turn = next(k for k, items in enumerate(self.__order) if items is queue)
+                            self.__passed(turn, 1)
+
+                    elif not self.__condition.wait_for(
+                        lambda: len(queue) < self.maxlen or self.__closed, timeout
+                    ) or self.__closed:
+                        self.dropped += 1
+                        continue
+
+                queue.append(item)
+                self.__count += 1
+                queued += 1
+
+            if queued:
+                self.__condition.notify_all()
+            return queued
+
+    def full(self, lane=DATA):
+        # True when a message put in the lane now meets the drop policy
+        if lane in (CONTROL, BARRIER):
+            return False
+        return len(self.__lane(lane)) >= self.maxlen
+
+    def get(self, timeout=None):
+        # Returns None when the queue is closed or nothing arrived within the timeout
+        with self.__condition:
+            if not self.__condition.wait_for(lambda: self.__count or self.__closed, timeout):
+                return None
+            if not self.__count:
+                return None
+
+            item = self.__take(1)[0]
+            self.__condition.notify_all()  # Wake up producers blocked on a full queue
+            return item
+
+    def wait(self, timeout=None):
+        # Waits like get() without taking anything; True when messages are queued, or when
+        # wake() was called
+        with self.__condition:
+            self.__condition.wait_for(
+                lambda: self.__count or self.__woken or self.__closed, timeout
+            )
+            woken, self.__woken = self.__woken, False
+            return bool(self.__count) or woken
+
+    def wake(self):
+        # Returns a consumer from wait() without queuing anything, for work it keeps outside
+        # the queue (the rest of a partially written frame)
+        with self.__condition:
+            self.__woken = True
+            self.__condition.notify_all()
+
+    def get_batch(self, max_items=None, timeout=None):
+        # Waits like get(), then takes every queued message (up to max_items) at once,
+        # control messages first
+        with self.__condition:
+            if not self.__condition.wait_for(lambda: self.__count or self.__closed, timeout):
+                return []
+
+            batch = self.__take(self.__count if max_items is None else min(max_items, self.__count))
+            self.__condition.notify_all()
+            return batch
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+    def is_closed(self):
+        return self.__closed
+
+    def __lane(self, lane):
+        items = self.__lanes.get(lane)
+        return self.__lanes[DATA] if items is None else items
+
+    def __take(self, count):
+        # The next `count` messages in scheduling order (count <= queued messages)
+        batch = []
+        control = self.__control
+        while control and len(batch) < count:
+            batch.append(control.popleft())
+
+        if self.__barriers:
+            self.__take_barriers(batch, count)
+        elif len(self.__order) == 1:
+            data = self.__order[0]
+            if count - len(batch) == len(data):
+                batch.extend(data)
+                data.clear()
+            while len(batch) < count:
+                batch.append(data.popleft())
+        else:
+            while len(batch) < count:
+                items = self.__order[self.__turn]
+                for _ in range(min(self.__weights[self.__turn], len(items), count - len(batch))):
+                    batch.append(items.popleft())
+                self.__turn = (self.__turn + 1) % len(self.__order)
+
+        self.__count -= len(batch)
+        return batch
+
+    def __take_barriers(self, batch, count):
+        # __take while barriers are pending: the data lanes only give the messages queued
+        # before the oldest barrier, which comes next
+        while len(batch) < count:
+            if self.__control:
+                batch.append(self.__control.popleft())
+                continue
+
+            barrier = self.__barriers[0] if self.__barriers else None
+            if barrier is not None and not any(barrier[1]):
+                batch.append(self.__barriers.popleft()[0])
+                continue
+
+            turn = self.__turn
+            items = self.__order[turn]
+            limit = len(items) if barrier is None else barrier[1][turn]
+            taken = min(self.__weights[turn], len(items), limit, count - len(batch))
+            for _ in range(taken):
+                batch.append(items.popleft())
+            if taken and barrier is not None:
+                self.__passed(turn, taken)
+            self.__turn = (turn + 1) % len(self.__order)
+
+    def __passed(self, turn, count):
+        # count messages left the head of data lane `turn`
+        for barrier in self.__barriers:
+            barrier[1][turn] -= min(count, barrier[1][turn])
@@ -0,0 +1,121 @@
+import threading
+import time
+
+BUCKETS = 40  # Histogram buckets: the last one takes every value from 2**38 ns (~4.6 min) up
+
+
+class Histogram:
+    """
+    Histogram of latencies [ns] with power-of-two buckets: bucket k counts the values in
+    [2**(k - 1), 2**k). Recording one is a bit_length and a few integer updates, nothing is
+    allocated per value, and histograms of different connections merge by adding buckets.
+    """
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        self.counts[min(value.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for k, count in enumerate(other.counts):
+            self.counts[k] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        # Upper bound of the bucket holding the q quantile [ns] (0 when empty)
+        if not self.count:
+            return 0
+
+        rank = q * self.count
+        seen = 0
+        for k, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(1 << k, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_us": self.total / self.count / 1e3 if self.count else 0,
+            "p50_us": self.percentile(0.5) / 1e3,
+            "p99_us": self.percentile(0.99) / 1e3,
+            "p999_us": self.percentile(0.999) / 1e3,
+            "max_us": self.max / 1e3,
+            # Upper bound of the bucket [us] -> values in it
+            "buckets": {f"{(1 << k) / 1e3:g}": count for k, count in enumerate(self.counts) if count},
+        }
+
+
+class ConnectionStats:
+    """
+    Counters of one client connection. The receive side (bytes_in, frames_in, forward) is
+    only updated by the thread reading the client, the send side (bytes_out, writes,
+    queue_wait) under the client's send lock, so none of them needs a lock of its own.
+    pending_since is the exception: every sender sets it when it queues a frame, without
+    the send lock (a writer blocked on the socket holds it), so it has a lock of its own.
+    A frame queued while the writer is emptying the queue may be timed from its own
+    arrival rather than the backlog's start: queue_wait tolerates that.
+
+    forward is the time from a read returning to every frame it carried being written to
+    or queued for its recipients. queue_wait is the time from a frame being queued for the
+    client, while its queue was empty, to the write that emptied it.
+    """
+    __slots__ = (
+        "bytes_in", "frames_in", "bytes_out", "writes", "forward", "queue_wait", "pending_since",
+        "pending_lock",
+    )
+
+    def __init__(self):
+        self.bytes_in = 0
+        self.frames_in = 0
+        self.bytes_out = 0
+        self.writes = 0
+        self.forward = Histogram()
+        self.queue_wait = Histogram()
+        self.pending_since = 0  # perf_counter_ns of the oldest frame waiting, 0 when none
+        self.pending_lock = threading.Lock()
+
+    def queued(self):
+        # Called for every frame queued, only the first one of a backlog takes the time
+        with self.pending_lock:
+            if not self.pending_since:
+                self.pending_since = time.perf_counter_ns()
+
+    def written(self, sent):
+        self.bytes_out += sent
+        self.writes += 1
+
+    def drained(self):
+        # Called by the writer once the queue it emptied is written
+        with self.pending_lock:
+            since, self.pending_since = self.pending_since, 0
+        if since:
+            self.queue_wait.record(time.perf_counter_ns() - since)
+
+    def merge(self, other):
+        self.bytes_in += other.bytes_in
+        self.frames_in += other.frames_in
+        self.bytes_out += other.bytes_out
+        self.writes += other.writes
+        self.forward.merge(other.forward)
+        self.queue_wait.merge(other.queue_wait)
+
+    def snapshot(self):
+        return {
+            "bytes_in": self.bytes_in,
+            "frames_in": self.frames_in,
+            "bytes_out": self.bytes_out,
+            "writes": self.writes,
+        }
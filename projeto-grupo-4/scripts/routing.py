@@ -0,0 +1,172 @@
+import threading
+
+BROADCAST = "broadcast"  # Peer of the clients that send to everyone
+
+
+class RoutingTable:
+    """
+    Connected clients of the server, indexed both ways.
+
+    The forward index maps an id to its client, the reverse index maps an id to the clients
+    whose peer it is. Routing a message is one lookup, and a rename or a disconnection only
+    touches the clients targeting that id. Every change goes through one lock; senders take
+    what they need from the table and write outside of it.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__clients = {}  # id -> client
+        self.__targeting = {}  # id -> {id(client): client} of the clients whose peer it is
+        self.__recipients = ()  # Snapshot of the clients, rebuilt after changes
+
+    def __len__(self):
+        return len(self.__clients)
+
+    def get(self, client_id):
+        return self.__clients.get(client_id)
+
+    def items(self):
+        return [(client.id, client) for client in self.__recipients]
+
+    def values(self):
+        return self.__recipients
+
+    def add(self, client):
+        # Returns False (and adds nothing) when client.id is taken
+        with self.__lock:
+            if client.id in self.__clients:
+                return False
+
+            self.__clients[client.id] = client
+            self.__target(client, client.peer)
+            self.__recipients = tuple(self.__clients.values())
+            return True
+
+    def remove(self, client):
+        # Returns the clients that targeted it, now back to broadcast, or None when the
+        # client was not in the table
+        with self.__lock:
+            if self.__clients.get(client.id) is not client:
+                return None
+
+            del self.__clients[client.id]
+            self.__untarget(client, client.peer)
+            self.__recipients = tuple(self.__clients.values())
+
+            orphans = list(self.__targeting.pop(client.id, {}).values())
+            for orphan in orphans:
+                orphan.peer = BROADCAST
+            return orphans
+
+    def rename(self, client, new_id):
+        # The clients targeting the old id follow the client. Returns False (and renames
+        # nothing) when new_id is taken by another client
+        with self.__lock:
+            if new_id == client.id:
+                return True
+            if new_id in self.__clients:
+                return False
+
+            old_id = client.id
+            del self.__clients[old_id]
+            client.id = new_id
+            self.__clients[new_id] = client
+            self.__recipients = tuple(self.__clients.values())
+
+            followers = self.__targeting.pop(old_id, {})
+            for follower in followers.values():
+                follower.peer = new_id
+            if followers:
+                self.__targeting.setdefault(new_id, {}).update(followers)
+            return True
+
+    def set_peer(self, client, peer_id):
+        with self.__lock:
+            self.__untarget(client, client.peer)
+            client.peer = peer_id
+            self.__target(client, peer_id)
+
+    def __target(self, client, peer_id):
+        if peer_id != BROADCAST:
+            self.__targeting.setdefault(peer_id, {})[id(client)] = client
+
+    def __untarget(self, client, peer_id):
+        targeting = self.__targeting.get(peer_id)
+        if targeting is not None:
+            targeting.pop(id(client), None)
+            if not targeting:
+                del self.__targeting[peer_id]
+
+
+WILDCARD = "*"  # Ends a prefix pattern: "motor/*" matches every topic starting with "motor/"
+TOPIC_CACHE_SIZE = 1024  # Topics whose subscribers are kept resolved
+
+
+class TopicIndex:
+    """
+    Subscriptions of the clients to topics.
+
+    A pattern is either a topic or a prefix followed by WILDCARD ("*" alone matches every
+    topic). Resolving a topic costs one lookup per prefix of it, whatever the number of
+    subscriptions, and the result is cached until the subscriptions change.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__exact = {}  # topic -> {id(client): client}
+        self.__prefixes = {}  # prefix -> {id(client): client}
+        self.__patterns = {}  # id(client) -> patterns of the client
+        self.__resolved = {}  # topic -> subscribers
+
+    def subscribe(self, client, pattern):
+        with self.__lock:
+            index, key = self.__index(pattern)
+            index.setdefault(key, {})[id(client)] = client
+            self.__patterns.setdefault(id(client), set()).add(pattern)
+            self.__resolved = {}
+
+    def unsubscribe(self, client, pattern=None):
+        # Without a pattern, every subscription of the client is dropped
+        with self.__lock:
+            patterns = self.__patterns.get(id(client), set())
+            if pattern is None:
+                removed = list(patterns)
+            else:
+                removed = [pattern] if pattern in patterns else []
+
+            for each in removed:
+                patterns.discard(each)
+                index, key = self.__index(each)
+                subscribers = index[key]
+                del subscribers[id(client)]
+                if not subscribers:
+                    del index[key]
+
+            if not patterns:
+                self.__patterns.pop(id(client), None)
+            if removed:
+                self.__resolved = {}
+            return removed
+
+    def subscriptions(self, client):
+        return sorted(self.__patterns.get(id(client), ()))
+
+    def subscribers(self, topic):
+        resolved = self.__resolved.get(topic)
+        if resolved is not None:
+            return resolved
+
+        with self.__lock:
+            found = dict(self.__exact.get(topic, {}))
+            for end in range(len(topic) + 1):
+                found.update(self.__prefixes.get(topic[:end], {}))
+
+            if len(self.__resolved) >= TOPIC_CACHE_SIZE:
+                self.__resolved = {}
+            resolved = self.__resolved[topic] = tuple(found.values())
+            return resolved
+
+    def __index(self, pattern):
+        if pattern.endswith(WILDCARD):
+            return self.__prefixes, pattern[: -len(WILDCARD)]
+        return self.__exact, pattern
@@ -1,39 +1,118 @@
-import socket
 import threading
 import struct
 import signal, types
 import time
 
-from simple_msg import ControlMsg, LabelString
+from simple_msg import CONTROL_MSG, DATAPOINT_BATCH, LABEL_STRING, STATS
+from message_queue import MessageQueue, BARRIER, BLOCK, CONTROL
+from flow_control import SendCredits
+from transport import TCP, TRANSPORTS, address, connected, create_socket
+from framing import FrameReader, configure_socket, send_buffers
 
 HEADER = 24
 HEADER_FORMAT = "!I20s"
 FORMAT = "utf-8"
 PORT = 5050
 SERVER = "172.17.0.2"
+QUEUE_SIZE = 1000  # Messages waiting to be sent before the drop policy applies
+SEND_BATCH = 64  # Most messages per write: a control message waits for one write at most
+
+# Commands that change where the server sends the next data messages: they keep their place
+# among the data messages instead of going ahead of them like the other commands
+ROUTING_COMMANDS = {"/change_peer", "/publish"}
 
 
 CLIENT_PATTERN = types.SimpleNamespace(
     socket=None,
     addr=None,
     id="",
-    data=types.SimpleNamespace(header=[], body=[]),
+    data=None,
     peer="broadcast",
+    topic=None,
+    subscriptions=None,
     is_alive=False,
 )
 
 
 class Client:
-    def __init__(self, print_msg=False, msg_per_second=100):
+    def __init__(
+        self,
+        print_msg=False,
+        queue_size=QUEUE_SIZE,
+        drop_policy=BLOCK,
+        nodelay=True,
+        send_buffer=None,
+        recv_buffer=None,
+        on_datapoints=None,
+        lanes=None,
+        flow_window=None,
+        flow_policy=BLOCK,
+        transport=TCP,
+        path=None,
+    ):
         self.__verbose = print_msg
 
-        signal.signal(signal.SIGINT, self.close_connection)  # Signal to end server
-
-        self.__client = CLIENT_PATTERN
+        # Called with every DataPointBatch received, as a DATAPOINT_DTYPE array
+        self.on_datapoints = on_datapoints
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.close_connection)  # Signal to end server
+
+        self.__client = types.SimpleNamespace(**vars(CLIENT_PATTERN))
+        # Control messages go ahead of every data message queued (except ROUTING_COMMANDS,
+        # which keep their place), and `lanes` (type name -> weight) gives message types a
+        # lane of their own, served in weighted round robin
+        self.__client.data = MessageQueue(queue_size, drop_policy, lanes)
+        self.__client.subscriptions = set()  # Patterns confirmed by the server
+
+        # Credit flow control (/flow): at most flow_window data messages sent ahead of the
+        # server's grants, which follow the queues of the recipients. Out of credits, the
+        # flow_policy applies (see SendCredits). Within queue_size, the send queue never
+        # drops a data message
+        self.__flow_window = flow_window
+        self.__credits = None
+        if flow_window is not None:
+            if not 0 < flow_window <= queue_size:
+                raise ValueError(f"Flow window must be within 1 and queue_size ({queue_size})")
+            self.__credits = SendCredits(
+                lambda frame, lane: self.__client.data.put(frame, lane=lane), flow_policy
+            )
+        self.__reader = FrameReader()
+
+        # TCP, or a Unix domain socket (UNIX) or shared-memory rings (SHM) to a server on
+        # the same host, at `path` (by default the path the server names after its port)
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport: {transport}")
+        self.__transport = transport
+        self.__path = path
+
+        # TCP_NODELAY and kernel buffer sizes of the socket (None is the system default)
+        self.__socket_options = dict(
+            nodelay=nodelay, send_buffer=send_buffer, recv_buffer=recv_buffer
+        )
 
         self.__lock = threading.Lock()
 
-        self.__msg_frequency = msg_per_second
+        # Last /stats answer of the server, and its arrival
+        self.__stats = None
+        self.__stats_received = threading.Event()
+
+        # Readers of the message types, and of the control commands, by name
+        self.__readers = {
+            CONTROL_MSG.type_name: self.handle_control_msg,
+            LABEL_STRING.type_name: self.read_label_string,
+            DATAPOINT_BATCH.type_name: self.read_datapoints,
+            STATS.type_name: self.read_stats,
+        }
+        self.__commands = {
+            "/end_connection": self.__end_connection,
+            "/change_peer": self.__change_peer,
+            "/peer_lost": self.__peer_lost,
+            "/change_id": self.__change_id,
+            "/subscribe": self.__subscribed,
+            "/unsubscribe": self.__unsubscribed,
+            "/credit": self.__credit,
+        }
 
         self.__start_client()
 
@@ -43,8 +122,12 @@ class Client:
 
     def __start_client(self):
         try:
-            # Initialize server like a TCP/IP socket
-            self.__client.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Initialize server like a TCP/IP socket (a Unix domain one for the local
+            # transports)
+            self.__client.socket = create_socket(self.__transport)
+
+            # Set before connect(), so the buffer sizes also size the TCP window
+            configure_socket(self.__client.socket, **self.__socket_options)
 
         except Exception as e:
             self.__log_function("Client not started")
@@ -64,7 +147,10 @@ class Client:
             time.sleep(1)
 
             try:
-                self.__client.socket.connect((server_ip, server_port))
+                self.__client.socket.connect(
+                    address(self.__transport, server_ip, server_port, self.__path)
+                )
+                self.__client.socket = connected(self.__transport, self.__client.socket)
                 self.__client.is_alive = True
                 break
 
@@ -85,160 +171,194 @@ class Client:
         # id_msg = ControlMsg('/change_id', self.__client.id).pack_msg()
         # header_id = self.pack_header(id_msg, 'ControlMsg')
 
-        peer_msg = ControlMsg("/change_peer", self.__client.peer).pack_msg()
-        header_peer = self.pack_header(peer_msg, "ControlMsg")
+        peer_frame = CONTROL_MSG.frame("/change_peer", self.__client.peer)
+        self.__client.data.put((peer_frame,), lane=BARRIER)
 
-        self.__client.data.header.append(header_peer)
-        self.__client.data.body.append(peer_msg)
+        if self.__credits is not None:
+            flow_frame = CONTROL_MSG.frame("/flow", str(self.__flow_window))
+            self.__client.data.put((flow_frame,), lane=CONTROL)
 
     def sending_loop(self):
         while self.__client.is_alive:
-            if len(self.__client.data.body) < 1:
-                time.sleep(1 / self.__msg_frequency)
+            # Sleeps until a message is queued (the timeout only rechecks the connection)
+            batch = self.__client.data.get_batch(SEND_BATCH, timeout=1)
+            if not batch:
                 continue
 
             try:
                 self.__log_function("Preparing to send a message...")
-                header = self.__client.data.header.pop(0)
-                data = self.__client.data.body.pop(0)
 
-                self.__client.socket.sendall(header)
-                self.__client.socket.sendall(data)
+                # Frames (or headers and bodies) of everything queued meanwhile, in one
+                # sendmsg call
+                send_buffers(self.__client.socket, [buffer for frame in batch for buffer in frame])
                 self.__log_function("Message sent successfully.")
-            except IndexError:
-                self.__log_function(
-                    "Error: Attempted to send a message from an empty queue."
-                )
             except Exception as e:
                 self.__log_function(f"Error sending message: {e}")
 
-    def send_message(self, message=""):
+    def send_message(self, message="", timeout=None):
+        # Returns False when the message is not sent (dropped, or refused for lack of credit).
+        # timeout bounds the wait of the BLOCK policies (None waits until the connection ends)
         if not self.__client.is_alive:
             self.__log_function("Client is not connected")
-            return
+            return False
 
         try:
             if message.startswith("/"):
                 # Handle control messages
                 control_msg_parts = message.split(" ")
                 control_msg_parts = control_msg_parts[:3]  # Only the first three parts
-                msg = ControlMsg(*(command for command in control_msg_parts)).pack_msg()
-                type_msg = "ControlMsg"
+                frame = CONTROL_MSG.frame(*control_msg_parts)
+                lane = BARRIER if control_msg_parts[0] in ROUTING_COMMANDS else CONTROL
 
             else:
                 # Handle label messages
-                msg = LabelString(self.__client.id, message).pack_msg()
-                type_msg = "LabelString"
+                frame = LABEL_STRING.frame(self.__client.id, message)
+                lane = LABEL_STRING.type_name
+
+            # Add the message (header and body packed together) to the queue
+            if self.queue_frame(frame, lane, timeout):
+                self.__log_function("Message added to send queue.")
+                return True
+            self.__log_function("Message dropped, send queue is full or out of credits.")
+        except Exception as e:
+            self.__log_function(f"Error in send_message: {e}")
+        return False
 
-            # Pack the header
-            header = self.pack_header(msg, type_msg)
+    def send_datapoints(self, records, timeout=None):
+        # records: DATAPOINT_DTYPE array (or tuples in DATAPOINT_FIELDS order), sent as one
+        # DataPointBatch frame of 42 bytes per record
+        if not self.__client.is_alive:
+            self.__log_function("Client is not connected")
+            return False
 
-            # Add the message to the queue
-            with self.__lock:
-                self.__client.data.header.append(header)
-                self.__client.data.body.append(msg)
+        frame = DATAPOINT_BATCH.frame(records)
+        if not self.queue_frame(frame, DATAPOINT_BATCH.type_name, timeout):
+            self.__log_function("DataPointBatch dropped, send queue is full or out of credits.")
+            return False
+        return True
 
-            self.__log_function("Message added to send queue.")
-        except Exception as e:
-            self.__log_function(f"Error in send_message: {e}")
+    def queue_frame(self, frame, lane, timeout=None):
+        # Data frames take a send credit under flow control, commands never wait
+        if self.__credits is None or lane in (CONTROL, BARRIER):
+            return self.__client.data.put((frame,), timeout, lane)
+        return self.__credits.send((frame,), lane, timeout)
+
+    def subscribe(self, pattern):
+        # Receive the messages published to the topic, or to every topic starting with the
+        # prefix when the pattern ends with "*" (e.g. "motor/*")
+        self.send_message(f"/subscribe {pattern}")
+
+    def unsubscribe(self, pattern=""):
+        # Without a pattern, every subscription is dropped
+        self.send_message(f"/unsubscribe {pattern}".rstrip())
+
+    def publish(self, topic=""):
+        # Send the next messages to the subscribers of the topic only (an empty topic goes
+        # back to the peer)
+        self.__client.topic = topic or None
+        self.send_message(f"/publish {topic}".rstrip())
+
+    def get_stats(self, summary=False, timeout=2.0):
+        # Runtime metrics of the server (see Server.get_stats), None when no answer arrives
+        # within the timeout. A summary leaves the other clients out
+        self.__stats_received.clear()
+        self.send_message("/stats summary" if summary else "/stats")
+
+        if not self.__stats_received.wait(timeout):
+            return None
+        return self.__stats
 
     def receiving_loop(self):
         while self.__client.is_alive:
             try:
-                length_message, type_message = self.receive_header()
-
-                if length_message == 0:
-                    self.__log_function("No header received or error in header.")
-                    time.sleep(3)  # Avoid busy waiting
-                    continue
-
-                self.receive_message(length_message, type_message)
+                if not self.receive_frames():
+                    self.__log_function("Connection closed by the server.")
+                    self.__disconnected()
+                    break
 
             except Exception as e:
                 self.__log_function(f"Critical error in receiving loop: {e}")
-                with self.__lock:
-                    self.__client.is_alive = False  # Mark the client as disconnected
+                self.__disconnected()
                 break
 
-    def receive_header(self):
-        header_length = HEADER
-        header = b""
-
-        while len(header) < header_length:
-            try:
-                chunk = self.__client.socket.recv(header_length - len(header))
-                if not chunk:
-                    # Socket was closed by the peer
-                    self.__log_function(
-                        "Connection reset by peer while receiving header."
-                    )
-                    return 0, ""
-                header += chunk
-            except ConnectionResetError as e:
-                self.__log_function(f"Connection reset by peer: {e}")
-                return 0, ""
-            except Exception as e:
-                self.__log_function(f"Error receiving header: {e}")
-                return 0, ""
-
-        try:
-            length_message, type_message = self.unpack_msg(header)
-            return length_message, type_message
-        except Exception as e:
-            self.__log_function(f"Error unpacking header: {e}")
-            return 0, ""
+    def __disconnected(self):
+        # Mark the client as disconnected, and release the senders waiting for room in the
+        # send queue or for a credit: nothing will drain the queue or grant credits anymore.
+        # The queue goes first, a grant may be waiting for room in it under the credits lock
+        with self.__lock:
+            self.__client.is_alive = False
+        self.__client.data.close()
+        if self.__credits is not None:
+            self.__credits.close()
+
+    def receive_frames(self):
+        # One read into the reusable frame buffer, then every complete frame it holds
+        if not self.__reader.recv_from(self.__client.socket):
+            return False
 
-    def receive_message(self, length_message, type_message):
-        body_msg = b""
-        msg_to_receive = length_message
+        for type_message, _, body_msg in self.__reader.frames():
+            self.receive_message(body_msg, type_message)
 
-        while len(body_msg) < length_message:
-            try:
-                chunk = self.__client.socket.recv(msg_to_receive)
-                if not chunk:
-                    # Socket was closed by the peer
-                    self.__log_function(
-                        "Connection reset by peer while receiving message."
-                    )
-                    return False
-                body_msg += chunk
-                msg_to_receive = length_message - len(body_msg)
-            except ConnectionResetError as e:
-                self.__log_function(f"Connection reset by peer: {e}")
-                return False
-            except Exception as e:
-                self.__log_function(f"Error receiving body: {e}")
-                return False
+        return True
 
-        if type_message != "ControlMsg":
-            self.read_message(body_msg, type_message)
+    def receive_message(self, body_msg, type_message):
+        # body_msg is a view of the frame buffer, valid until the next read
+        reader = self.__readers.get(type_message)
+        if reader is None:
+            self.__log_function(f"Unknown message type {type_message}")
         else:
-            self.handle_control_msg(body_msg)
+            reader(body_msg)
 
         return True
 
-    def read_message(self, body_msg, type_message):
-        if type_message == "LabelString":
-            label, string = LabelString().unpack_msg(body_msg)
-            self.__log_function(f"{label}: {string}")
+    def read_label_string(self, body_msg):
+        label, string = LABEL_STRING.unpack(body_msg)
+        self.__log_function(f"{label}: {string}")
+
+    def read_datapoints(self, body_msg):
+        records = DATAPOINT_BATCH.unpack(body_msg)
+        if self.on_datapoints is not None:
+            self.on_datapoints(records)
+        else:
+            self.__log_function(f"DataPointBatch of {len(records)} records")
+
+    def read_stats(self, body_msg):
+        self.__stats = STATS.unpack(body_msg)
+        self.__stats_received.set()
 
     def handle_control_msg(self, body_msg):
-        command, arg1, arg2 = ControlMsg().unpack_msg(body_msg)
+        command, arg1, arg2 = CONTROL_MSG.unpack(body_msg)
+
+        handler = self.__commands.get(command)
+        if handler is not None:
+            handler(arg1)
+
+    def __end_connection(self, arg1):
+        self.close_connection()
+
+    def __change_peer(self, arg1):
+        self.__client.peer = arg1
+        self.__log_function(f"Peer changed to {arg1}")
 
-        if command == "/end_connection":
-            self.close_connection()
+    def __peer_lost(self, arg1):
+        self.__client.peer = "broadcast"
+        self.__log_function("Peer lost. Changed to broadcast")
 
-        if command == "/change_peer":
-            self.__client.peer = arg1
-            self.__log_function(f"Peer changed to {arg1}")
+    def __change_id(self, arg1):
+        self.__client.id = arg1
+        self.__log_function(f"ID changed to {arg1}")
 
-        if command == "/peer_lost":
-            self.__client.peer = "broadcast"
-            self.__log_function("Peer lost. Changed to broadcast")
+    def __subscribed(self, arg1):
+        self.__client.subscriptions.add(arg1)
+        self.__log_function(f"Subscribed to {arg1}")
 
-        if command == "/change_id":
-            self.__client.id = arg1
-            self.__log_function(f"ID changed to {arg1}")
+    def __unsubscribed(self, arg1):
+        self.__client.subscriptions.discard(arg1)
+        self.__log_function(f"Unsubscribed from {arg1}")
+
+    def __credit(self, arg1):
+        if self.__credits is not None:
+            self.__credits.grant(int(arg1))
 
     def close_connection(self, signal_received=None, frame=None):
         if signal_received is not None:
@@ -248,7 +368,7 @@ class Client:
             exit(0)
             return
 
-        self.__client.is_alive = False
+        self.__disconnected()
         self.__client.socket.close()
         self.__log_function("Connection closed")
         exit(0)
@@ -271,3 +391,16 @@ class Client:
 
     def client_is_alive(self):
         return self.__client.is_alive
+
+    def get_subscriptions(self):
+        return sorted(self.__client.subscriptions)
+
+    def get_dropped(self):
+        # Messages lost to the drop policy of the send queue, or replaced while waiting for
+        # a send credit (COALESCE)
+        coalesced = 0 if self.__credits is None else self.__credits.coalesced
+        return self.__client.data.dropped + coalesced
+
+    def get_credits(self):
+        # Send credits left, None without flow control
+        return None if self.__credits is None else self.__credits.available
@@ -1,61 +1,297 @@
+import json
 import struct
 
+from framing import FORMAT, HEADER, HEADER_FORMAT
+
+try:
+    import numpy as np
+except ImportError:  # DataPointBatch then works with lists of tuples
+    np = None
+
+HEADER_STRUCT = struct.Struct(HEADER_FORMAT)
+
+
+def _text_fields(count):
+    """
+    Encoder and decoder of `count` text fields. Unrolled for the field counts of the
+    registered types: a comprehension over the fields costs more than the struct call.
+    Missing fields are empty.
+    """
+    def strip(field):
+        return field.rstrip(b'\x00').decode(FORMAT)
+
+    if count == 2:
+        def encode(first='', second=''):
+            return first.encode(FORMAT), second.encode(FORMAT)
+
+        def decode(fields):
+            first, second = fields
+            return strip(first), strip(second)
+
+    elif count == 3:
+        def encode(first='', second='', third=''):
+            return first.encode(FORMAT), second.encode(FORMAT), third.encode(FORMAT)
+
+        def decode(fields):
+            first, second, third = fields
+            return strip(first), strip(second), strip(third)
+
+    else:
+        def encode(*fields):
+            if len(fields) > count:
+                raise TypeError(f'{count} fields, got {len(fields)}')
+            return [field.encode(FORMAT) for field in fields] + [b''] * (count - len(fields))
+
+        def decode(fields):
+            return tuple([strip(field) for field in fields])
+
+    return encode, decode
+
+
+class TextCodec:
+    """
+    Encoder/decoder of a message made of fixed-size text fields, padded with '\\x00'.
+
+    The struct of the body, and the one of the whole frame (header + body), are compiled
+    once: pack() and frame() are a single struct call, and pack_into() writes the body
+    straight into an outgoing buffer. A codec holds no state of the message it packs, so
+    one instance serves every thread.
+    """
+    __slots__ = (
+        'type_id', 'type_name', 'type_bytes', 'sizes', 'size', '_encode', '_decode', '_body', '_frame'
+    )
+
+    def __init__(self, type_id, type_name, sizes):
+        fields = ''.join(f'{size}s' for size in sizes)
+
+        self.type_id = type_id
+        self.type_name = type_name
+        self.type_bytes = type_name.encode(FORMAT)
+        self.sizes = tuple(sizes)
+        self._encode, self._decode = _text_fields(len(self.sizes))
+        self._body = struct.Struct(fields)
+        self.size = self._body.size
+        self._frame = struct.Struct(HEADER_FORMAT + fields)  # Set last, then the codec is frozen
+
+    def __setattr__(self, name, value):
+        if hasattr(self, '_frame'):
+            raise AttributeError(f'{type(self).__name__} is immutable')
+        object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        return f'TextCodec({self.type_id}, {self.type_name!r}, {self.sizes})'
+
+    def pack(self, *fields):
+        # Missing fields are empty, longer ones are cut to their size
+        return self._body.pack(*self._encode(*fields))
+
+    def pack_into(self, buffer, offset, *fields):
+        # Returns the offset after the body
+        self._body.pack_into(buffer, offset, *self._encode(*fields))
+        return offset + self.size
+
+    def frame(self, *fields):
+        # Header and body of a whole frame, in one struct call
+        return self._frame.pack(self.size, self.type_bytes, *self._encode(*fields))
+
+    def frame_into(self, buffer, offset, *fields):
+        self._frame.pack_into(buffer, offset, self.size, self.type_bytes, *self._encode(*fields))
+        return offset + HEADER + self.size
+
+    def unpack(self, data):
+        return self._decode(self._body.unpack(data))
+
+
+# DataPoint tuple of the manipulator controller (PackedDataPoint in main.cpp): 42 bytes per
+# record, no padding, little-endian on the wire
+DATAPOINT_FIELDS = (
+    ('time_us', 'Q'),
+    ('pulse_qc', 'i'),
+    ('setpoint_current_mA', 'd'),
+    ('actual_current_mA', 'h'),
+    ('epos_velocity_unfiltered_rpm', 'i'),
+    ('calculated_velocity_rad/s', 'f'),
+    ('tracked_reference', 'f'),
+    ('event_max_error', 'f'),
+    ('event_error', 'f'),
+)
+DATAPOINT_STRUCT = struct.Struct('<' + ''.join(code for _, code in DATAPOINT_FIELDS))
+
+if np is not None:
+    DATAPOINT_DTYPE = np.dtype([(name, '<' + code) for name, code in DATAPOINT_FIELDS])
+
+
+class DataPointCodec:
+    """
+    Encoder/decoder of a batch of DataPoint records, sent as their packed bytes one after
+    the other (the frame length gives the number of records).
+
+    records is a NumPy array of DATAPOINT_DTYPE (copied with a single tobytes, or a single
+    array assignment into a buffer) or a sequence of tuples in DATAPOINT_FIELDS order.
+    unpack returns a DATAPOINT_DTYPE array, or a list of tuples without NumPy.
+    """
+    __slots__ = ('type_id', 'type_name', 'type_bytes')
+
+    record_size = DATAPOINT_STRUCT.size
+
+    def __init__(self, type_id, type_name='DataPointBatch'):
+        object.__setattr__(self, 'type_id', type_id)
+        object.__setattr__(self, 'type_name', type_name)
+        object.__setattr__(self, 'type_bytes', type_name.encode(FORMAT))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __repr__(self):
+        return f'DataPointCodec({self.type_id}, {self.type_name!r})'
+
+    def pack(self, records):
+        if np is not None and isinstance(records, np.ndarray):
+            return records.astype(DATAPOINT_DTYPE, copy=False).tobytes()
+
+        data = bytearray(self.record_size * len(records))
+        self.pack_into(data, 0, records)
+        return bytes(data)
+
+    def pack_into(self, buffer, offset, records):
+        # Returns the offset after the records
+        if np is not None and isinstance(records, np.ndarray):
+            np.frombuffer(buffer, DATAPOINT_DTYPE, len(records), offset)[:] = records
+        else:
+            for k, record in enumerate(records):
+                DATAPOINT_STRUCT.pack_into(buffer, offset + k * self.record_size, *record)
+        return offset + self.record_size * len(records)
+
+    def frame(self, records):
+        data = bytearray(HEADER + self.record_size * len(records))
+        HEADER_STRUCT.pack_into(data, 0, len(data) - HEADER, self.type_bytes)
+        self.pack_into(data, HEADER, records)
+        return bytes(data)
+
+    def frame_into(self, buffer, offset, records):
+        HEADER_STRUCT.pack_into(buffer, offset, self.record_size * len(records), self.type_bytes)
+        return self.pack_into(buffer, offset + HEADER, records)
+
+    def unpack(self, data):
+        if len(data) % self.record_size:
+            raise ValueError(f'{self.type_name} of {len(data)} bytes is not a whole number of records')
+
+        if np is not None:
+            # Copied out of data, which may be a view of a receive buffer
+            return np.frombuffer(data, dtype=DATAPOINT_DTYPE).copy()
+        return list(DATAPOINT_STRUCT.iter_unpack(data))
+
+
+class JsonCodec:
+    """
+    Encoder/decoder of a message carrying one JSON document (its length is the frame's).
+    """
+    __slots__ = ('type_id', 'type_name', 'type_bytes')
+
+    def __init__(self, type_id, type_name):
+        object.__setattr__(self, 'type_id', type_id)
+        object.__setattr__(self, 'type_name', type_name)
+        object.__setattr__(self, 'type_bytes', type_name.encode(FORMAT))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __repr__(self):
+        return f'JsonCodec({self.type_id}, {self.type_name!r})'
+
+    def pack(self, document):
+        return json.dumps(document, separators=(',', ':')).encode(FORMAT)
+
+    def frame(self, document):
+        body = self.pack(document)
+        return HEADER_STRUCT.pack(len(body), self.type_bytes) + body
+
+    def unpack(self, data):
+        return json.loads(bytes(data).decode(FORMAT))
+
+
+# Registry of the message types: the codec of a type, by type name (as in the frame header)
+# or by numeric id
+CODECS = {}
+CODECS_BY_ID = {}
+
+
+def register(codec):
+    if codec.type_name in CODECS or codec.type_id in CODECS_BY_ID:
+        raise ValueError(f'Message type {codec.type_name} ({codec.type_id}) already registered')
+    if len(codec.type_bytes) > HEADER - 4:  # The 20 bytes after the length
+        raise ValueError(f'Type name {codec.type_name} does not fit the header')
+
+    CODECS[codec.type_name] = codec
+    CODECS_BY_ID[codec.type_id] = codec
+    return codec
+
+
+def get_codec(type_message):
+    # Codec of a type name or numeric id, None when the type is not registered
+    if isinstance(type_message, int):
+        return CODECS_BY_ID.get(type_message)
+    return CODECS.get(type_message)
+
+
+CONTROL_MSG = register(TextCodec(1, 'ControlMsg', (20, 20, 20)))
+LABEL_STRING = register(TextCodec(2, 'LabelString', (20, 80)))
+DATAPOINT_BATCH = register(DataPointCodec(3, 'DataPointBatch'))
+STATS = register(JsonCodec(4, 'Stats'))  # Answer to /stats
+
+
 class LabelString:
     def __init__(self, label='', string_msg=''):
         self.__label = label
         self.__string = string_msg
-        self.__pattern = f'20s80s'
 
     def pack_msg(self):
-        self.__label = self.__label.encode('utf-8')
-        self.__label = self.__label.ljust(20, b"\x00")
-
-        self.__string = self.__string.encode('utf-8')
-        self.__string = self.__string.ljust(80, b"\x00")
+        return LABEL_STRING.pack(self.__label, self.__string)
 
-        return struct.pack(self.__pattern, self.__label, self.__string)
-    
     def unpack_msg(self, data):
-        self.__label, self.__string = struct.unpack(self.__pattern, data)
-        self.__label = self.__label.decode('utf-8').strip('\x00')
-        self.__string = self.__string.decode('utf-8').strip('\x00')
+        self.__label, self.__string = LABEL_STRING.unpack(data)
 
         return self.__label, self.__string
 
+    def __str__(self):
+        return f'Label: {self.__label}, String: {self.__string}'
+
+    def __repr__(self):
+        return str(self)
+
+
 class ControlMsg:
     def __init__(self, command='', arg1 ='', arg2=''):
         self.__command = command
         self.__arg1 = arg1
         self.__arg2 = arg2
-        self.__pattern = '20s20s20s'
-    
-    def setup_msg(self):
-        self.__command = self.__command.encode('utf-8')
-        self.__command = self.__command.ljust(20, b"\x00")
-
-        self.__arg1 = self.__arg1.encode('utf-8')
-        self.__arg1 = self.__arg1.ljust(20, b"\x00")
-
-        self.__arg2 = self.__arg2.encode('utf-8')
-        self.__arg2 = self.__arg2.ljust(20, b"\x00")
 
     def pack_msg(self):
-        self.setup_msg()
-        return struct.pack(self.__pattern, 
-                           self.__command, 
-                           self.__arg1, 
-                           self.__arg2)
+        return CONTROL_MSG.pack(self.__command, self.__arg1, self.__arg2)
 
     def unpack_msg(self, data):
-        self.__command, self.__arg1, self.__arg2 = struct.unpack(self.__pattern, data)
-        self.__command = self.__command.decode('utf-8').strip('\x00')
-        self.__arg1 = self.__arg1.decode('utf-8').strip('\x00')
-        self.__arg2 = self.__arg2.decode('utf-8').strip('\x00')
+        self.__command, self.__arg1, self.__arg2 = CONTROL_MSG.unpack(data)
 
         return self.__command, self.__arg1, self.__arg2
 
     def __str__(self):
-        return f'Control: {self.control}, String: {self.string}'
+        return f'Control: {self.__command}, Args: {self.__arg1} {self.__arg2}'
 
     def __repr__(self):
-        return str(self)
\ No newline at end of file
+        return str(self)
+
+
+class DataPointBatch:
+    """
+    Batch of DataPoint records (see DataPointCodec).
+    """
+    def __init__(self, records=()):
+        self.__records = records
+
+    def pack_msg(self):
+        return DATAPOINT_BATCH.pack(self.__records)
+
+    def unpack_msg(self, data):
+        self.__records = DATAPOINT_BATCH.unpack(data)
+
+        return self.__records
@@ -1,10 +1,22 @@
+import itertools
+import json
+import os
 import socket
+import selectors
 import threading
 import struct
 import signal, types
 import time
 
-from simple_msg import ControlMsg
+from simple_msg import CONTROL_MSG, STATS
+from message_queue import MessageQueue, CONTROL, DATA, DROP_OLDEST, DROP_NEWEST
+from framing import (
+    FrameReader, FrameTooLarge, IOV_MAX, configure_socket, send_available, send_buffers,
+    split_frames,
+)
+from routing import BROADCAST, RoutingTable, TopicIndex
+from metrics import ConnectionStats
+from transport import TCP, SHM, TRANSPORTS, accepted, address, create_socket
 
 HEADER = 24
 HEADER_FORMAT = "!I20s"
@@ -14,28 +26,128 @@ SERVER_PATTERN = types.SimpleNamespace(
     socket=None,
     ip="127.0.0.1",
     port=5050,
+    address=None,
     is_alive=False,
     clients_connected={},
 )
-OVERHEAD = 10
-DISCARD = 2
+OVERHEAD = 10  # Frames queued for a client before the drop policy applies
+
+# Slow consumer policy, besides DROP_OLDEST and DROP_NEWEST: disconnect the client whose
+# queue is full
+DISCONNECT = "disconnect"
+
+# Non-blocking flag of a single send on a blocking socket (0 where it does not exist)
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+# I/O modes: two threads per client, or every client served by one selector loop
+THREADS = "threads"
+SELECTOR = "selector"
 
 
 class Server:
-    def __init__(self, ip=None, port=None, print_msg=False, msg_per_second=100):
+    def __init__(
+        self,
+        ip=None,
+        port=None,
+        print_msg=False,
+        msg_per_second=100,
+        mode=THREADS,
+        queue_size=OVERHEAD,
+        drop_policy=DROP_OLDEST,
+        nodelay=True,
+        send_buffer=None,
+        recv_buffer=None,
+        stats_file=None,
+        stats_interval=10.0,
+        lanes=None,
+        transport=TCP,
+        path=None,
+    ):
 
         # Public attributes
         self.lock = threading.Lock()  # Lock for threads
 
-        signal.signal(signal.SIGINT, self.end_server)  # Signal to end server
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.end_server)  # Signal to end server
 
         # Print attributes
         self.__verbose = print_msg  # Print messages
 
         self.__msg_frequency = msg_per_second  # Messages per second
 
+        if mode not in (THREADS, SELECTOR):
+            raise ValueError(f"Unknown server mode: {mode}")
+        self.__mode = mode
+
+        # TCP, or for clients on the same host a Unix domain socket (UNIX) or shared-memory
+        # rings (SHM), at `path` (by default a path named after the port, see unix_path)
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport: {transport}")
+        self.__transport = transport
+
+        # Per-client queue of frames waiting to be written to it. A client that does not
+        # keep up fills its own queue and is shed by the policy, the others are not delayed
+        # (so blocking on a full queue is not an option)
+        if drop_policy not in (DROP_OLDEST, DROP_NEWEST, DISCONNECT):
+            raise ValueError(f"Unsupported drop policy for the server: {drop_policy}")
+        self.__queue_size = queue_size
+        self.__drop_policy = drop_policy
+
+        # Lanes of the client queues: the frames the server sends itself (control) go ahead
+        # of the forwarded ones, and `lanes` (type name -> weight) gives message types a
+        # data lane of their own, served in weighted round robin. Other types share one lane
+        self.__lanes = dict(lanes or {})
+        self.__shed = 0  # Clients disconnected by the DISCONNECT policy
+
+        # Credit flow control (/flow): the clients whose grant waits for a recipient of
+        # their frames to drain its queue below the high water mark
+        self.__high_water = max(1, queue_size // 2)
+        self.__throttled = {}  # id(client) -> client
+
+        # Runtime metrics (see get_stats): the counters of every connection, plus those of
+        # the clients already gone. stats_file gets a snapshot every stats_interval seconds
+        self.__started = time.time()
+        self.__accepted = 0
+        self.__closed_stats = ConnectionStats()
+        self.__closed_dropped = 0
+        self.__stats_file = stats_file
+        self.__stats_interval = stats_interval
+
+        # Default client ids: never reused, unlike the number of connected clients, which
+        # drops as clients disconnect or are shed
+        self.__client_numbers = itertools.count()
+
+        # Options of every client socket: TCP_NODELAY and kernel buffer sizes (None is the
+        # system default)
+        self.__socket_options = dict(
+            nodelay=nodelay, send_buffer=send_buffer, recv_buffer=recv_buffer
+        )
+
         # Private attributes
-        self.__server = SERVER_PATTERN
+        self.__server = types.SimpleNamespace(**vars(SERVER_PATTERN))
+        self.__server.clients_connected = RoutingTable()
+        self.__topics = TopicIndex()  # /subscribe patterns of the clients
+
+        # Message types the server reads itself (every other type is forwarded as it
+        # arrived), and the control commands, by name
+        self.__handlers = {CONTROL_MSG.type_name: self.handle_control_msg}
+        self.__commands = {
+            "/change_peer": self.__change_peer,
+            "/change_id": self.__change_id,
+            "/subscribe": self.__subscribe,
+            "/unsubscribe": self.__unsubscribe,
+            "/publish": self.__publish,
+            "/stats": self.__stats,
+            "/flow": self.__flow,
+        }
+
+        # Selector mode: readiness of every socket, plus a socketpair to wake the loop up
+        # when another thread queues frames for a client
+        self.__selector = None
+        self.__wakeup = None
+        self.__wakeup_pending = False
+        self.__loop_thread = None
+        self.__dirty = {}  # Clients with newly queued frames, flushed once per loop pass
 
         if ip is not None:
             self.__server.ip = ip
@@ -43,6 +155,8 @@ class Server:
         if port is not None:
             self.__server.port = port
 
+        self.__server.address = address(transport, self.__server.ip, self.__server.port, path)
+
         self.__start_server()  # Start server
 
     def __log_function(self, msg):
@@ -51,14 +165,29 @@ class Server:
 
     def __start_server(self):
         try:
-            # Initialize server like a TCP/IP socket
-            self.__server.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-            # Set server to reuse address and port for restart events
-            self.__server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Initialize server like a TCP/IP socket (a Unix domain one for the local
+            # transports, the shared-memory rings are set up over it)
+            self.__server.socket = create_socket(self.__transport)
+
+            if self.__transport == TCP:
+                # Set server to reuse address and port for restart events
+                self.__server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            elif os.path.exists(self.__server.address):
+                os.unlink(self.__server.address)  # Left by a server that did not end cleanly
+
+            # Buffer sizes set before listen() are inherited by the accepted sockets, and
+            # size the TCP window they negotiate
+            if self.__socket_options["send_buffer"] is not None:
+                self.__server.socket.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_SNDBUF, self.__socket_options["send_buffer"]
+                )
+            if self.__socket_options["recv_buffer"] is not None:
+                self.__server.socket.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_RCVBUF, self.__socket_options["recv_buffer"]
+                )
 
-            # Bind server to ip and port
-            self.__server.socket.bind((self.__server.ip, self.__server.port))
+            # Bind server to ip and port (the socket path for the local transports)
+            self.__server.socket.bind(self.__server.address)
 
             # Start listening for connections
             self.__server.socket.listen()
@@ -69,11 +198,18 @@ class Server:
 
         self.__server.is_alive = True
         self.__log_function(
-            f"Server started at {self.__server.ip}:{self.__server.port}"
+            f"Server started at {self.__server.address} ({self.__mode} mode, {self.__transport})"
         )
 
-        # start a accepting thread
-        threading.Thread(target=self.accept_connections).start()
+        if self.__stats_file is not None:
+            threading.Thread(target=self.dump_stats, daemon=True).start()
+
+        if self.__mode == SELECTOR:
+            # start the event loop serving every client
+            self.__start_selector()
+        else:
+            # start a accepting thread
+            threading.Thread(target=self.accept_connections).start()
 
         while not self.__server.is_alive:
             time.sleep(1 / self.__msg_frequency)
@@ -85,42 +221,137 @@ class Server:
         if self.__server.socket is not None:
             self.warning_down_server()
             self.__server.socket.close()
+            if self.__transport != TCP and os.path.exists(self.__server.address):
+                os.unlink(self.__server.address)
             self.__server.is_alive = False
             self.__log_function("Server ended")
             exit(0)
 
     def warning_down_server(self):
-        for client_id, client in self.__server.clients_connected.items():
+        frame = CONTROL_MSG.frame("/end_connection")
+
+        for client_id, client in list(self.__server.clients_connected.items()):
             try:
-                msg = ControlMsg("/end_connection").pack_msg()
-                header = self.pack_header(msg, "ControlMsg")
-                client.socket.sendall(header)
-                client.socket.sendall(msg)
+                # The writers stop with the server, write what is left here
+                with client.send_lock:
+                    client.socket.setblocking(True)
+                    send_buffers(
+                        client.socket,
+                        client.unsent + client.data.get_batch(timeout=0) + [frame],
+                    )
             except Exception as e:
                 self.__log_function(f"Error sending warning to {client_id}: {e}")
 
+    def send_frames(self, client, *buffers, lane=CONTROL):
+        # buffers are the headers and bodies of one or more frames (or whole frames). The
+        # server's own frames go in the control lane, forwarded ones in their type's lane
+        frame = buffers[0] if len(buffers) == 1 else b"".join(buffers)
+
+        if not self.queue_frame(client, frame, lane):
+            self.shed_client(client)
+
+    def queue_frame(self, client, frame, lane=CONTROL):
+        # Hands an encoded frame to the client's writer. frame may be a view of a receive
+        # buffer: it is only copied when it has to wait in the queue. Returns False when the
+        # client is a slow consumer to be disconnected
+        if self.__write_through(client, frame):
+            return True
+
+        return self.__enqueue(
+            client, split_frames(frame if isinstance(frame, bytes) else bytes(frame)), lane
+        )
+
+    def __enqueue(self, client, frames, lane):
+        # frames: the frames of a run, queued one by one so that queue_size, the drop
+        # policy and the dropped counters count frames
+        if client.data.full(lane) and threading.current_thread() is self.__loop_thread:
+            # Full only because the loop has not flushed it during this pass yet: the client
+            # is slow if its socket does not take the queued frames either
+            self.__flush_client(client)
+
+        client.stats.queued()
+        queued = client.data.put_many(frames, lane=lane)
+        self.__writer_wakeup(client)
+
+        return queued == len(frames) or self.__drop_policy != DISCONNECT
+
+    def __write_through(self, client, frame):
+        # Writes the frame right away, without waking the writer up, when nothing is waiting
+        # for the client and its writer is idle. Never blocks: returns False when the frame
+        # has to be queued
+        if self.__mode == THREADS and not MSG_DONTWAIT:
+            return False
+        if not client.send_lock.acquire(blocking=False):
+            return False
+
+        try:
+            if client.unsent or len(client.data):
+                return False  # Keep the order of the frames already waiting
+
+            try:
+                sent = client.socket.send(frame, MSG_DONTWAIT)
+            except (BlockingIOError, OSError):
+                return False
+            client.stats.written(sent)
+
+            if sent < len(frame):
+                # The writer sends the rest before anything queued after it (copied out
+                # of a receive buffer, which the next read overwrites)
+                rest = memoryview(frame)[sent:]
+                client.unsent = [rest if isinstance(frame, bytes) else bytes(rest)]
+                if self.__mode == THREADS:
+                    client.data.wake()
+                else:
+                    self.__writer_wakeup(client)
+
+            return True
+        finally:
+            client.send_lock.release()
+
+    def shed_client(self, client):
+        if client.data.is_closed():
+            return  # Already disconnected
+
+        self.__log_function(f"Client {client.id} does not keep up, disconnecting")
+        self.__shed += 1
+        self.remove_client(client)
+
+    def __writer_wakeup(self, client):
+        # Threads mode: the client's writer thread is woken up by its queue
+        if self.__mode == THREADS:
+            return
+
+        with self.lock:
+            self.__dirty[id(client)] = client
+            wakeup = (
+                not self.__wakeup_pending
+                and threading.current_thread() is not self.__loop_thread
+            )
+            if wakeup:
+                self.__wakeup_pending = True
+
+        if wakeup:
+            # One byte wakes the loop for every frame queued until it runs
+            self.__wakeup[1].send(b"\0")
+
     def accept_connections(self):
         while self.__server.is_alive:
             try:
                 client_socket, address = self.__server.socket.accept()
                 # client_socket.settimeout(10)  # Optional: Prevent hanging connections
 
+                configure_socket(client_socket, **self.__socket_options)
+                client_socket = accepted(self.__transport, client_socket)
+
                 current_client = self.add_new_client(client_socket, address)
                 self.__log_function(f"New connection from {address}")
 
                 # Send welcome message
-                command_msg = ControlMsg("/new_peer", current_client.id).pack_msg()
-                header = self.pack_header(command_msg, "ControlMsg")
+                new_peer = CONTROL_MSG.frame("/new_peer", current_client.id)
+                self.send_broadcast(current_client, new_peer, lane=CONTROL)
 
-                self.send_broadcast(
-                    client=current_client, header=header, msg=command_msg
-                )
-
-                id_name = ControlMsg("/change_id", current_client.id).pack_msg()
-                header_id = self.pack_header(id_name, "ControlMsg")
-
-                current_client.socket.sendall(header_id)
-                current_client.socket.sendall(id_name)
+                id_name = CONTROL_MSG.frame("/change_id", current_client.id)
+                self.send_frames(current_client, id_name)
 
                 # Start threads for client handling
                 threading.Thread(
@@ -137,116 +368,148 @@ class Server:
 
     def add_new_client(self, client_socket, address):
         current_client = types.SimpleNamespace(
-            socket=None, addr=None, id="", data=None, peer="broadcast", is_alive=True
+            socket=None, addr=None, id="", data=None, peer=BROADCAST, is_alive=True
         )
+        current_client.topic = None  # Set by /publish, then it overrides peer
         current_client.socket = client_socket
         current_client.addr = address
-        current_client.id = f"client_{len(self.__server.clients_connected)}"
-        current_client.data = types.SimpleNamespace(header=[], body=[])
-
-        with threading.Lock():
-            self.__server.clients_connected[current_client.id] = current_client
+        # Frames waiting to be written to the client (DISCONNECT drops the new frame, then
+        # the client)
+        current_client.data = MessageQueue(
+            self.__queue_size,
+            DROP_NEWEST if self.__drop_policy == DISCONNECT else self.__drop_policy,
+            self.__lanes,
+        )
+        # Reusable receive buffer, and what the last write left unsent
+        current_client.reader = FrameReader()
+        current_client.send_lock = threading.Lock()
+        current_client.unsent = []
+        current_client.stats = ConnectionStats()
+        # Selector event of a client that has frames left to write. A shared-memory
+        # connection has room again when the client rings, which comes as a read
+        current_client.write_event = 0 if self.__transport == SHM else selectors.EVENT_WRITE
+        # Send credits (/flow): at most `window` data frames in flight, `credits` of them
+        # still granted to the client. A window of 0 is no flow control
+        current_client.window = 0
+        current_client.credits = 0
+
+        self.__accepted += 1
+
+        # Skips the numbers a client took with /change_id
+        current_client.id = f"client_{next(self.__client_numbers)}"
+        while not self.__server.clients_connected.add(current_client):
+            current_client.id = f"client_{next(self.__client_numbers)}"
 
         # Send new client broadcast
-        msg = ControlMsg("/new_peer", current_client.id).pack_msg()
-        header = self.pack_header(msg, "ControlMsg")
-        self.send_broadcast(client=current_client, header=header, msg=msg)
+        new_peer = CONTROL_MSG.frame("/new_peer", current_client.id)
+        self.send_broadcast(current_client, new_peer, lane=CONTROL)
 
         return current_client
 
     def handle_client(self, client):
         while self.__server.is_alive:
-            try:
-                length_message, type_message, header = self.receive_header(client)
-
-                if not header:
-                    self.__log_function("No header received")
-                    break
-
-            except Exception as e:
-                self.__log_function(f"Error receiving header: {e}")
-                break
-
-            if not self.receive_message(client, length_message, type_message, header):
+            if not self.receive_frames(client):
                 break
 
-    def receive_header(self, client):
-        header_length = HEADER
-        header = b""
-
-        while len(header) < header_length:
-            try:
-                # Receives the header
-                chunk = client.socket.recv(header_length - len(header))
-                if not chunk:
-                    # If the client disconnects while receiving the header
-                    self.__log_function("Client disconnected while receiving header.")
-                    self.remove_client(client)
-                    return 0, "", b""
-
-                header += chunk
-
-            except Exception as e:
-                self.__log_function(header)
-                self.__log_function(f"Error receiving header: {e}")
-                return 0, "", b""
-
+    def receive_frames(self, client):
+        # One read into the client's frame buffer, then every complete frame it holds
         try:
-            # Unpack the header
-            length_message, type_message = self.unpack_header(header)
-            return length_message, type_message, header
+            received = client.reader.recv_from(client.socket)
+            if not received:
+                self.__log_function("Client disconnected.")
+                self.remove_client(client)
+                return False  # Indicates failure in receiving
 
+        except BlockingIOError:
+            return True
         except Exception as e:
-            self.__log_function(f"Error unpacking header: {e}")
-            return 0, "", b""
+            self.__log_function(f"Error receiving from {client.id}: {e}")
+            self.remove_client(client)
+            return False  # Indicates failure in receiving
 
-    def receive_message(self, client, length_message, type_message, header):
-        body_msg = b""
-        msg_to_receive = length_message
-
-        while len(body_msg) < length_message:
-            try:
-                # Receive the remaining part of the message
-                chunk = client.socket.recv(msg_to_receive)
-                if not chunk:
-                    # Client disconnected
-                    self.__log_function("Client disconnected while receiving body.")
-                    return False  # Indicates failure in receiving
+        stats = client.stats
+        stats.bytes_in += received
+        start = time.perf_counter_ns()
+        parsed = 0
 
-                body_msg += chunk
-                msg_to_receive = length_message - len(body_msg)
+        try:
+            # Only the types the server reads are cut out, the data frames in between
+            # come as runs and go out unparsed
+            for type_message, frame, body_msg in client.reader.frames(self.__handlers):
+                if body_msg is not None:
+                    parsed += 1
+                try:
+                    self.receive_message(client, type_message, frame, body_msg)
+                except Exception as e:
+                    # Only this frame is lost: the ones after it in the buffer may not get
+                    # another read to be handled on
+                    self.__log_function(f"Error handling message from {client.id}: {e}")
+        except FrameTooLarge as e:
+            # The rest of the stream cannot be framed
+            self.__log_function(f"Dropping {client.id}: {e}")
+            self.remove_client(client)
+            return False
+
+        if stats.frames_in != client.reader.count:
+            if client.window:
+                # Every data frame took one of the client's credits
+                self.take_credits(client, client.reader.count - stats.frames_in - parsed)
+            stats.frames_in = client.reader.count
+            stats.forward.record(time.perf_counter_ns() - start)
 
-            except Exception as e:
-                self.__log_function(f"Error receiving body: {e}")
-                return False  # Indicates failure in receiving
+        return True  # Indicates successful reception
 
-        if type_message != "ControlMsg":
-            # Store the received data in the client
-            client.data.header.append(header)
-            client.data.body.append(body_msg)
-            return True  # Indicates successful reception
+    def receive_message(self, client, type_message, frame, body_msg):
+        # frame and body_msg are views of the client's frame buffer. A run of data frames
+        # of one type comes with body_msg None
+        handler = self.__handlers.get(type_message)
+        if handler is not None:
+            handler(client, body_msg, frame)
+            return
 
-        # Handle control messages
-        self.handle_control_msg(client, body_msg, header)
-        return True  # Indicates successful reception
+        # Cut-through: the frames go from the receive buffer to the recipients' sockets,
+        # and are only copied for the recipients that have to queue them (in the lane of
+        # their type, DATA when the type has none)
+        if client.topic is not None:
+            self.send_to_topic(client, frame, lane=type_message)
+        elif client.peer == BROADCAST:
+            self.send_broadcast(client, frame, lane=type_message)
+        else:
+            self.send_to_peer(client, frame, lane=type_message)
 
     def remove_client(self, client):
-        with threading.Lock():
-            self.update_peer_lost(client.id)
-            self.__server.clients_connected.pop(client.id)
-            client.socket.close()
-            self.__log_function(f"Client {client.id} disconnected")
+        orphans = self.__server.clients_connected.remove(client)
+        if orphans is None:
+            return  # Already removed
+
+        client.data.close()
+        self.__topics.unsubscribe(client)
+        with self.lock:
+            self.__closed_stats.merge(client.stats)
+            self.__closed_dropped += client.data.dropped
+            self.__throttled.pop(id(client), None)
+        if self.__selector is not None:
+            try:
+                self.__selector.unregister(client.socket)
+            except (KeyError, ValueError):
+                pass
+        client.socket.close()
+        self.__log_function(f"Client {client.id} disconnected")
+
+        self.update_peer_lost(client.id, orphans)
 
-    def update_peer_lost(self, client_id):
-        for _, client in self.__server.clients_connected.items():
-            if client.peer == client_id:
-                lost_msg = ControlMsg("/peer_lost", client_id).pack_msg()
-                header = self.pack_header(lost_msg, "ControlMsg")
+        if self.__throttled:
+            self.release_credits()  # It may have been the congested recipient
+
+    def update_peer_lost(self, client_id, orphans):
+        # orphans are the clients that targeted client_id, already back to broadcast
+        if not orphans:
+            return
 
-                client.socket.sendall(header)
-                client.socket.sendall(lost_msg)
+        lost_frame = CONTROL_MSG.frame("/peer_lost", client_id)
 
-                client.peer = "broadcast"
+        for client in orphans:
+            self.send_frames(client, lost_frame)
 
     def pack_header(self, message, type_message):
         # Get the length of the message and the type of the message
@@ -265,90 +528,373 @@ class Server:
 
         return length_message, type_message
 
-    def send_to_peer(self, client, msg, header):
-        with threading.Lock():
-            peer = next(
-                (
-                    peer_client
-                    for peer_client in self.__server.clients_connected.keys()
-                    if peer_client == client.peer
-                ),
-                None,
-            )
+    def send_to_peer(self, client, *buffers, lane=DATA):
+        peer = self.__server.clients_connected.get(client.peer)
 
-            if peer is None:
-                self.__log_function(f"Peer {client.peer} not found")
-                return
+        if peer is None:
+            self.__log_function(f"Peer {client.peer} not found")
+            return
 
-            try:
-                peer = self.__server.clients_connected[peer]
-                peer.socket.sendall(header)
-                peer.socket.sendall(msg)
-            except Exception as e:
-                self.__log_function(f"Error sending to peer {client.peer}: {e}")
+        try:
+            self.send_frames(peer, *buffers, lane=lane)
+        except Exception as e:
+            self.__log_function(f"Error sending to peer {client.peer}: {e}")
 
-    def send_broadcast(self, client, header, msg):
-        with threading.Lock():
-            for recipient_id, recipient in self.__server.clients_connected.items():
-                if recipient.id == client.id:
-                    continue  # Skip the sender
+    def send_broadcast(self, client, *buffers, lane=DATA):
+        # Snapshot of the table, nothing is locked while the frame is handed out
+        self.fan_out(client, self.__server.clients_connected.values(), buffers, lane)
 
-                try:
-                    recipient.socket.sendall(header)
-                    recipient.socket.sendall(msg)
-                except Exception as e:
-                    self.__log_function(
-                        f"Error sending broadcast to {recipient_id}: {e}"
-                    )
+    def send_to_topic(self, client, *buffers, lane=DATA):
+        # Only the clients subscribed to the topic the client publishes
+        self.fan_out(client, self.__topics.subscribers(client.topic), buffers, lane)
+
+    def fan_out(self, client, recipients, buffers, lane=DATA):
+        # Written through where possible, otherwise copied once and every recipient queues
+        # views of the same bytes, one per frame
+        frame = buffers[0] if len(buffers) == 1 else b"".join(buffers)
+        stored = None
+        slow = []
+
+        for recipient in recipients:
+            if recipient is client:
+                continue  # Skip the sender
 
-    def sending_thread(self, client):
-        while self.__server.is_alive:
             try:
-                if len(client.data.body) > 0:
-                    header = client.data.header.pop(0)
-                    msg = client.data.body.pop(0)
+                if self.__write_through(recipient, frame):
+                    continue
+                if stored is None:
+                    stored = split_frames(frame if isinstance(frame, bytes) else bytes(frame))
+                if not self.__enqueue(recipient, stored, lane):
+                    slow.append(recipient)
+            except Exception as e:
+                self.__log_function(f"Error sending to {recipient.id}: {e}")
 
-                    if client.peer == "broadcast":
-                        self.send_broadcast(client=client, header=header, msg=msg)
+        for recipient in slow:
+            self.shed_client(recipient)
 
-                    else:
-                        self.send_to_peer(client=client, header=header, msg=msg)
+    def sending_thread(self, client):
+        # Writer of the client: only this thread blocks on a slow client socket
+        while self.__server.is_alive and not client.data.is_closed():
+            # Sleeps until a frame is queued (the timeout only rechecks the server state),
+            # then writes everything queued meanwhile with one sendmsg. Frames are taken
+            # under the send lock, so a write-through never overtakes them
+            if not client.data.wait(timeout=1):
+                continue
 
-                if len(client.data.body) > OVERHEAD:
-                    # Remove the oldest messages
-                    client.data.header = client.data.header[-(OVERHEAD - DISCARD) :]
-                    client.data.body = client.data.body[-(OVERHEAD - DISCARD) :]
+            try:
+                with client.send_lock:
+                    buffers = client.unsent + client.data.get_batch(timeout=0)
+                    client.unsent = []
+                    client.stats.written(send_buffers(client.socket, buffers))
+                    if not len(client.data):
+                        client.stats.drained()
 
             except Exception as e:
                 self.__log_function(f"Error sending message: {e}")
                 continue
 
-            time.sleep(1 / self.__msg_frequency)
+            if self.__throttled:
+                self.release_credits()
+
+    def take_credits(self, client, frames):
+        with self.lock:
+            client.credits -= frames
+        if client.credits <= client.window // 2:
+            self.grant_credits(client)
+
+    def grant_credits(self, client):
+        # Tops the client's credits up to its window, unless a recipient of its data frames
+        # is congested: the grant then waits for a write to that recipient
+        if self.__congested(client):
+            with self.lock:
+                self.__throttled[id(client)] = client
+            # Checked again once listed, so a queue drained in between is not missed
+            if self.__congested(client):
+                return
+            with self.lock:
+                if self.__throttled.pop(id(client), None) is None:
+                    return  # Released meanwhile
+
+        with self.lock:
+            granted = client.window - client.credits
+            client.credits = client.window
+        if granted > 0:
+            self.send_frames(client, CONTROL_MSG.frame("/credit", str(granted)))
+
+    def release_credits(self):
+        # Called after writes: grants the throttled clients whose recipients caught up
+        with self.lock:
+            throttled, self.__throttled = self.__throttled, {}
+
+        for client in throttled.values():
+            if not client.data.is_closed():
+                self.grant_credits(client)
+
+    def __congested(self, client):
+        # True when a recipient of the client's data frames has high water frames waiting
+        if client.topic is not None:
+            recipients = self.__topics.subscribers(client.topic)
+        elif client.peer == BROADCAST:
+            recipients = self.__server.clients_connected.values()
+        else:
+            peer = self.__server.clients_connected.get(client.peer)
+            recipients = () if peer is None else (peer,)
+
+        return any(
+            len(recipient.data) + len(recipient.unsent) >= self.__high_water
+            for recipient in recipients
+            if recipient is not client
+        )
+
+    def handle_control_msg(self, client, msg, frame):
+        command, arg1, arg2 = CONTROL_MSG.unpack(msg)
+
+        handler = self.__commands.get(command)
+        if handler is None:
+            self.__log_function(f"Unknown command {command} from {client.id}")
+            return
+
+        handler(client, arg1, frame)
+
+    def __change_peer(self, client, arg1, frame):
+        self.__server.clients_connected.set_peer(client, arg1)
+        self.__log_function(f"Peer changed to {arg1}")
+
+    def __change_id(self, client, arg1, frame):
+        # Clients targeting the old id follow the rename. A taken id is refused, the answer
+        # then carries the id the client keeps
+        if not self.update_peers(client, arg1):
+            self.__log_function(f"Id {arg1} already in use, {client.id} not renamed")
 
-    def handle_control_msg(self, client, msg, header):
-        command, arg1, arg2 = ControlMsg().unpack_msg(msg)
+        self.send_frames(client, CONTROL_MSG.frame("/change_id", client.id))
 
-        if command.startswith("/change_peer"):
-            client.peer = arg1
-            self.__log_function(f"Peer changed to {arg1}")
+    def __subscribe(self, client, arg1, frame):
+        if not arg1:
+            self.__log_function(f"Empty topic pattern from {client.id}")
             return
 
-        if command.startswith("/change_id"):
-            self.update_peers(client.id, arg1)
-            client.id = arg1
+        self.__topics.subscribe(client, arg1)
+        self.__log_function(f"{client.id} subscribed to {arg1}")
+        self.send_frames(client, frame)  # Confirms the subscription
 
-            id_name = ControlMsg("/change_id", client.id).pack_msg()
-            header_id = self.pack_header(id_name, "ControlMsg")
+    def __unsubscribe(self, client, arg1, frame):
+        # Without a pattern, every subscription of the client
+        for pattern in self.__topics.unsubscribe(client, arg1 or None):
+            self.__log_function(f"{client.id} unsubscribed from {pattern}")
+            self.send_frames(client, CONTROL_MSG.frame("/unsubscribe", pattern))
 
-            client.socket.sendall(header_id)
-            client.socket.sendall(id_name)
+    def __stats(self, client, arg1, frame):
+        # Answered with a Stats message (JSON), "/stats summary" leaves the clients out
+        self.send_frames(client, STATS.frame(self.get_stats(per_client=arg1 != "summary")))
 
+    def __flow(self, client, arg1, frame):
+        # Credit flow control of the client's data frames: it gets `arg1` credits, one per
+        # frame, and gets them back as its recipients keep up (0 turns it off)
+        try:
+            window = max(int(arg1), 0)
+        except ValueError:
+            self.__log_function(f"Invalid flow window {arg1!r} from {client.id}")
             return
 
-    def update_peers(self, client_id, new_id):
-        for _, clients in self.__server.clients_connected.items():
-            if clients.peer == client_id:
-                clients.peer = new_id
+        with self.lock:
+            client.window = window
+            if not window:
+                client.credits = 0
+        self.__log_function(f"{client.id} flow window {window}")
+        if window:
+            self.grant_credits(client)
+
+    def __publish(self, client, arg1, frame):
+        # Data frames go to the subscribers of the topic (an empty topic goes back to the peer)
+        client.topic = arg1 or None
+        self.__log_function(f"{client.id} publishes to {arg1 or client.peer}")
+
+    def update_peers(self, client, new_id):
+        return self.__server.clients_connected.rename(client, new_id)
 
     def get_is_alive(self):
         return self.__server.is_alive
+
+    def get_dropped(self):
+        # Frames lost to the drop policy, per connected client
+        return {
+            client_id: client.data.dropped
+            for client_id, client in list(self.__server.clients_connected.items())
+        }
+
+    def get_shed(self):
+        # Clients disconnected for not keeping up (DISCONNECT policy)
+        return self.__shed
+
+    def get_stats(self, per_client=True):
+        """
+        Snapshot of the runtime metrics: totals since the server started (the clients gone
+        included), latency histograms of the forwarding and of the time frames wait in the
+        client queues, and the current queue depth and counters of every client.
+        """
+        total = ConnectionStats()
+        with self.lock:
+            total.merge(self.__closed_stats)
+            dropped = self.__closed_dropped
+
+        clients = {}
+        for client in self.__server.clients_connected.values():
+            total.merge(client.stats)
+            dropped += client.data.dropped
+            if per_client:
+                clients[client.id] = dict(
+                    client.stats.snapshot(),
+                    queued=len(client.data),
+                    unsent=len(client.unsent),
+                    dropped=client.data.dropped,
+                    credits=client.credits if client.window else None,
+                    peer=client.peer,
+                    topic=client.topic,
+                )
+
+        snapshot = dict(
+            time=time.time(),
+            uptime_s=time.time() - self.__started,
+            mode=self.__mode,
+            connected=len(self.__server.clients_connected),
+            accepted=self.__accepted,
+            shed=self.__shed,
+            dropped=dropped,
+            throttled=len(self.__throttled),
+            **total.snapshot(),
+            forward=total.forward.snapshot(),
+            queue_wait=total.queue_wait.snapshot(),
+        )
+        if per_client:
+            snapshot["clients"] = clients
+        return snapshot
+
+    def dump_stats(self):
+        # Appends a snapshot to stats_file (one JSON document per line) every stats_interval
+        while self.__server.is_alive:
+            time.sleep(self.__stats_interval)
+            try:
+                with open(self.__stats_file, "a") as stats_file:
+                    stats_file.write(json.dumps(self.get_stats()) + "\n")
+            except OSError as e:
+                self.__log_function(f"Error writing stats to {self.__stats_file}: {e}")
+
+    # Selector mode ---------------------------------------------------------------
+
+    def __start_selector(self):
+        self.__selector = selectors.DefaultSelector()
+        self.__wakeup = socket.socketpair()
+        self.__wakeup[0].setblocking(False)
+
+        self.__server.socket.setblocking(False)
+        self.__selector.register(self.__server.socket, selectors.EVENT_READ, None)
+        self.__selector.register(self.__wakeup[0], selectors.EVENT_READ, self.__wakeup)
+
+        self.__loop_thread = threading.Thread(target=self.selector_loop)
+        self.__loop_thread.start()
+
+    def selector_loop(self):
+        while self.__server.is_alive:
+            try:
+                events = self.__selector.select(timeout=1)
+            except (OSError, ValueError):
+                break  # Server socket closed
+
+            for key, mask in events:
+                if key.data is None:
+                    self.__accept_ready()
+                elif key.data is self.__wakeup:
+                    self.__wakeup_ready()
+                else:
+                    if mask & selectors.EVENT_READ and not self.__read_ready(key.data):
+                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        self.__flush_client(key.data)
+
+            # One write per client for everything queued during this pass
+            with self.lock:
+                dirty, self.__dirty = self.__dirty, {}
+                self.__wakeup_pending = False
+
+            for client in dirty.values():
+                self.__flush_client(client)
+
+    def __accept_ready(self):
+        while True:
+            try:
+                client_socket, address = self.__server.socket.accept()
+            except (BlockingIOError, OSError):
+                return
+
+            try:
+                client_socket.setblocking(False)
+                configure_socket(client_socket, **self.__socket_options)
+                client_socket = accepted(self.__transport, client_socket)
+            except OSError as e:
+                # Gone before it was set up (e.g. during the shared-memory handshake)
+                self.__log_function(f"Socket error while accepting connection: {e}")
+                client_socket.close()
+                continue
+
+            current_client = self.add_new_client(client_socket, address)
+            self.__selector.register(client_socket, selectors.EVENT_READ, current_client)
+            self.__log_function(f"New connection from {address}")
+
+            # Send welcome message
+            new_peer = CONTROL_MSG.frame("/new_peer", current_client.id)
+            self.send_broadcast(current_client, new_peer, lane=CONTROL)
+
+            id_name = CONTROL_MSG.frame("/change_id", current_client.id)
+            self.send_frames(current_client, id_name)
+
+    def __wakeup_ready(self):
+        # The clients to flush are in __dirty, only the wakeup bytes are read here
+        try:
+            while self.__wakeup[0].recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def __read_ready(self, client):
+        if not self.receive_frames(client):
+            return False
+
+        if client.unsent and not client.write_event:
+            self.__flush_client(client)  # The read may have been a SPACE_BELL
+        return True
+
+    def __flush_client(self, client):
+        with client.send_lock:
+            try:
+                # sendmsg until the socket buffer is full (a call that leaves bytes of the
+                # buffers it was given unsent). Frames leave the queue only once the socket
+                # took the previous ones, so a client that does not read fills its queue
+                while True:
+                    if not client.unsent:
+                        client.unsent = client.data.get_batch(timeout=0)
+                        if not client.unsent:
+                            client.stats.drained()
+                            break
+
+                    given = min(len(client.unsent), IOV_MAX)
+                    left = len(client.unsent) - given
+                    sent, client.unsent = send_available(client.socket, client.unsent)
+                    if sent:
+                        client.stats.written(sent)
+                    if len(client.unsent) > left:
+                        break
+            except Exception as e:
+                self.__log_function(f"Error sending to {client.id}: {e}")
+                client.unsent = []
+                return
+
+            events = selectors.EVENT_READ | (client.write_event if client.unsent else 0)
+
+        try:
+            if self.__selector.get_key(client.socket).events != events:
+                self.__selector.modify(client.socket, events, client)
+        except (KeyError, ValueError):
+            pass  # Client already removed
+
+        if self.__throttled:
+            self.release_credits()
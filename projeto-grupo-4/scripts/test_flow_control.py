@@ -0,0 +1,89 @@
+import threading
+import unittest
+
+from flow_control import COALESCE, FAIL_FAST, SendCredits
+from message_queue import BLOCK
+
+
+class SendCreditsTest(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.accept = True
+
+    def credits(self, policy, available=0):
+        credits = SendCredits(self.send, policy)
+        if available:
+            credits.grant(available)
+        return credits
+
+    def send(self, item, lane):
+        if self.accept:
+            self.sent.append(item)
+        return self.accept
+
+    def test_one_credit_per_message(self):
+        credits = self.credits(FAIL_FAST, available=2)
+
+        self.assertEqual([credits.send(k, "data") for k in range(3)], [True, True, False])
+        self.assertEqual(self.sent, [0, 1])
+        self.assertEqual((credits.available, credits.refused), (0, 1))
+
+    def test_refused_by_the_queue_gives_the_credit_back(self):
+        credits = self.credits(FAIL_FAST, available=1)
+        self.accept = False
+
+        self.assertFalse(credits.send(0, "data"))
+        self.assertEqual(credits.available, 1)
+
+    def test_block_waits_for_a_grant(self):
+        credits = self.credits(BLOCK)
+        granter = threading.Timer(0.05, credits.grant, (1,))
+        granter.start()
+
+        self.assertTrue(credits.send(0, "data", timeout=5))
+        granter.join()
+        self.assertEqual((self.sent, credits.available), ([0], 0))
+
+    def test_block_timeout_refuses(self):
+        credits = self.credits(BLOCK)
+
+        self.assertFalse(credits.send(0, "data", timeout=0.01))
+        self.assertEqual((self.sent, credits.refused), ([], 1))
+
+    def test_close_releases_a_blocked_send(self):
+        credits = self.credits(BLOCK)
+        closer = threading.Timer(0.05, credits.close)
+        closer.start()
+
+        self.assertFalse(credits.send(0, "data"))
+        closer.join()
+        self.assertFalse(credits.send(1, "data"))
+        self.assertEqual(self.sent, [])
+
+    def test_coalesce_keeps_the_latest_of_each_lane(self):
+        credits = self.credits(COALESCE)
+        for k in range(3):
+            self.assertTrue(credits.send(f"a{k}", "a"))
+        self.assertTrue(credits.send("b0", "b"))
+
+        self.assertEqual(self.sent, [])
+        self.assertEqual(credits.coalesced, 2)
+
+        credits.grant(1)
+        self.assertEqual(self.sent, ["a2"])  # The oldest lane goes first
+        credits.grant(5)
+        self.assertEqual(self.sent, ["a2", "b0"])
+        self.assertEqual(credits.available, 4)
+
+    def test_grant_keeps_the_order_with_new_messages(self):
+        credits = self.credits(COALESCE)
+        credits.send("kept", "a")
+        credits.grant(2)
+        credits.send("new", "a")
+
+        self.assertEqual(self.sent, ["kept", "new"])
+        self.assertEqual(credits.available, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import socket
+import struct
+import unittest
+
+from framing import HEADER_FORMAT, MAX_FRAME, FrameReader, FrameTooLarge
+from simple_msg import CONTROL_MSG, LABEL_STRING
+
+
+class FrameReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.writer, self.reader_socket = socket.socketpair()
+        self.reader = FrameReader()
+
+    def tearDown(self):
+        self.writer.close()
+        self.reader_socket.close()
+
+    def receive(self, data, parsed=None, frames=None):
+        self.writer.sendall(data)
+        received = 0
+        while received < len(data):
+            received += self.reader.recv_from(self.reader_socket)
+        if frames is None:
+            frames = []
+        for type_message, frame, _ in self.reader.frames(parsed):
+            frames.append((type_message, bytes(frame)))
+        return frames
+
+    def test_type_name_not_text_is_dropped(self):
+        labels = [LABEL_STRING.frame("label", str(k)) for k in range(5)]
+        invalid = struct.pack(HEADER_FORMAT, 3, b"\xff\xfeBad") + b"abc"
+
+        frames = self.receive(invalid + b"".join(labels))
+
+        self.assertEqual(frames, [("LabelString", label) for label in labels])
+        self.assertEqual(self.reader.invalid, 1)
+        self.assertEqual(self.reader.count, 5)
+
+    def test_type_name_not_text_ends_run(self):
+        # The runs around the dropped frame do not carry its bytes
+        label = LABEL_STRING.frame("label", "x")
+        control = CONTROL_MSG.frame("/stats")
+        invalid = struct.pack(HEADER_FORMAT, 3, b"\xff\xfeBad") + b"abc"
+
+        frames = self.receive(label * 2 + invalid + label + control, parsed={"ControlMsg"})
+
+        self.assertEqual(
+            frames,
+            [("LabelString", label * 2), ("LabelString", label), ("ControlMsg", control)],
+        )
+        self.assertEqual(self.reader.invalid, 1)
+
+    def test_frame_too_large_raises_before_growing(self):
+        label = LABEL_STRING.frame("label", "x")
+        huge = struct.pack(HEADER_FORMAT, MAX_FRAME + 1, b"LabelString")
+        frames = []
+
+        with self.assertRaises(FrameTooLarge):
+            self.receive(label + huge, frames=frames)
+
+        # The frames before it are still delivered, and nothing was allocated for it
+        self.assertEqual(frames, [("LabelString", label)])
+        self.writer.sendall(b"x" * 100)
+        self.assertEqual(self.reader.recv_from(self.reader_socket), 100)
+        self.assertEqual(len(self.reader._FrameReader__buffer), 65536)
+
+    def test_frame_limit(self):
+        self.reader = FrameReader(size=64, max_frame=1000)
+        fits = struct.pack(HEADER_FORMAT, 1000, b"LabelString") + bytes(1000)
+        over = struct.pack(HEADER_FORMAT, 1001, b"LabelString")
+
+        self.assertEqual(self.receive(fits), [("LabelString", fits)])
+        with self.assertRaises(FrameTooLarge):
+            self.receive(over)
+
+
+if __name__ == "__main__":
+    unittest.main()
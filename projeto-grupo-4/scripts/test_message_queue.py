@@ -0,0 +1,203 @@
+import threading
+import unittest
+
+from message_queue import BARRIER, BLOCK, CONTROL, DATA, DROP_NEWEST, DROP_OLDEST, MessageQueue
+
+
+class DropPolicyTest(unittest.TestCase):
+    def fill(self, policy, count=5):
+        queue = MessageQueue(maxlen=3, policy=policy)
+        results = [queue.put(k, timeout=0) for k in range(count)]
+        return queue, results
+
+    def test_drop_oldest(self):
+        queue, results = self.fill(DROP_OLDEST)
+
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual(queue.get_batch(), [2, 3, 4])
+        self.assertEqual(queue.dropped, 2)
+
+    def test_drop_newest(self):
+        queue, results = self.fill(DROP_NEWEST)
+
+        self.assertEqual(results, [True, True, True, False, False])
+        self.assertEqual(queue.get_batch(), [0, 1, 2])
+        self.assertEqual(queue.dropped, 2)
+
+    def test_block_gives_up_after_its_timeout(self):
+        queue, results = self.fill(BLOCK)
+
+        self.assertEqual(results, [True, True, True, False, False])
+        self.assertEqual(queue.get_batch(), [0, 1, 2])
+        self.assertEqual(queue.dropped, 2)
+
+    def test_block_waits_for_room(self):
+        queue, _ = self.fill(BLOCK, count=3)
+        taker = threading.Timer(0.05, queue.get)
+        taker.start()
+
+        self.assertTrue(queue.put(3, timeout=5))
+        taker.join()
+        self.assertEqual(queue.get_batch(), [1, 2, 3])
+        self.assertEqual(queue.dropped, 0)
+
+    def test_close_releases_a_blocked_put(self):
+        queue, _ = self.fill(BLOCK, count=3)
+        closer = threading.Timer(0.05, queue.close)
+        closer.start()
+
+        self.assertFalse(queue.put(3))
+        closer.join()
+        self.assertFalse(queue.put(4, timeout=0))
+        self.assertEqual(queue.get(timeout=0), 0)
+
+    def test_put_many_counts_each_item(self):
+        queue = MessageQueue(maxlen=3, policy=DROP_NEWEST)
+
+        self.assertEqual(queue.put_many(range(10)), 3)
+        self.assertEqual(queue.dropped, 7)
+        self.assertEqual(len(queue), 3)
+
+    def test_control_lane_is_never_full(self):
+        queue, _ = self.fill(DROP_NEWEST, count=3)
+
+        self.assertTrue(queue.full())
+        self.assertFalse(queue.full(CONTROL))
+        for k in range(10):
+            self.assertTrue(queue.put(f"c{k}", lane=CONTROL))
+        self.assertEqual(queue.dropped, 0)
+
+
+class LaneTest(unittest.TestCase):
+    def test_control_goes_first(self):
+        queue = MessageQueue(maxlen=10)
+        queue.put("d0")
+        queue.put("c0", lane=CONTROL)
+        queue.put("d1")
+        queue.put("c1", lane=CONTROL)
+
+        self.assertEqual(queue.get_batch(), ["c0", "c1", "d0", "d1"])
+
+    def test_weighted_round_robin(self):
+        queue = MessageQueue(maxlen=10, weights={"fast": 3, "slow": 1})
+        for k in range(6):
+            queue.put(f"f{k}", lane="fast")
+            queue.put(f"s{k}", lane="slow")
+        queue.put("d0")
+
+        self.assertEqual(
+            queue.get_batch(),
+            ["d0", "f0", "f1", "f2", "s0", "f3", "f4", "f5", "s1", "s2", "s3", "s4", "s5"],
+        )
+
+    def test_round_robin_resumes_across_batches(self):
+        queue = MessageQueue(maxlen=10, weights={"fast": 2, "slow": 1})
+        for k in range(4):
+            queue.put(f"f{k}", lane="fast")
+            queue.put(f"s{k}", lane="slow")
+
+        self.assertEqual(queue.get_batch(max_items=3), ["f0", "f1", "s0"])
+        self.assertEqual(queue.get_batch(max_items=3), ["f2", "f3", "s1"])
+
+    def test_unknown_lane_shares_the_data_lane(self):
+        queue = MessageQueue(maxlen=2, policy=DROP_NEWEST, weights={"fast": 1})
+        queue.put("d0")
+        queue.put("u0", lane="unknown")
+
+        self.assertFalse(queue.put("u1", lane="unknown"))
+        self.assertTrue(queue.put("f0", lane="fast"))
+        self.assertEqual(queue.get_batch(), ["d0", "f0", "u0"])
+
+    def test_each_lane_is_bounded_on_its_own(self):
+        queue = MessageQueue(maxlen=2, policy=DROP_OLDEST, weights={"fast": 1})
+        for k in range(4):
+            queue.put(f"f{k}", lane="fast")
+        queue.put("d0")
+
+        self.assertEqual(sorted(queue.get_batch()), ["d0", "f2", "f3"])
+        self.assertEqual(queue.dropped, 2)
+
+
+class BarrierTest(unittest.TestCase):
+    def test_barrier_keeps_its_place_among_data(self):
+        queue = MessageQueue(maxlen=100)
+        for k in range(5):
+            queue.put(f"a{k}")
+        queue.put("/change_peer", lane=BARRIER)
+        queue.put("b0")
+        queue.put("/stats", lane=CONTROL)
+
+        self.assertEqual(
+            queue.get_batch(), ["/stats", "a0", "a1", "a2", "a3", "a4", "/change_peer", "b0"]
+        )
+
+    def test_barrier_waits_for_every_lane(self):
+        queue = MessageQueue(maxlen=100, weights={"fast": 4, "slow": 1})
+        for k in range(8):
+            queue.put(f"fast{k}", lane="fast")
+        queue.put("slow0", lane="slow")
+        queue.put("/publish", lane=BARRIER)
+        queue.put("fast8", lane="fast")
+        queue.put("slow1", lane="slow")
+
+        batch = queue.get_batch()
+
+        before, after = batch[: batch.index("/publish")], batch[batch.index("/publish") + 1 :]
+        self.assertEqual(sorted(before), sorted([f"fast{k}" for k in range(8)] + ["slow0"]))
+        self.assertEqual(sorted(after), ["fast8", "slow1"])
+
+    def test_barrier_taken_in_several_batches(self):
+        queue = MessageQueue(maxlen=100)
+        for k in range(3):
+            queue.put(k)
+        queue.put("barrier", lane=BARRIER)
+        queue.put(3)
+
+        self.assertEqual([queue.get() for _ in range(5)], [0, 1, 2, "barrier", 3])
+        self.assertEqual(len(queue), 0)
+
+    def test_dropped_messages_release_the_barrier(self):
+        queue = MessageQueue(maxlen=2)
+        queue.put(0)
+        queue.put(1)
+        queue.put("barrier", lane=BARRIER)
+        queue.put(2)  # Drops 0, which no longer holds the barrier back
+
+        self.assertFalse(queue.full(BARRIER))
+        self.assertEqual(queue.get_batch(), [1, "barrier", 2])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_barrier_on_empty_queue(self):
+        queue = MessageQueue(maxlen=10)
+        queue.put("barrier", lane=BARRIER)
+        queue.put(0, lane=DATA)
+
+        self.assertEqual(queue.get_batch(max_items=1), ["barrier"])
+        self.assertEqual(queue.get_batch(), [0])
+
+
+class WakeTest(unittest.TestCase):
+    def test_wake_returns_wait_without_queuing(self):
+        queue = MessageQueue(maxlen=1, policy=DROP_OLDEST)
+        queue.put("frame")
+        queue.get()
+
+        queue.wake()
+
+        self.assertTrue(queue.wait(timeout=0))
+        self.assertEqual(len(queue), 0)
+        self.assertFalse(queue.wait(timeout=0))  # Once per wake()
+        queue.put("next")
+        self.assertEqual(queue.dropped, 0)
+
+    def test_wake_from_another_thread(self):
+        queue = MessageQueue()
+        waker = threading.Timer(0.05, queue.wake)
+        waker.start()
+
+        self.assertTrue(queue.wait(timeout=5))
+        waker.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import types
+import unittest
+
+from routing import BROADCAST, RoutingTable, TopicIndex
+
+
+def client(client_id, peer=BROADCAST):
+    return types.SimpleNamespace(id=client_id, peer=peer)
+
+
+class RoutingTableTest(unittest.TestCase):
+    def setUp(self):
+        self.table = RoutingTable()
+        self.a, self.b, self.c = client("a"), client("b", peer="a"), client("c", peer="a")
+        for each in (self.a, self.b, self.c):
+            self.assertTrue(self.table.add(each))
+
+    def test_add_refuses_a_taken_id(self):
+        self.assertFalse(self.table.add(client("a")))
+        self.assertIs(self.table.get("a"), self.a)
+        self.assertEqual(len(self.table), 3)
+
+    def test_rename_moves_the_clients_targeting_it(self):
+        self.assertTrue(self.table.rename(self.a, "alice"))
+
+        self.assertIsNone(self.table.get("a"))
+        self.assertIs(self.table.get("alice"), self.a)
+        self.assertEqual((self.b.peer, self.c.peer), ("alice", "alice"))
+        self.assertEqual(self.table.remove(self.a), [self.b, self.c])
+
+    def test_rename_refuses_a_taken_id(self):
+        self.assertFalse(self.table.rename(self.b, "a"))
+        self.assertEqual(self.b.id, "b")
+
+    def test_remove_returns_the_orphans_back_to_broadcast(self):
+        self.table.set_peer(self.c, "b")
+
+        self.assertEqual(self.table.remove(self.a), [self.b])
+        self.assertEqual(self.b.peer, BROADCAST)
+        self.assertEqual(self.c.peer, "b")
+        self.assertIsNone(self.table.remove(self.a))
+        self.assertEqual([each.id for each in self.table.values()], ["b", "c"])
+
+
+class TopicIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.topics = TopicIndex()
+        self.exact, self.motor, self.everything = client("exact"), client("motor"), client("all")
+        self.topics.subscribe(self.exact, "motor/velocity")
+        self.topics.subscribe(self.motor, "motor/*")
+        self.topics.subscribe(self.everything, "*")
+
+    def subscribers(self, topic):
+        return sorted(each.id for each in self.topics.subscribers(topic))
+
+    def test_exact_and_wildcard_patterns(self):
+        self.assertEqual(self.subscribers("motor/velocity"), ["all", "exact", "motor"])
+        self.assertEqual(self.subscribers("motor/current"), ["all", "motor"])
+        self.assertEqual(self.subscribers("motor/"), ["all", "motor"])
+        self.assertEqual(self.subscribers("motor"), ["all"])
+        self.assertEqual(self.subscribers("motorcycle/velocity"), ["all"])
+        self.assertEqual(self.subscribers("motor/velocity/x"), ["all", "motor"])
+
+    def test_subscribed_twice_is_one_subscriber(self):
+        self.topics.subscribe(self.exact, "motor/*")
+
+        self.assertEqual(self.subscribers("motor/velocity"), ["all", "exact", "motor"])
+
+    def test_unsubscribe_clears_the_cached_topics(self):
+        self.assertEqual(self.subscribers("motor/current"), ["all", "motor"])
+
+        self.assertEqual(self.topics.unsubscribe(self.motor, "motor/*"), ["motor/*"])
+        self.assertEqual(self.subscribers("motor/current"), ["all"])
+        self.assertEqual(self.topics.unsubscribe(self.motor, "motor/*"), [])
+
+    def test_unsubscribe_everything(self):
+        self.topics.subscribe(self.exact, "telemetry/*")
+
+        self.assertEqual(
+            sorted(self.topics.unsubscribe(self.exact)), ["motor/velocity", "telemetry/*"]
+        )
+        self.assertEqual(self.topics.subscriptions(self.exact), [])
+        self.assertEqual(self.subscribers("motor/velocity"), ["all", "motor"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import socket
+import threading
+import unittest
+
+from benchmark import pack_frame, recv_frame, start_server, wait_control
+from simple_client import Client
+from simple_msg import ControlMsg, LabelString
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+class RoutingOrderTest(unittest.TestCase):
+    MESSAGES = 3000
+
+    def setUp(self):
+        self.port = free_port()
+        self.server = start_server(self.port, "threads", queue_size=10 * self.MESSAGES)
+
+    def tearDown(self):
+        # The client's threads stop once the server is gone
+        self.server.kill()
+        self.server.wait()
+
+    def receiver(self, name):
+        sock = socket.create_connection(("127.0.0.1", self.port))
+        wait_control(sock, "/change_id")
+        sock.sendall(pack_frame(ControlMsg("/change_id", name).pack_msg(), "ControlMsg"))
+        wait_control(sock, "/change_id")
+        self.addCleanup(sock.close)
+
+        values = []
+
+        def read():
+            sock.settimeout(2)
+            try:
+                while True:
+                    type_message, body = recv_frame(sock)
+                    if type_message == "LabelString":
+                        values.append(LabelString().unpack_msg(body)[1])
+            except OSError:
+                pass
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        return thread, values
+
+    def test_change_peer_does_not_overtake_data(self):
+        # With a small socket buffer most of the messages to A are still queued in the
+        # client when /change_peer B is sent: none of them may be routed to B
+        thread_a, to_a = self.receiver("A")
+        thread_b, to_b = self.receiver("B")
+
+        client = Client(send_buffer=4096)
+        client.start_connection("127.0.0.1", self.port, "sender", "A")
+        for k in range(self.MESSAGES):
+            client.send_message(f"before{k}")
+        client.send_message("/change_peer B")
+        client.send_message("after")
+
+        thread_a.join()
+        thread_b.join()
+
+        self.assertEqual(to_a, [f"before{k}" for k in range(self.MESSAGES)])
+        self.assertEqual(to_b, ["after"])
+
+
+if __name__ == "__main__":
+    unittest.main()
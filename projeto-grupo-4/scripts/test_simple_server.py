@@ -0,0 +1,55 @@
+import socket
+import struct
+import unittest
+
+from benchmark import recv_frame, start_server, wait_control
+from framing import HEADER_FORMAT, MAX_FRAME
+from simple_msg import CONTROL_MSG
+from simple_server import SELECTOR, THREADS
+from test_simple_client import free_port
+
+
+class ReceiveFramesTest(unittest.TestCase):
+    def connect(self, mode):
+        port = free_port()
+        server = start_server(port, mode)
+        self.addCleanup(server.wait)
+        self.addCleanup(server.kill)
+
+        sock = socket.create_connection(("127.0.0.1", port))
+        self.addCleanup(sock.close)
+        sock.settimeout(5)
+        wait_control(sock, "/change_id")
+        return sock
+
+    def test_frames_after_a_failed_handler_are_handled(self):
+        # Both frames arrive in one read: the second one must not wait for another read
+        for mode in (THREADS, SELECTOR):
+            with self.subTest(mode=mode):
+                sock = self.connect(mode)
+                invalid = bytearray(CONTROL_MSG.frame("/stats"))
+                invalid[struct.calcsize(HEADER_FORMAT)] = 0xFF  # Body not text
+
+                sock.sendall(bytes(invalid) + CONTROL_MSG.frame("/stats", "summary"))
+
+                while True:
+                    type_message, _ = recv_frame(sock)
+                    if type_message == "Stats":
+                        break
+
+    def test_frame_too_large_drops_the_client(self):
+        for mode in (THREADS, SELECTOR):
+            with self.subTest(mode=mode):
+                sock = self.connect(mode)
+
+                sock.sendall(struct.pack(HEADER_FORMAT, MAX_FRAME + 1, b"LabelString"))
+
+                try:
+                    while sock.recv(4096):
+                        pass
+                except ConnectionResetError:
+                    pass
+
+
+if __name__ == "__main__":
+    unittest.main()
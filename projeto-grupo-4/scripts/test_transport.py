@@ -0,0 +1,63 @@
+import os
+import socket
+import threading
+import unittest
+
+from transport import ShmConnection
+
+
+@unittest.skipUnless(hasattr(os, "memfd_create"), "shared-memory rings need memfd_create")
+class ShmConnectionTest(unittest.TestCase):
+    def setUp(self):
+        server_socket, client_socket = socket.socketpair()
+        self.server = ShmConnection.serve(server_socket, capacity=4096)
+        self.client = ShmConnection.attach(client_socket)
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+    def receive(self, connection, size):
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            count = connection.recv_into(view[received:])
+            if not count:
+                break
+            received += count
+        return bytes(buffer[:received])
+
+    def test_both_directions(self):
+        self.client.sendall(b"ping")
+        self.assertEqual(self.receive(self.server, 4), b"ping")
+
+        self.assertEqual(self.server.sendmsg([b"po", b"ng"]), 4)
+        self.assertEqual(self.receive(self.client, 4), b"pong")
+
+    def test_more_than_the_ring_holds(self):
+        # The writer waits for room as the reader drains, across the end of the ring
+        data = bytes(range(256)) * 100
+        writer = threading.Thread(target=self.server.sendall, args=(data,))
+        writer.start()
+
+        self.assertEqual(self.receive(self.client, len(data)), data)
+        writer.join()
+
+    def test_full_ring_without_blocking(self):
+        self.server.setblocking(False)
+
+        self.assertEqual(self.server.send(bytes(5000)), 4096)
+        with self.assertRaises(BlockingIOError):
+            self.server.send(b"x")
+
+    def test_end_of_file_after_the_data(self):
+        self.server.sendall(b"last")
+        self.server.close()
+
+        self.assertEqual(self.receive(self.client, 4), b"last")
+        self.assertEqual(self.client.recv_into(bytearray(4)), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
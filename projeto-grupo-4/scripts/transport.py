@@ -0,0 +1,300 @@
+import errno
+import mmap
+import os
+import socket
+import struct
+import tempfile
+import threading
+
+# Transports of the framing: TCP, a Unix domain stream socket, or shared-memory rings
+# (set up over a Unix domain socket) for clients on the same host as the server
+TCP = "tcp"
+UNIX = "unix"
+SHM = "shm"
+
+TRANSPORTS = (TCP, UNIX, SHM)
+
+RING_SIZE = 1 << 20  # Bytes of each shared-memory ring (one per direction and connection)
+SPACE_POLL = 0.001  # [s] A writer facing a full ring looks at it again at least this often
+
+# Layout of a ring: write and read positions (modulo 2**32), the writer's request for a
+# space doorbell, then the data
+HEAD, TAIL, WAITING = 0, 1, 2
+RING_HEADER = 64
+MASK = 0xFFFFFFFF
+
+# Doorbells sent over the socket of a shared-memory connection
+DATA_BELL = b"d"  # Data written into a ring its reader had drained
+SPACE_BELL = b"s"  # Room made in a ring its writer found full
+BELLS = 4096  # Most doorbells read at once
+
+_HANDSHAKE = struct.Struct("!I")  # Ring size, sent by the server along with the memfd
+
+
+def unix_path(port):
+    # Default socket path of the local transports, so a port number still names a server
+    return os.path.join(tempfile.gettempdir(), f"simple_server_{port}.sock")
+
+
+def address(transport, ip, port, path=None):
+    # (ip, port) over TCP, the socket path otherwise
+    if transport == TCP:
+        return ip, port
+    return path if path is not None else unix_path(port)
+
+
+def create_socket(transport):
+    if transport not in TRANSPORTS:
+        raise ValueError(f"Unknown transport: {transport}")
+    family = socket.AF_INET if transport == TCP else socket.AF_UNIX
+    return socket.socket(family, socket.SOCK_STREAM)
+
+
+def accepted(transport, sock):
+    # Server side of a new connection: the connection to read and write
+    if transport == SHM:
+        return ShmConnection.serve(sock)
+    return sock
+
+
+def connected(transport, sock):
+    # Client side of a new connection: the connection to read and write
+    if transport == SHM:
+        return ShmConnection.attach(sock)
+    return sock
+
+
+def connect(transport, ip, port, path=None):
+    sock = create_socket(transport)
+    sock.connect(address(transport, ip, port, path))
+    return connected(transport, sock)
+
+
+class _Ring:
+    """
+    One direction of a shared-memory connection: a byte ring with a single writer and a
+    single reader. The writer only moves HEAD and the reader only TAIL, each after copying
+    the data, so neither needs a lock.
+    """
+    __slots__ = ("index", "data", "capacity")
+
+    def __init__(self, view, offset, capacity):
+        self.index = view[offset : offset + 12].cast("I")
+        self.data = view[offset + RING_HEADER : offset + RING_HEADER + capacity]
+        self.capacity = capacity
+
+    def free(self):
+        return self.capacity - ((self.index[HEAD] - self.index[TAIL]) & MASK)
+
+    def write(self, data):
+        # Copies what fits of data, returns the number of bytes written
+        index = self.index
+        head = index[HEAD]
+        count = min(self.capacity - ((head - index[TAIL]) & MASK), len(data))
+        if not count:
+            return 0
+
+        start = head & (self.capacity - 1)
+        first = min(count, self.capacity - start)
+        if first == len(data):
+            self.data[start : start + first] = data
+        else:
+            data = memoryview(data)
+            self.data[start : start + first] = data[:first]
+            self.data[: count - first] = data[first:count]
+
+        index[HEAD] = (head + count) & MASK
+        return count
+
+    def read_into(self, buffer):
+        # Copies what fits of the ring into buffer, returns the number of bytes read
+        index = self.index
+        tail = index[TAIL]
+        count = min((index[HEAD] - tail) & MASK, len(buffer))
+        if not count:
+            return 0
+
+        start = tail & (self.capacity - 1)
+        first = min(count, self.capacity - start)
+        buffer[:first] = self.data[start : start + first]
+        if count > first:
+            buffer[first:count] = self.data[: count - first]
+
+        index[TAIL] = (tail + count) & MASK
+        return count
+
+    def release(self):
+        self.index.release()
+        self.data.release()
+
+
+class ShmConnection:
+    """
+    Connection over two shared-memory rings, one per direction, with the part of the socket
+    interface the server and the client use (recv_into, send, sendmsg, sendall, ...).
+
+    The server creates the rings in a memfd and passes it to the client over the Unix
+    socket it accepted. From then on the socket only carries doorbells: DATA_BELL when a
+    write finds its ring drained (the reader may be asleep on the socket), SPACE_BELL when
+    a read makes room the writer asked for. Writes to a reader that keeps up cost no system
+    call, and selectors and blocking reads still wait on the socket.
+
+    The positions are stored after the data they cover. Python has no memory barrier: this
+    holds on x86 and on single-core CPUs (the BeagleBone Black's), not on every multi-core
+    ARM.
+    """
+
+    def __init__(self, sock, mapping, capacity, server_side):
+        self.__sock = sock
+        self.__mapping = mapping
+        view = memoryview(mapping)
+        first = _Ring(view, 0, capacity)
+        second = _Ring(view, RING_HEADER + capacity, capacity)
+        view.release()
+
+        self.__tx, self.__rx = (first, second) if server_side else (second, first)
+        self.__blocking = sock.getblocking()
+        self.__space = threading.Condition()  # Notified when a SPACE_BELL arrives
+
+    @classmethod
+    def serve(cls, sock, capacity=RING_SIZE):
+        # Server side: creates the rings and hands them to the client
+        if capacity & (capacity - 1) or not 0 < capacity <= 1 << 31:
+            raise ValueError(f"Ring size must be a power of two up to 2**31, not {capacity}")
+
+        size = 2 * (RING_HEADER + capacity)
+        fd = os.memfd_create("simple_server_rings")
+        try:
+            os.ftruncate(fd, size)
+            mapping = mmap.mmap(fd, size)
+            socket.send_fds(sock, [_HANDSHAKE.pack(capacity)], [fd])
+        finally:
+            os.close(fd)
+        return cls(sock, mapping, capacity, server_side=True)
+
+    @classmethod
+    def attach(cls, sock):
+        # Client side: maps the rings the server sent
+        message, fds, _, _ = socket.recv_fds(sock, _HANDSHAKE.size, 1)
+        try:
+            if len(message) != _HANDSHAKE.size or not fds:
+                raise ConnectionError("The server sent no shared-memory rings")
+            (capacity,) = _HANDSHAKE.unpack(message)
+            mapping = mmap.mmap(fds[0], 2 * (RING_HEADER + capacity))
+        finally:
+            for fd in fds:
+                os.close(fd)
+        return cls(sock, mapping, capacity, server_side=False)
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        # Returns 0 once the peer closed and everything it wrote was read
+        if nbytes:
+            buffer = memoryview(buffer)[:nbytes]
+
+        while True:
+            received = self.__rx.read_into(buffer)
+            if received:
+                if self.__rx.index[WAITING]:
+                    self.__rx.index[WAITING] = 0
+                    try:
+                        self.__ring(SPACE_BELL)
+                    except OSError:
+                        pass  # The peer closed, its end of file comes next
+                return received
+
+            # Drained: read the doorbells, then look at the ring again before sleeping on
+            # the socket, so a write made in between is not missed
+            try:
+                bells = self.__sock.recv(BELLS, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                if not self.__blocking or flags & socket.MSG_DONTWAIT:
+                    raise
+                bells = self.__sock.recv(BELLS)
+
+            if not bells:
+                return self.__rx.read_into(buffer)  # Written before the peer closed
+            if SPACE_BELL in bells:
+                with self.__space:
+                    self.__space.notify_all()
+
+    def recv(self, bufsize, flags=0):
+        buffer = bytearray(bufsize)
+        return bytes(buffer[: self.recv_into(buffer, bufsize, flags)])
+
+    def send(self, data, flags=0):
+        return self.__write((data,), self.__blocking and not flags & socket.MSG_DONTWAIT)
+
+    def sendmsg(self, buffers, *args):
+        return self.__write(buffers, self.__blocking)
+
+    def sendall(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[self.__write((view,), self.__blocking) :]
+
+    def setblocking(self, flag):
+        self.__blocking = flag
+        self.__sock.setblocking(flag)
+
+    def getblocking(self):
+        return self.__blocking
+
+    def fileno(self):
+        return self.__sock.fileno()
+
+    def getsockname(self):
+        return self.__sock.getsockname()
+
+    def close(self):
+        self.__sock.close()
+        with self.__space:
+            self.__space.notify_all()
+        try:
+            self.__tx.release()
+            self.__rx.release()
+            self.__mapping.close()
+        except (BufferError, ValueError):
+            pass  # A slice of the rings is still in use, the mapping goes with it
+
+    def __write(self, buffers, block):
+        # Writes the buffers in order until the ring is full, like a sendmsg. Only waits
+        # (for a SPACE_BELL, or SPACE_POLL) when nothing could be written
+        tx = self.__tx
+        written = 0
+        buffers = [buffer for buffer in buffers if len(buffer)]
+        current, offset = 0, 0
+
+        while current < len(buffers):
+            buffer = buffers[current]
+            head = tx.index[HEAD]
+            count = tx.write(memoryview(buffer)[offset:] if offset else buffer)
+            if count:
+                written += count
+                if tx.index[TAIL] == head:
+                    self.__ring(DATA_BELL)  # The reader had read everything before it
+                offset += count
+                if offset == len(buffer):
+                    current, offset = current + 1, 0
+                continue
+
+            # Full: ask the reader for a SPACE_BELL, then look again (it may have read
+            # everything in between, and will not ring)
+            tx.index[WAITING] = 1
+            if tx.free():
+                continue
+            if written:
+                break
+            if not block:
+                raise BlockingIOError(errno.EAGAIN, "Shared-memory ring full")
+            with self.__space:
+                self.__space.wait(SPACE_POLL)
+            if self.__sock.fileno() < 0:
+                raise OSError(errno.EBADF, "Connection closed")
+
+        return written
+
+    def __ring(self, bell):
+        try:
+            self.__sock.send(bell, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            pass  # The socket is full of doorbells the peer has yet to read
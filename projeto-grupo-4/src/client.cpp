@@ -144,6 +144,11 @@ void Client::receivingMsg(const int msg_size, const std::string& type_message){
         msg.display();
     }
 
+    else if (type_message.substr(0, 14) == "DataPointBatch"){
+        std::vector<PackedDataPoint> records = DataPointBatch::unpack_msg(buffer.data(), buffer.size());
+        std::cout << "[DataPointBatch] " << records.size() << " records" << std::endl;
+    }
+
     else{
         std::cerr << "Unknown message type" << std::endl;}
 }
@@ -173,6 +178,16 @@ void Client::handleControlMsg(const std::array<uint8_t, CONTROL_MSG_BUFFER>& con
         this->_client.client_peer = "broadcast";
     }   
 
+    else if (msg.getName() == "/subscribe"){
+        this->_client.subscriptions.insert(msg.getArg1());
+        std::cout << "Subscribed to " << msg.getArg1() << std::endl;
+    }
+
+    else if (msg.getName() == "/unsubscribe"){
+        this->_client.subscriptions.erase(msg.getArg1());
+        std::cout << "Unsubscribed from " << msg.getArg1() << std::endl;
+    }
+
     else{
         std::cerr << "Unknown control message" << std::endl;
     }
@@ -197,15 +212,38 @@ void Client::sendingMsg(const std::string& command, const std::string& arg1, con
     sendingMsg(buffer.data(), "ControlMsg", CONTROL_MSG_BUFFER);
 }
 
+void Client::sendingDataPoints(const PackedDataPoint* records, size_t count){
+    std::vector<uint8_t> buffer = DataPointBatch::pack_msg(records, count);
+    sendingMsg(buffer.data(), "DataPointBatch", buffer.size());
+}
+
+void Client::subscribe(const std::string& pattern){
+    sendingMsg("/subscribe", pattern, "");
+}
+
+void Client::unsubscribe(const std::string& pattern){
+    sendingMsg("/unsubscribe", pattern, "");
+}
+
+void Client::publish(const std::string& topic){
+    this->_mutex.lock();
+    this->_client.topic = topic;
+    this->_mutex.unlock();
+
+    sendingMsg("/publish", topic, "");
+}
+
 void Client::sendBytes(const uint8_t* buffer, int content_size){
     // Send a buffer to the server
     int bytes_sent = 0;
     while (bytes_sent < content_size){
-        bytes_sent = send(this->client_socket, buffer, content_size, 0);
-        if (bytes_sent < 0){
+        // send may write only part of a large message (a DataPointBatch), continue after it
+        ssize_t chunk = send(this->client_socket, buffer + bytes_sent, content_size - bytes_sent, 0);
+        if (chunk < 0){
             std::cerr << "Error sending data to server" << std::endl;
             break;
         }
+        bytes_sent += chunk;
     }
 }
 